@@ -0,0 +1,182 @@
+# asyncio versions of the HackRF RX calls, for programs that run an event
+# loop.  HackRF.astream, aread_samples and aconfigure call into here; the
+# module is only imported by them, since it needs Python 3.
+#
+#   async for block in hackrf.astream(block_size=131072):
+#       ...
+#   iq = await hackrf.aread_samples(2e6)
+#   await hackrf.aconfigure(freq=433.92e6, lna=16)
+#
+# Nothing here blocks the loop.  The libhackrf callback thread hands
+# finished blocks (and finished captures) to the loop with
+# call_soon_threadsafe, once per block rather than once per transfer.
+# The calls that do block, starting and stopping RX and the USB control
+# transfers behind configure(), run on a single worker thread per device,
+# which also keeps them in order.
+
+import asyncio
+import functools
+import queue
+import threading
+import numpy as np
+
+import iqconvert
+import libhackrf
+
+
+def _loop():
+    try:
+        return asyncio.get_running_loop()
+    except AttributeError:
+        return asyncio.get_event_loop()
+
+
+# the worker thread for hackrf's blocking calls
+def _executor(hackrf):
+    executor = getattr(hackrf, '_aio_executor', None)
+    if executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(max_workers=1)
+        hackrf._aio_executor = executor
+    return executor
+
+
+async def _call(hackrf, fn, *args, **kwargs):
+    return await _loop().run_in_executor(_executor(hackrf),
+            functools.partial(fn, *args, **kwargs))
+
+
+# Stands in for BlockQueue.ready: queued blocks go to an asyncio.Queue on
+# loop.  put_nowait is called from the libhackrf thread and raises
+# queue.Full, like the queue it replaces, once maxsize blocks are waiting
+# (counting those still on their way to the loop), so BlockQueue drops
+# blocks exactly as it does for stream().
+class LoopQueue(object):
+
+    def __init__(self, loop, maxsize):
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize)
+        self._slots = threading.Semaphore(maxsize)
+
+    def put_nowait(self, i):
+        if not self._slots.acquire(False):
+            raise queue.Full
+        try:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, i)
+        except RuntimeError:
+            # the loop is closed, nobody is listening
+            self._slots.release()
+            raise queue.Full
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    async def get(self):
+        i = await self.queue.get()
+        self._slots.release()
+        return i
+
+
+# async version of HackRF.stream, with the same arguments
+# the blocks come from hackrf.block_queue, a BlockQueue whose ready queue
+# is a LoopQueue; dropped blocks are counted in its dropped
+async def astream(hackrf, block_size=131072, queue_depth=16, num_blocks=None,
+        timeout=None):
+    bq = libhackrf.BlockQueue(2*int(block_size), queue_depth)
+    bq.ready = ready = LoopQueue(_loop(), queue_depth)
+    hackrf.block_queue = bq
+
+    result = None
+    try:
+        # starting RX is a USB control transfer too
+        result = await _call(hackrf, hackrf.lib.hackrf_start_rx,
+                hackrf.dev_p, libhackrf.st_callback, None)
+        if result != 0:
+            raise IOError("Error in hackrf_start_rx")
+
+        count = 0
+        while num_blocks is None or count < num_blocks:
+            try:
+                i = await asyncio.wait_for(ready.get(), timeout)
+            except asyncio.TimeoutError:
+                raise IOError("No samples received in %g s" % timeout)
+            yield bq.blocks[i]
+            bq.release(i)
+            count += 1
+    finally:
+        # result is None if this was cancelled while RX was starting; the
+        # worker stops it after the start is done
+        if result is None or result == 0:
+            result = await _call(hackrf, hackrf.lib.hackrf_stop_rx,
+                    hackrf.dev_p)
+            if result != 0:
+                raise IOError("Error in hackrf_stop_rx")
+
+
+# async version of HackRF.read_samples
+# dtype is what the samples are converted to (on the worker thread), None
+# for the raw int8 IQ
+# cancelling the task stops the capture
+async def aread_samples(hackrf, num_samples=131072, out=None, timeout=None,
+        dtype=np.complex128):
+    loop = _loop()
+    done = loop.create_future()
+
+    def finished():
+        loop.call_soon_threadsafe(
+                lambda: done.done() or done.set_result(None))
+
+    deadline = None if timeout is None else libhackrf._clock() + timeout
+    hackrf.capture_listener = finished
+    try:
+        started = True
+        try:
+            try:
+                await _call(hackrf, hackrf._start_capture, num_samples, out)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # nothing was started
+                started = False
+                raise
+
+            # same checks as _wait_capture, waiting on done instead
+            while not hackrf.capture_done.is_set():
+                wait = libhackrf.STREAMING_CHECK_INTERVAL
+                if deadline is not None:
+                    wait = min(wait, deadline - libhackrf._clock())
+                    if wait <= 0:
+                        raise IOError("Capture timed out with %d of %d "
+                                "bytes received"
+                                % (hackrf.buffer_offset, hackrf.num_bytes))
+                try:
+                    await asyncio.wait_for(asyncio.shield(done), wait)
+                    break
+                except asyncio.TimeoutError:
+                    pass
+                if hackrf.lib.hackrf_is_streaming(hackrf.dev_p) \
+                        != libhackrf.HackRfError.HACKRF_TRUE \
+                        and not hackrf.capture_done.is_set():
+                    raise IOError("HackRF stopped streaming with %d of %d "
+                            "bytes received"
+                            % (hackrf.buffer_offset, hackrf.num_bytes))
+
+            if hackrf._capture_cancelled:
+                raise libhackrf.CaptureCancelled("Capture cancelled with %d "
+                        "of %d bytes received"
+                        % (hackrf.buffer_offset, hackrf.num_bytes))
+        finally:
+            # also when cancelled while starting, as in astream
+            if started:
+                await _call(hackrf, hackrf._stop_capture)
+    finally:
+        hackrf.capture_listener = None
+
+    if dtype is None:
+        return hackrf.buffer
+    return await _call(hackrf, iqconvert.convert, hackrf.buffer, dtype)
+
+
+# HackRF.configure on the worker thread
+async def aconfigure(hackrf, **settings):
+    return await _call(hackrf, hackrf.configure, **settings)
@@ -0,0 +1,356 @@
+# Virtual HackRF devices.
+#
+# A backend is what HackRF calls for everything it does with a device;
+# normally that's the native libhackrf.  The backends here implement the
+# same functions in Python, so everything built on HackRF (read_samples,
+# start_rx, stream, record, ...) runs without a board:
+#
+#   hackrf = HackRF(backend=FileBackend('capture.cs8'))
+#   hackrf = HackRF(backend=SyntheticBackend(tones=[(1e6, 0.5)]))
+#
+# Samples reach the HackRF callbacks the same way they do from libhackrf:
+# a thread calls the ctypes callback with a POINTER(hackrf_transfer) per
+# transfer.  With realtime=True transfers are paced at the configured
+# sample rate, otherwise they are delivered as fast as possible.
+# When pacing, a transfer that is due more than one transfer period late
+# (because the callbacks can't keep up) is counted in overruns, which is
+# where a real device would start losing data.
+#
+# TX works the same way in the other direction: the thread hands the
+# callback an empty transfer to fill, and what it filled is passed to
+# tx_sink (if set) as an int8 array that is only valid during the call.
+
+from ctypes import *
+import threading
+import time
+import numpy as np
+
+from libhackrf import hackrf_transfer, hackrf_device_list_t, \
+        read_partid_serialno_t, HackRfError, HackRfUsbBoardId
+
+# bytes in one libhackrf USB transfer
+TRANSFER_SIZE = 262144
+
+
+class VirtualBackend(object):
+
+    # if time_callbacks is set, the time taken by each callback is kept
+    # in callback_times (seconds, one entry per transfer)
+    def __init__(self, realtime=True, transfer_size=TRANSFER_SIZE,
+            serial=(0, 0, 0x12345678, 0x9abcdef0), time_callbacks=False,
+            tx_sink=None):
+        self.realtime = realtime
+        self.time_callbacks = time_callbacks
+        self.tx_sink = tx_sink
+        self.transfer_size = int(transfer_size)
+        self.serial = serial
+
+        self.sample_rate = 20e6
+        self.center_freq = 100e6
+        self.lna_gain = 16
+        self.vga_gain = 16
+        self.amp_enable = 0
+        self.txvga_gain = 0
+
+        # every opened device gets a small buffer whose address stands in
+        # for the hackrf_device pointer
+        self._devices = {}
+
+        self._thread = None
+        self._stop = threading.Event()
+        self.streaming = False
+
+        # device lists handed out and freed, to check nothing leaks
+        self.lists = 0
+        self.lists_freed = 0
+
+        # counters for the current or last stream
+        self.transfers = 0
+        self.overruns = 0
+        self.callback_times = []
+        self.tx_bytes = 0
+
+    # subclasses return (address, length) of the next transfer's data,
+    # or None when there is nothing more to deliver
+    def next_transfer(self):
+        raise NotImplementedError
+
+    # called before the first transfer of every stream
+    def reset(self):
+        pass
+
+    # libhackrf functions used by HackRF
+
+    def hackrf_init(self):
+        return HackRfError.HACKRF_SUCCESS
+
+    def hackrf_exit(self):
+        return HackRfError.HACKRF_SUCCESS
+
+    # serial number as hackrf_device_list and hackrf_info show it
+    @property
+    def serial_string(self):
+        return "".join("%08x" % v for v in self.serial)
+
+    # a list with this one device in it, like libhackrf's
+    def hackrf_device_list(self):
+        serials = (c_char_p*1)(self.serial_string.encode('ascii'))
+        boards = (c_int*1)(HackRfUsbBoardId.USB_BOARD_ID_HACKRF_ONE)
+        indexes = (c_int*1)(0)
+        dl = hackrf_device_list_t(cast(serials, POINTER(c_char_p)),
+                cast(boards, POINTER(c_int)), cast(indexes, POINTER(c_int)),
+                1, None, 1)
+        # the arrays live as long as the list
+        dl._arrays = (serials, boards, indexes)
+        self.lists += 1
+        return pointer(dl)
+
+    def hackrf_device_list_free(self, device_list):
+        self.lists_freed += 1
+
+    def _open(self, dev_pp):
+        dev = create_string_buffer(8)
+        self._devices[addressof(dev)] = dev
+        dev_pp[0] = addressof(dev)
+        return HackRfError.HACKRF_SUCCESS
+
+    def hackrf_device_list_open(self, device_list, index, dev_pp):
+        if index != 0:
+            return HackRfError.HACKRF_ERROR_NOT_FOUND
+        return self._open(dev_pp)
+
+    # like libhackrf, serial may be just the end of the serial number
+    def hackrf_open_by_serial(self, serial, dev_pp):
+        if serial is not None and \
+                not self.serial_string.endswith(serial.decode('ascii')):
+            return HackRfError.HACKRF_ERROR_NOT_FOUND
+        return self._open(dev_pp)
+
+    def hackrf_close(self, dev_p):
+        self._devices.pop(dev_p.value, None)
+        return HackRfError.HACKRF_SUCCESS
+
+    def hackrf_set_freq(self, dev_p, freq):
+        self.center_freq = freq
+        return HackRfError.HACKRF_SUCCESS
+
+    def hackrf_set_sample_rate(self, dev_p, rate):
+        self.sample_rate = rate
+        return HackRfError.HACKRF_SUCCESS
+
+    def hackrf_set_amp_enable(self, dev_p, value):
+        self.amp_enable = value
+        return HackRfError.HACKRF_SUCCESS
+
+    def hackrf_set_lna_gain(self, dev_p, gain):
+        self.lna_gain = gain
+        return HackRfError.HACKRF_SUCCESS
+
+    def hackrf_set_vga_gain(self, dev_p, gain):
+        self.vga_gain = gain
+        return HackRfError.HACKRF_SUCCESS
+
+    def hackrf_set_txvga_gain(self, dev_p, gain):
+        self.txvga_gain = gain
+        return HackRfError.HACKRF_SUCCESS
+
+    def hackrf_board_partid_serialno_read(self, dev_p, sn):
+        for i, v in enumerate(self.serial):
+            sn.serial_no[i] = v
+        return HackRfError.HACKRF_SUCCESS
+
+    def hackrf_is_streaming(self, dev_p):
+        if self.streaming:
+            return HackRfError.HACKRF_TRUE
+        return HackRfError.HACKRF_ERROR_STREAMING_STOPPED
+
+    def hackrf_start_rx(self, dev_p, callback, rx_ctx):
+        if self._thread is not None:
+            return HackRfError.HACKRF_ERROR_BUSY
+
+        self.reset()
+        return self._start(self._rx_loop, (dev_p.value, callback, rx_ctx))
+
+    def hackrf_start_tx(self, dev_p, callback, tx_ctx):
+        if self._thread is not None:
+            return HackRfError.HACKRF_ERROR_BUSY
+
+        return self._start(self._tx_loop, (dev_p.value, callback, tx_ctx))
+
+    def _start(self, loop, args):
+        self._stop.clear()
+        self.streaming = True
+        self._thread = threading.Thread(target=loop, args=args,
+                name='virtual-hackrf')
+        self._thread.daemon = True
+        self._thread.start()
+        return HackRfError.HACKRF_SUCCESS
+
+    def hackrf_stop_tx(self, dev_p):
+        return self.hackrf_stop_rx(dev_p)
+
+    def hackrf_stop_rx(self, dev_p):
+        self._stop.set()
+        if self._thread is not None \
+                and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+        self.streaming = False
+        return HackRfError.HACKRF_SUCCESS
+
+    def _rx_loop(self, dev, callback, rx_ctx):
+        transfer = hackrf_transfer(dev, None, self.transfer_size, 0,
+                rx_ctx, None)
+        p = pointer(transfer)
+
+        self.transfers = 0
+        self.overruns = 0
+        self.callback_times = times = []
+        period = self.transfer_size/2.0/self.sample_rate
+        t0 = time.time()
+        samples = 0
+        while not self._stop.is_set():
+            block = self.next_transfer()
+            if block is None:
+                break
+            addr, length = block
+
+            if self.realtime:
+                # a transfer is only delivered once its last sample is in
+                delay = t0 + (samples + length//2)/float(self.sample_rate) \
+                        - time.time()
+                if delay > 0:
+                    # wait on _stop so hackrf_stop_rx doesn't have to
+                    if self._stop.wait(delay):
+                        break
+                elif delay < -period:
+                    # a real device would have dropped data by now; count
+                    # it and start pacing again from here
+                    self.overruns += 1
+                    t0 -= delay
+
+            transfer.buffer = cast(addr, POINTER(c_byte))
+            transfer.valid_length = length
+            self.transfers += 1
+            samples += length//2
+
+            # like libhackrf, a non-zero return ends the stream
+            if self.time_callbacks:
+                start = time.perf_counter()
+                result = callback(p)
+                times.append(time.perf_counter() - start)
+            else:
+                result = callback(p)
+            if result != 0:
+                break
+
+        self.streaming = False
+
+    def _tx_loop(self, dev, callback, tx_ctx):
+        buf = np.zeros(self.transfer_size, dtype=np.int8)
+        transfer = hackrf_transfer(dev, buf.ctypes.data_as(POINTER(c_byte)),
+                self.transfer_size, self.transfer_size, None, tx_ctx)
+        p = pointer(transfer)
+
+        self.transfers = 0
+        self.tx_bytes = 0
+        t0 = time.time()
+        samples = 0
+        while not self._stop.is_set():
+            if self.realtime:
+                delay = t0 + samples/float(self.sample_rate) - time.time()
+                if delay > 0 and self._stop.wait(delay):
+                    break
+
+            transfer.valid_length = self.transfer_size
+            if callback(p) != 0:
+                break
+
+            n = transfer.valid_length
+            self.transfers += 1
+            self.tx_bytes += n
+            samples += n//2
+            if self.tx_sink is not None:
+                self.tx_sink(buf[:n])
+
+        self.streaming = False
+
+
+# Replays a raw int8 IQ file (.cs8, .sigmf-data, hackrf_transfer output)
+# by memory-mapping it and handing out transfers that point straight into
+# the mapping.  With loop=True the file repeats forever, otherwise the
+# stream ends at the end of the file.
+class FileBackend(VirtualBackend):
+
+    def __init__(self, path, loop=False, sample_rate=None, **kwargs):
+        VirtualBackend.__init__(self, **kwargs)
+        self.path = path
+        self.loop = loop
+        self.data = np.memmap(path, dtype=np.int8, mode='r')
+        self.addr = self.data.ctypes.data
+        self.offset = 0
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+
+    def reset(self):
+        self.offset = 0
+
+    def next_transfer(self):
+        size = len(self.data) - len(self.data) % 2
+        if self.offset >= size:
+            if not self.loop or size == 0:
+                return None
+            self.offset = 0
+
+        n = min(self.transfer_size, size - self.offset)
+        block = (self.addr + self.offset, n)
+        self.offset += n
+        return block
+
+
+# Generates complex tones plus gaussian noise.
+# tones is a list of (offset from center in Hz, amplitude) pairs, with
+# amplitudes relative to int8 full scale.  The signal is built once into
+# a table of table_transfers transfers, with the tone frequencies rounded
+# so the table repeats without a phase jump, and transfers point into it.
+class SyntheticBackend(VirtualBackend):
+
+    def __init__(self, tones=((1e6, 0.5),), noise=0.01, table_transfers=16,
+            seed=None, **kwargs):
+        VirtualBackend.__init__(self, **kwargs)
+        self.tones = list(tones)
+        self.noise = noise
+        self.table_transfers = int(table_transfers)
+        self.seed = seed
+        self.table = None
+        self._table_rate = None
+        self.index = 0
+
+    def make_table(self):
+        n = self.table_transfers*self.transfer_size//2
+        t = np.arange(n)
+        iq = np.zeros(n, dtype=np.complex128)
+        for freq, amplitude in self.tones:
+            cycles = round(freq*n/float(self.sample_rate))
+            iq += amplitude*np.exp(2j*np.pi*cycles*t/n)
+
+        if self.noise:
+            rng = np.random.RandomState(self.seed)
+            iq += self.noise*(rng.standard_normal(n)
+                    + 1j*rng.standard_normal(n))/np.sqrt(2)
+
+        table = np.empty(2*n, dtype=np.int8)
+        table[0::2] = np.clip(np.round(iq.real*127), -128, 127)
+        table[1::2] = np.clip(np.round(iq.imag*127), -128, 127)
+        return table
+
+    def reset(self):
+        if self.table is None or self._table_rate != self.sample_rate:
+            self.table = self.make_table()
+            self._table_rate = self.sample_rate
+        self.index = 0
+
+    def next_transfer(self):
+        addr = self.table.ctypes.data + self.index*self.transfer_size
+        self.index = (self.index + 1) % self.table_transfers
+        return (addr, self.transfer_size)
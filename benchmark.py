@@ -0,0 +1,832 @@
+# Benchmarks for the pyhackrf RX path.
+# These drive the library with synthetic transfers or a virtual device
+# (see backends.py), so no HackRF needs to be plugged in.
+#
+#   python benchmark.py                      # everything
+#   python benchmark.py rx conversion        # just some of them
+#   python benchmark.py --quick --json results.json
+#
+# With --json the results are written in a machine-readable form, so runs
+# from different versions can be compared.
+
+from ctypes import *
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import numpy as np
+
+from libhackrf import *
+import libhackrf
+import dsp
+import iqarchive
+import iqconvert
+import iqserver
+import shmring
+from backends import SyntheticBackend
+
+TRANSFER_SIZE = 262144      # bytes in one libhackrf USB transfer
+
+SAMPLE_RATES = (2e6, 8e6, 10e6, 20e6)
+CAPTURE_LENGTHS = (2**14, 2**17, 2**20, 2**22)
+
+
+# a HackRF object that was never opened, registered under a fake device
+# pointer so the module callbacks can find it
+def _unopened_hackrf(dev=0x1000):
+    hackrf = HackRF.__new__(HackRF)
+    hackrf.dev_p = p_hackrf_device(dev)
+    hackrf.capture_done = threading.Event()
+    libhackrf._hackrf_dict[dev] = hackrf
+    return hackrf
+
+# a single hackrf_transfer filled with random int8 data
+def _synthetic_transfer(dev=0x1000, size=TRANSFER_SIZE):
+    data = (c_byte*size).from_buffer_copy(
+            np.random.randint(-128, 128, size).astype(np.int8).tobytes())
+    transfer = hackrf_transfer(dev, cast(data, POINTER(c_byte)), size, size,
+            None, None)
+    # keep data alive as long as the transfer
+    transfer._data = data
+    return transfer
+
+# a HackRF on a synthetic virtual device
+def _virtual_hackrf(sample_rate, realtime=True):
+    backend = SyntheticBackend(realtime=realtime, time_callbacks=True)
+    hackrf = HackRF(backend=backend)
+    hackrf.sample_rate = sample_rate
+    # build the signal table now rather than inside the first timed run
+    backend.reset()
+    return hackrf, backend
+
+# p50/p99 of the backend's callback times, in microseconds
+def _latency(backend):
+    times = np.array(backend.callback_times)
+    if not len(times):
+        return {'callback_p50_us': None, 'callback_p99_us': None}
+    p50, p99 = np.percentile(times, [50, 99])*1e6
+    return {'callback_p50_us': p50, 'callback_p99_us': p99}
+
+
+# time read_samples_cb alone for captures of increasing size
+# the cost per transfer should stay flat as the capture grows
+def bench_read_samples_cb(sizes=(2**18, 2**20, 2**22, 2**23)):
+    hackrf = _unopened_hackrf()
+    transfer = _synthetic_transfer()
+    p = pointer(transfer)
+
+    results = []
+    for num_samples in sizes:
+        hackrf._prepare_capture(num_samples)
+
+        n = 0
+        t0 = time.perf_counter()
+        while not hackrf.capture_done.is_set():
+            read_samples_cb(p)
+            n += 1
+        dt = time.perf_counter() - t0
+
+        results.append({
+            'num_samples': num_samples,
+            'transfers': n,
+            'seconds': dt,
+            'us_per_transfer': 1e6*dt/n,
+            'msps': num_samples/dt/1e6,
+            })
+    return results
+
+
+# per-transfer cost of the ways a start_rx callback can get at the
+# samples: the ctypes cast + bytearray copy the README used to show, an
+# ArrayCallback view and an ArrayCallback pooled copy; also the most
+# Python memory allocated at once by a transfer (just small objects for the
+# ArrayCallback modes, whose buffers are all allocated up front)
+def bench_rx_callbacks(calls=2000):
+    transfer = _synthetic_transfer()
+    p = pointer(transfer)
+
+    def by_cast(hackrf_transfer):
+        c = hackrf_transfer.contents
+        values = cast(c.buffer, POINTER(c_byte*c.buffer_length)).contents
+        np.frombuffer(bytearray(values), dtype=np.int8)
+        return 0
+
+    def on_array(samples, seq, timestamp):
+        return 0
+
+    modes = [
+        ('cast_bytearray', by_cast),
+        ('view', libhackrf.ArrayCallback(on_array)),
+        ('copy', libhackrf.ArrayCallback(on_array, copy=True)),
+        ]
+    results = []
+    for name, cb in modes:
+        cb(p)
+        t0 = time.perf_counter()
+        for i in range(calls):
+            cb(p)
+        dt = time.perf_counter() - t0
+
+        tracemalloc.start()
+        cb(p)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results.append({
+            'mode': name,
+            'us_per_transfer': 1e6*dt/calls,
+            'peak_alloc_bytes': peak,
+            })
+    return results
+
+
+# BurstTrigger cost per transfer at 20 MS/s, on noise that never
+# triggers and on a signal that is always above the threshold
+def bench_bursts(calls=500, sample_rate=20e6):
+    noise = np.random.randint(-2, 3, TRANSFER_SIZE).astype(np.int8)
+    loud = np.random.randint(-100, 101, TRANSFER_SIZE).astype(np.int8)
+    period = TRANSFER_SIZE/2/sample_rate
+    results = []
+    for name, data in (('idle', noise), ('triggered', loud)):
+        trigger = libhackrf.BurstTrigger(sample_rate, max_samples=2**18)
+        t0 = time.perf_counter()
+        for i in range(calls):
+            trigger(data, i, time.time())
+            # consume straight away, like a consumer that keeps up
+            while not trigger.ready.empty():
+                trigger.release(trigger.get())
+        per_call = (time.perf_counter() - t0)/calls
+        results.append({
+            'signal': name,
+            'us_per_transfer': 1e6*per_call,
+            'percent_of_transfer_period': 100*per_call/period,
+            'bursts': trigger.bursts,
+            })
+    return results
+
+
+# cost of the per-transfer counters (StreamStats.record) against the
+# transfer period at 20 MS/s
+def bench_stats_overhead(calls=100000):
+    stats = libhackrf.StreamStats()
+    c = _synthetic_transfer()
+    clock = libhackrf._clock
+    t0 = time.perf_counter()
+    for i in range(calls):
+        t = clock()
+        stats.record(c, t, clock())
+    per_call = (time.perf_counter() - t0)/calls
+    period = TRANSFER_SIZE/2/20e6
+    return [{
+        'us_per_transfer': 1e6*per_call,
+        'percent_of_transfer_period': 100*per_call/period,
+        }]
+
+
+# end-to-end read_samples on a virtual device paced at each sample rate:
+# achieved MS/s, callback latency, peak Python memory and overruns
+def bench_rx(sample_rates=SAMPLE_RATES, lengths=CAPTURE_LENGTHS):
+    results = []
+    for rate in sample_rates:
+        hackrf, backend = _virtual_hackrf(rate)
+        transfer_period = TRANSFER_SIZE/2.0/rate
+        for num_samples in lengths:
+            tracemalloc.start()
+            t0 = time.perf_counter()
+            hackrf.read_samples(num_samples)
+            dt = time.perf_counter() - t0
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            r = {
+                'sample_rate': rate,
+                'num_samples': num_samples,
+                'seconds': dt,
+                'transfer_seconds': backend.transfers*transfer_period,
+                'msps': num_samples/dt/1e6,
+                'peak_mem_bytes': peak,
+                'transfers': backend.transfers,
+                'dropped_transfers': backend.overruns,
+                }
+            r.update(_latency(backend))
+            results.append(r)
+        hackrf.close()
+    return results
+
+
+# the fastest read_samples can go with an unpaced virtual device
+def bench_rx_unpaced(lengths=CAPTURE_LENGTHS):
+    hackrf, backend = _virtual_hackrf(20e6, realtime=False)
+    results = []
+    for num_samples in lengths:
+        t0 = time.perf_counter()
+        hackrf.read_samples(num_samples)
+        dt = time.perf_counter() - t0
+        r = {
+            'num_samples': num_samples,
+            'seconds': dt,
+            'msps': num_samples/dt/1e6,
+            'transfers': backend.transfers,
+            }
+        r.update(_latency(backend))
+        results.append(r)
+    hackrf.close()
+    return results
+
+
+# HackRF.stream at each sample rate with a consumer converting every
+# block to complex64: blocks dropped and the rate the consumer sustained
+def bench_stream(sample_rates=SAMPLE_RATES, seconds=1.0,
+        block_size=131072):
+    out = np.empty(block_size, np.complex64)
+    results = []
+    for rate in sample_rates:
+        hackrf, backend = _virtual_hackrf(rate)
+        num_blocks = max(1, int(seconds*rate/block_size))
+
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        for block in hackrf.stream(block_size, num_blocks=num_blocks):
+            iqconvert.int8_to_complex64(block, out=out)
+        dt = time.perf_counter() - t0
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        r = {
+            'sample_rate': rate,
+            'blocks': num_blocks,
+            'seconds': dt,
+            'msps': num_blocks*block_size/dt/1e6,
+            'peak_mem_bytes': peak,
+            'dropped_blocks': hackrf.block_queue.dropped,
+            'dropped_transfers': backend.overruns,
+            }
+        r.update(_latency(backend))
+        results.append(r)
+        hackrf.close()
+    return results
+
+
+async def _astream(hackrf, block_size, num_blocks, out):
+    stalls = []
+
+    async def ticker():
+        while True:
+            t = time.perf_counter()
+            await asyncio.sleep(0.001)
+            stalls.append(time.perf_counter() - t - 0.001)
+
+    task = asyncio.ensure_future(ticker())
+    t0 = time.perf_counter()
+    async for block in hackrf.astream(block_size, num_blocks=num_blocks):
+        iqconvert.int8_to_complex64(block, out=out)
+    dt = time.perf_counter() - t0
+    await hackrf.aconfigure(freq=433.92e6)
+    task.cancel()
+    return dt, stalls
+
+# HackRF.astream at each sample rate, consuming like bench_stream, with
+# another task on the loop waking up every millisecond: how late it woke
+# up (p99/max) shows whether RX ever holds up the loop
+def bench_astream(sample_rates=(10e6, 20e6), seconds=1.0, block_size=131072):
+    out = np.empty(block_size, np.complex64)
+    results = []
+    for rate in sample_rates:
+        hackrf, backend = _virtual_hackrf(rate)
+        num_blocks = max(1, int(seconds*rate/block_size))
+        dt, stalls = asyncio.run(_astream(hackrf, block_size, num_blocks,
+                out))
+        results.append({
+            'sample_rate': rate,
+            'msps': num_blocks*block_size/dt/1e6,
+            'dropped_blocks': hackrf.block_queue.dropped,
+            'dropped_transfers': backend.overruns,
+            'loop_late_p99_ms': 1e3*float(np.percentile(stalls, 99)),
+            'loop_late_max_ms': 1e3*max(stalls),
+            })
+        hackrf.close()
+    return results
+
+
+# HackRF.sweep over span_hz on a paced virtual device
+# the virtual device retunes instantly, so this is the host side of the
+# scan time: settling discards, USB-rate sample delivery and the FFTs
+def bench_sweep(span_hz=1e9, bin_widths=(1e6, 100e3), dwell=0.001):
+    results = []
+    for bin_width in bin_widths:
+        hackrf, backend = _virtual_hackrf(20e6)
+        r = next(hackrf.sweep(1e9, 1e9 + span_hz, bin_width, dwell))
+        results.append({
+            'span_hz': span_hz,
+            'bin_width': bin_width,
+            'dwell': dwell,
+            'steps': r['steps'],
+            'bins': len(r['power']),
+            'seconds': r['seconds'],
+            'seconds_per_ghz': r['seconds_per_ghz'],
+            'dropped_transfers': backend.overruns,
+            })
+        hackrf.close()
+    return results
+
+
+# WelchPSD fed raw int8 transfers: how much faster than 20 MS/s it runs
+def bench_psd(n_ffts=(256, 1024, 8192), seconds=1.0, sample_rate=20e6):
+    data = np.random.randint(-128, 128,
+            2*int(seconds*sample_rate)).astype(np.int8)
+    results = []
+    for n_fft in n_ffts:
+        for average in ('linear', 'exponential', 'max'):
+            psd = dsp.WelchPSD(n_fft, sample_rate, average=average)
+            for i in range(0, len(data), TRANSFER_SIZE):
+                psd.process(data[i:i+TRANSFER_SIZE])
+            results.append({
+                'n_fft': n_fft,
+                'average': average,
+                'msps': psd.samples_processed/psd.busy_seconds/1e6,
+                'realtime_factor': psd.realtime_factor,
+                'keeping_up': psd.keeping_up,
+                'rows': psd.rows_emitted,
+                })
+    return results
+
+
+# Channelizer throughput in input MS/s, for a few channel counts and
+# decimations; msps_per_core divides by the CPU time used (all threads)
+# rather than the wall time
+def bench_channelizer(channels=(1, 4), decimations=(10, 40), seconds=1.0,
+        sample_rate=20e6):
+    data = np.random.randint(-128, 128,
+            2*int(seconds*sample_rate)).astype(np.int8)
+    results = []
+    for n in channels:
+        for decimation in decimations:
+            offsets = np.linspace(-5e6, 5e6, n)
+            ch = dsp.Channelizer(sample_rate, offsets, decimation)
+            ch.process(data[:TRANSFER_SIZE])
+            ch.samples_processed = 0
+            ch.busy_seconds = 0.0
+            cpu0 = time.process_time()
+            for i in range(0, len(data), TRANSFER_SIZE):
+                ch.process(data[i:i+TRANSFER_SIZE])
+            cpu = time.process_time() - cpu0
+            results.append({
+                'channels': n,
+                'decimation': decimation,
+                'taps': len(ch.taps),
+                'msps': ch.samples_processed/ch.busy_seconds/1e6,
+                'msps_per_core': ch.samples_processed/cpu/1e6,
+                'realtime_factor': ch.realtime_factor,
+                })
+    return results
+
+
+def _fm_iq(sample_rate, seconds, offset, deviation, tone=1e3):
+    t = np.arange(int(seconds*sample_rate))/sample_rate
+    phase = 2*np.pi*offset*t + deviation/tone*np.sin(2*np.pi*tone*t)
+    data = np.empty(2*len(t), np.int8)
+    data[0::2] = np.round(60*np.cos(phase))
+    data[1::2] = np.round(60*np.sin(phase))
+    return data
+
+# FMDemodulator on an FM signal offset Hz off center carrying a 1 kHz
+# tone (or on a recorded int8 IQ file, path, with sample_rates holding its
+# sample rate and offset where the station is), fed a transfer at a time:
+# realtime factor against the wall time, and per core against the CPU
+# time used (all threads); tone_db is the demodulated tone's power
+# relative to everything else in the audio, a check that the output is
+# right
+def bench_fm(modes=('wbfm', 'nbfm'), sample_rates=(2e6, 10e6, 20e6),
+        seconds=1.0, path=None, offset=1e6):
+    results = []
+    for mode in modes:
+        for sample_rate in sample_rates:
+            if path is None:
+                deviation = dsp.FMDemodulator._modes[mode][1]
+                data = _fm_iq(sample_rate, seconds, offset, deviation)
+            else:
+                data = np.fromfile(path, dtype=np.int8)
+            fm = dsp.FMDemodulator(sample_rate, offset=offset, mode=mode,
+                    tau=None)
+            cpu0 = time.process_time()
+            audio = np.concatenate([fm.process(data[i:i+TRANSFER_SIZE])
+                    for i in range(0, len(data), TRANSFER_SIZE)])
+            cpu = time.process_time() - cpu0
+
+            r = {
+                'mode': mode,
+                'sample_rate': sample_rate,
+                'audio_rate': fm.audio_rate,
+                'realtime_factor': fm.realtime_factor,
+                'realtime_factor_per_core':
+                    fm.samples_processed/sample_rate/cpu,
+                }
+            if path is None:
+                settled = audio[len(audio)//4:]
+                t = np.arange(len(settled))/fm.audio_rate
+                ref = np.exp(-2j*np.pi*1e3*t)
+                tone = np.real(2*np.mean(settled*ref)*np.conj(ref))
+                r['tone_db'] = 10*np.log10(np.var(tone)/
+                        np.var(settled - tone))
+            results.append(r)
+    return results
+
+
+# a frequency-hopping loop over a few channels that sets the sample rate,
+# frequency and gains every hop, done with the individual setters and with
+# configure(); control_transfers counts the settings that reached the
+# device (each is a USB control transfer on real hardware)
+def bench_configure(hops=2000, channels=(433.05e6, 433.3e6, 433.55e6, 433.8e6)):
+    hackrf, backend = _virtual_hackrf(20e6)
+    sent = [0]
+    for name in ('hackrf_set_freq', 'hackrf_set_sample_rate',
+            'hackrf_set_amp_enable', 'hackrf_set_lna_gain',
+            'hackrf_set_vga_gain'):
+        def counted(*args, **kwargs):
+            sent[0] += 1
+            return counted.fn(*args, **kwargs)
+        counted.fn = getattr(backend, name)
+        setattr(backend, name, counted)
+
+    def setters(freq):
+        hackrf.set_sample_rate(20e6)
+        hackrf.set_freq(freq)
+        hackrf.set_lna_gain(16)
+        hackrf.set_vga_gain(20)
+
+    def configure(freq):
+        hackrf.configure(freq=freq, sample_rate=20e6, lna=16, vga=20)
+
+    results = []
+    for name, hop in (('setters', setters), ('configure', configure)):
+        sent[0] = 0
+        t0 = time.perf_counter()
+        for i in range(hops):
+            hop(channels[i % len(channels)])
+        dt = time.perf_counter() - t0
+        results.append({
+            'method': name,
+            'hops': hops,
+            'control_transfers': sent[0],
+            'us_per_hop': 1e6*dt/hops,
+            })
+    hackrf.close()
+    return results
+
+
+# opening and closing a virtual device by index over and over (like
+# reopening after a fault): the registry should enumerate once and free
+# every native list it reads
+def bench_open(cycles=200):
+    backend = SyntheticBackend()
+    registry = DeviceRegistry(backend)
+    opens = []
+    closes = []
+    for i in range(cycles):
+        hackrf = HackRF(backend=backend, registry=registry)
+        hackrf.close()
+        opens.append(hackrf.open_seconds)
+        closes.append(hackrf.close_seconds)
+    return [{
+        'cycles': cycles,
+        'open_us': 1e6*np.median(opens),
+        'close_us': 1e6*np.median(closes),
+        'enumerations': registry.enumerations,
+        'lists_not_freed': backend.lists - backend.lists_freed,
+        }]
+
+
+def _ring_consumer(name, results):
+    consumer = shmring.RingConsumer(name, start='oldest')
+    out = np.empty(TRANSFER_SIZE//2, np.complex64)
+    for seq, samples, timestamp in consumer:
+        iqconvert.int8_to_complex64(samples, out=out)
+    results.put({'received': consumer.received, 'missed': consumer.missed})
+    consumer.close()
+
+# publishing to a shared-memory ring: the cost per transfer in the RX
+# callback, then 1..N consumer processes (each converting every transfer
+# to complex64) reading a paced virtual device through it
+def bench_shmring(consumers=(1, 2, 4), seconds=1.0, sample_rate=20e6,
+        calls=500):
+    data = np.random.randint(-128, 128, TRANSFER_SIZE).astype(np.int8)
+    publisher = shmring.RingPublisher(num_slots=64)
+    t0 = time.perf_counter()
+    for i in range(calls):
+        publisher(data, i, 0.0)
+    per_call = (time.perf_counter() - t0)/calls
+    publisher.close()
+    results = [{
+        'consumers': 0,
+        'us_per_transfer': 1e6*per_call,
+        'percent_of_transfer_period':
+            100*per_call/(TRANSFER_SIZE/2/sample_rate),
+        }]
+
+    for n in consumers:
+        hackrf, backend = _virtual_hackrf(sample_rate)
+        publisher = shmring.RingPublisher(num_slots=64,
+                sample_rate=sample_rate)
+        stats_queue = multiprocessing.Queue()
+        procs = [multiprocessing.Process(target=_ring_consumer,
+                args=(publisher.name, stats_queue)) for i in range(n)]
+        for p in procs:
+            p.start()
+        hackrf.start_rx(publisher, arrays=True)
+        time.sleep(seconds)
+        hackrf.stop_rx()
+        published = publisher.published
+        publisher.close()
+        stats = [stats_queue.get() for p in procs]
+        for p in procs:
+            p.join()
+        hackrf.close()
+        results.append({
+            'consumers': n,
+            'published': published,
+            'min_received': min(s['received'] for s in stats),
+            'max_missed': max(s['missed'] for s in stats),
+            'dropped_transfers': backend.overruns,
+            })
+    return results
+
+
+def _iq_reader(client, seconds, results):
+    buf = np.empty(1 << 20, np.int8)
+    received = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        client.read(len(buf), buf)
+        received += len(buf)
+    results.append(received)
+
+# serving a paced virtual device over loopback TCP to 1..N clients that
+# read as fast as they can, plus one that never reads: the readers should
+# get the full sample rate while the stalled one only drops batches
+def bench_iqserver(clients=(1, 2, 4), seconds=1.0, sample_rate=20e6):
+    results = []
+    for n in clients:
+        hackrf, backend = _virtual_hackrf(sample_rate)
+        server = hackrf.serve(port=0)
+        port = server.address[1]
+        readers = [iqserver.IQClient(port=port) for i in range(n)]
+        stalled = iqserver.IQClient(port=port, rcvbuf=65536)
+        received = []
+        threads = [threading.Thread(target=_iq_reader,
+                args=(c, seconds, received)) for c in readers]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        stalled_address = '%s:%d' % stalled.sock.getsockname()[:2]
+        stats = server.stats()
+        server.stop()
+        for c in readers + [stalled]:
+            c.close()
+        hackrf.close()
+        results.append({
+            'clients': n,
+            'min_msps': min(received)/2.0/seconds/1e6,
+            'max_dropped_batches': max(s['dropped_batches'] for s in stats
+                if s['address'] != stalled_address),
+            'stalled_dropped_batches': sum(s['dropped_batches']
+                for s in stats if s['address'] == stalled_address),
+            'dropped_transfers': backend.overruns,
+            })
+    return results
+
+
+# writing an archive of noise-like IQ with each codec (input MS/s and
+# compressed size), then reading back a range from the middle of it with
+# and without threads: how long it takes and how many of the chunks were
+# decompressed
+def bench_archive(codecs=('zlib', 'lzma'), num_samples=2**24,
+        read_samples=2**23, threads=4):
+    data = np.random.normal(0, 20, 2*num_samples).clip(-128, 127) \
+            .astype(np.int8)
+    results = []
+    for codec in codecs:
+        fd, path = tempfile.mkstemp(suffix='.hrfa')
+        os.close(fd)
+        try:
+            t0 = time.perf_counter()
+            w = iqarchive.ArchiveWriter(path, 20e6, 100e6, codec=codec,
+                    threads=threads)
+            for i in range(0, len(data), TRANSFER_SIZE):
+                w.write(data[i:i+TRANSFER_SIZE])
+            w.close()
+            write_seconds = time.perf_counter() - t0
+
+            r = {
+                'codec': codec,
+                'write_msps': num_samples/write_seconds/1e6,
+                'ratio': os.path.getsize(path)/float(len(data)),
+                }
+            for n in (0, threads):
+                reader = iqarchive.ArchiveReader(path, threads=n)
+                t0 = time.perf_counter()
+                reader.read(num_samples//2, read_samples)
+                r['read_ms_threads_%d' % n] = \
+                        1e3*(time.perf_counter() - t0)
+                r['chunks_read'] = reader.chunks_decompressed
+                r['chunks'] = len(reader.chunks)
+                reader.close()
+            results.append(r)
+        finally:
+            os.remove(path)
+    return results
+
+
+# MultiHackRF.read_samples on 1..N paced virtual devices: wall time for
+# N devices should stay close to the time for one
+def bench_multi(counts=(1, 2, 4), num_samples=2**21, sample_rate=20e6):
+    results = []
+    for n in counts:
+        hackrfs = [_virtual_hackrf(sample_rate)[0] for i in range(n)]
+        multi = MultiHackRF(hackrfs)
+        t0 = time.perf_counter()
+        r = multi.read_samples(num_samples, dtype=None)
+        dt = time.perf_counter() - t0
+        results.append({
+            'devices': n,
+            'num_samples': num_samples,
+            'seconds': dt,
+            'capture_seconds': num_samples/sample_rate,
+            'max_start_offset': max(x['start_offset'] for x in r),
+            })
+        for hackrf in hackrfs:
+            hackrf.close()
+    return results
+
+
+# median wall time of running code in a fresh interpreter, in ms
+def _python_ms(code, repeat):
+    here = os.path.dirname(os.path.abspath(__file__))
+    times = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        subprocess.check_call([sys.executable, '-c', code], cwd=here)
+        times.append(1e3*(time.perf_counter() - t0))
+    return float(np.median(times))
+
+# cost of importing libhackrf in a fresh process, against importing numpy
+# alone (which it can't avoid), and the one-off cost of loading the
+# native library on first use (None if it isn't installed)
+def bench_import(repeat=5):
+    baseline = _python_ms('import numpy', repeat)
+    imported = _python_ms('import libhackrf', repeat)
+
+    t0 = time.perf_counter()
+    try:
+        libhackrf.hackrf_init()
+        load_ms = 1e3*(time.perf_counter() - t0)
+    except IOError:
+        load_ms = None
+
+    return [{
+        'import_numpy_ms': baseline,
+        'import_libhackrf_ms': imported,
+        'libhackrf_overhead_ms': imported - baseline,
+        'first_use_load_ms': load_ms,
+        }]
+
+
+# the conversion bytes2iq used to do, kept for comparison
+def _bytes2iq_old(data):
+    values = np.array(data).astype(np.int8)
+    iq = values.astype(np.float64).view(np.complex128)
+    iq /= 127.5
+    iq -= (1 + 1j)
+    return iq
+
+# MS/s of fn(data) averaged over repeat calls
+def _msps(fn, data, repeat):
+    fn(data)
+    t0 = time.perf_counter()
+    for i in range(repeat):
+        fn(data)
+    return len(data)//2*repeat/(time.perf_counter() - t0)/1e6
+
+# throughput of the int8 -> sample conversion kernels
+def bench_conversion(num_samples=2**22, repeat=10, threads=4):
+    data = np.random.randint(-128, 128, 2*num_samples).astype(np.int8)
+    out = {
+        'complex64': np.empty(num_samples, np.complex64),
+        'complex128': np.empty(num_samples, np.complex128),
+        'int16': np.empty((num_samples, 2), np.int16),
+        }
+
+    results = [{'name': 'bytes2iq (old)',
+        'msps': _msps(_bytes2iq_old, data, repeat)}]
+    for dtype in ('complex64', 'complex128', 'int16'):
+        for t in (None, threads):
+            name = '%s, %d thread(s)' % (dtype, t or 1)
+            fn = lambda d: iqconvert.convert(d, dtype, out=out[dtype],
+                    threads=t)
+            results.append({'name': name, 'msps': _msps(fn, data, repeat)})
+    return results
+
+
+# name -> (full run, quick run)
+BENCHMARKS = {
+    'read_samples_cb': (bench_read_samples_cb,
+        lambda: bench_read_samples_cb(sizes=(2**18, 2**20))),
+    'rx_callbacks': (bench_rx_callbacks,
+        lambda: bench_rx_callbacks(calls=200)),
+    'bursts': (bench_bursts,
+        lambda: bench_bursts(calls=50)),
+    'stats_overhead': (bench_stats_overhead,
+        lambda: bench_stats_overhead(calls=20000)),
+    'rx': (bench_rx,
+        lambda: bench_rx(sample_rates=(2e6, 20e6), lengths=(2**17, 2**20))),
+    'rx_unpaced': (bench_rx_unpaced,
+        lambda: bench_rx_unpaced(lengths=(2**17, 2**20))),
+    'stream': (bench_stream,
+        lambda: bench_stream(sample_rates=(2e6, 20e6), seconds=0.25)),
+    'astream': (bench_astream,
+        lambda: bench_astream(seconds=0.25)),
+    'sweep': (bench_sweep,
+        lambda: bench_sweep(span_hz=200e6)),
+    'psd': (bench_psd,
+        lambda: bench_psd(n_ffts=(1024,), seconds=0.25)),
+    'channelizer': (bench_channelizer,
+        lambda: bench_channelizer(seconds=0.25)),
+    'fm': (bench_fm,
+        lambda: bench_fm(sample_rates=(2e6, 20e6), seconds=0.25)),
+    'configure': (bench_configure,
+        lambda: bench_configure(hops=200)),
+    'open': (bench_open,
+        lambda: bench_open(cycles=20)),
+    'shmring': (bench_shmring,
+        lambda: bench_shmring(consumers=(1, 2), seconds=0.25, calls=50)),
+    'iqserver': (bench_iqserver,
+        lambda: bench_iqserver(clients=(1, 2), seconds=0.25)),
+    'archive': (bench_archive,
+        lambda: bench_archive(codecs=('zlib',), num_samples=2**22,
+            read_samples=2**21)),
+    'multi': (bench_multi,
+        lambda: bench_multi(counts=(1, 2), num_samples=2**20)),
+    'import': (bench_import,
+        lambda: bench_import(repeat=3)),
+    'conversion': (bench_conversion,
+        lambda: bench_conversion(num_samples=2**20, repeat=3)),
+    }
+
+
+def _format(value):
+    if isinstance(value, float):
+        return '%.4g' % value
+    return str(value)
+
+def _print_results(name, results):
+    print(name)
+    for r in results:
+        print('  ' + ', '.join('%s=%s' % (k, _format(v))
+            for k, v in sorted(r.items())))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            description='Benchmarks for the pyhackrf RX path.')
+    parser.add_argument('names', nargs='*', metavar='benchmark',
+            help='benchmarks to run (default all): %s'
+            % ', '.join(sorted(BENCHMARKS)))
+    parser.add_argument('--quick', action='store_true',
+            help='fewer, smaller runs')
+    parser.add_argument('--json', metavar='PATH',
+            help='write the results to PATH as JSON')
+    args = parser.parse_args(argv)
+
+    names = args.names or sorted(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark %r' % name)
+
+    results = {}
+    for name in names:
+        full, quick = BENCHMARKS[name]
+        results[name] = quick() if args.quick else full()
+        _print_results(name, results[name])
+
+    if args.json:
+        report = {
+            'timestamp': time.time(),
+            'python': sys.version.split()[0],
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'quick': args.quick,
+            'results': results,
+            }
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
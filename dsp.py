@@ -0,0 +1,663 @@
+# Signal processing helpers for HackRF samples.
+#
+# Everything here works on complex64 blocks and keeps its tables
+# (windows, ...) cached, so calling it once per block doesn't rebuild them.
+
+import fractions
+import time
+import numpy as np
+
+import iqconvert
+
+_windows = {}
+_fft_has_out = None
+
+
+# whether np.fft.fft takes out= (numpy >= 2.0); checked on first use
+# rather than at import, since importing np.fft isn't free
+def _fft_supports_out():
+    global _fft_has_out
+    if _fft_has_out is None:
+        try:
+            np.fft.fft(np.zeros(1, np.complex64),
+                    out=np.empty(1, np.complex64))
+            _fft_has_out = True
+        except TypeError:
+            _fft_has_out = False
+    return _fft_has_out
+
+_window_functions = {
+    'hann': np.hanning,
+    'hamming': np.hamming,
+    'blackman': np.blackman,
+    'rect': np.ones,
+    }
+
+
+# float32 window of length n, built once per (name, n)
+def get_window(name, n):
+    key = (name, n)
+    w = _windows.get(key)
+    if w is None:
+        try:
+            fn = _window_functions[name]
+        except KeyError:
+            raise ValueError("unknown window %r" % name)
+        w = fn(n).astype(np.float32)
+        w.flags.writeable = False
+        _windows[key] = w
+    return w
+
+
+# mean |FFT|^2 of the consecutive n_fft-sample segments of iq, with the
+# window applied and DC in the middle (fftshifted)
+# all segments are transformed in one batched FFT
+# normalized so a full-scale tone centered on a bin reads 1 (0 dBFS)
+def batch_power(iq, n_fft, window_name='hann', out=None):
+    n_seg = len(iq) // n_fft
+    if n_seg == 0:
+        raise ValueError("need at least %d samples, got %d" % (n_fft, len(iq)))
+
+    w = get_window(window_name, n_fft)
+    segs = iq[:n_seg*n_fft].reshape(n_seg, n_fft)
+    spectra = np.fft.fft(segs*w, axis=1)
+    power = spectra.real**2 + spectra.imag**2
+    p = power.mean(axis=0)
+    p /= float(w.sum())**2
+
+    if out is None:
+        return np.fft.fftshift(p)
+    out[:] = np.fft.fftshift(p)
+    return out
+
+
+# 10*log10(p), with zeros mapped to a floor instead of -inf
+def to_db(p, floor=1e-20):
+    return 10*np.log10(np.maximum(p, floor))
+
+
+# Streaming Welch power spectral density with a waterfall.
+#
+# Feed it consecutive sample blocks (raw int8 from HackRF.stream, or
+# complex) with process().  Blocks are cut into overlapping windowed
+# segments, carrying the tail of each block over to the next, and the
+# segments are FFT'd in batches of up to batch at a time using scratch
+# buffers allocated once.
+#
+# average is how segment powers are combined:
+#   'linear'       mean over each waterfall row (reset every row)
+#   'exponential'  running average, each segment weighted by alpha
+#   'max'          max-hold until reset()
+# A waterfall row (the current PSD in dB) is emitted every
+# 1/row_rate seconds of samples; process() returns the rows it emitted.
+#
+# scaling='spectrum' reads a full-scale tone as 0 dB, 'density' gives
+# power per Hz.
+# keeping_up tells whether processing runs faster than the samples arrive.
+class WelchPSD(object):
+
+    def __init__(self, n_fft=1024, sample_rate=20e6, overlap=0.5,
+            window='hann', average='linear', alpha=0.1, row_rate=10.0,
+            batch=64, scaling='spectrum'):
+        if average not in ('linear', 'exponential', 'max'):
+            raise ValueError("unknown average %r" % average)
+        if scaling not in ('spectrum', 'density'):
+            raise ValueError("unknown scaling %r" % scaling)
+
+        self.n_fft = int(n_fft)
+        self.sample_rate = float(sample_rate)
+        self.hop = max(1, self.n_fft - int(round(overlap*self.n_fft)))
+        self.average = average
+        self.alpha = float(alpha)
+        self.batch = int(batch)
+
+        self.window = w = get_window(window, self.n_fft)
+        if scaling == 'spectrum':
+            self.scale = 1.0/float(w.sum())**2
+        else:
+            self.scale = 1.0/(self.sample_rate*float((w**2).sum()))
+
+        self.segments_per_row = max(1, int(round(
+            self.sample_rate/row_rate/self.hop)))
+
+        # scratch buffers
+        self._buf = np.empty(0, dtype=np.complex64)
+        self._have = 0
+        self._seg = np.empty((self.batch, self.n_fft), dtype=np.complex64)
+        self._pow = np.empty((self.batch, self.n_fft), dtype=np.float32)
+        # weights of the last k segments of a batch are _decay[-k:], from
+        # alpha*(1 - alpha)**(k - 1) for the oldest to alpha for the newest
+        self._decay = (1 - self.alpha)**np.arange(self.batch - 1, -1, -1) \
+                *self.alpha
+
+        self.acc = np.zeros(self.n_fft)
+        self.reset()
+
+        # throughput accounting
+        self.samples_processed = 0
+        self.busy_seconds = 0.0
+        self.rows_emitted = 0
+
+    # start averaging again from scratch
+    def reset(self):
+        self.acc[:] = 0
+        self.count = 0
+        self._row_segments = 0
+
+    # frequencies of the PSD bins relative to the center, DC in the middle
+    @property
+    def freqs(self):
+        return np.fft.fftshift(np.fft.fftfreq(self.n_fft, 1/self.sample_rate))
+
+    # the current PSD, linear power, DC in the middle
+    def psd_linear(self):
+        if self.count == 0:
+            return np.zeros(self.n_fft)
+        p = self.acc*self.scale
+        if self.average == 'linear':
+            p /= self.count
+        return np.fft.fftshift(p)
+
+    # the current PSD in dB, DC in the middle
+    def psd(self):
+        return to_db(self.psd_linear())
+
+    # how many times faster than real time the samples are processed
+    @property
+    def realtime_factor(self):
+        if self.busy_seconds == 0:
+            return float('inf')
+        return self.samples_processed/self.sample_rate/self.busy_seconds
+
+    @property
+    def keeping_up(self):
+        return self.realtime_factor >= 1
+
+    # append block to the sample buffer after the carried-over tail
+    def _append(self, block):
+        if block.dtype == np.int8:
+            n = len(block)//2
+        else:
+            n = len(block)
+        need = self._have + n
+        if len(self._buf) < need:
+            buf = np.empty(need, dtype=np.complex64)
+            buf[:self._have] = self._buf[:self._have]
+            self._buf = buf
+
+        dst = self._buf[self._have:need]
+        if block.dtype == np.int8:
+            iqconvert.int8_to_complex64(block, out=dst)
+        else:
+            dst[:] = block
+        self._have = need
+        return n
+
+    def _accumulate(self, k):
+        p = self._pow[:k]
+        if self.average == 'linear':
+            self.acc += p.sum(axis=0)
+        elif self.average == 'exponential':
+            if self.count == 0:
+                # start from the first segment rather than from zero
+                self.acc[:] = p[0]
+                p = p[1:]
+                k -= 1
+            if k:
+                self.acc *= (1 - self.alpha)**k
+                self.acc += np.dot(self._decay[-k:], p)
+        else:
+            np.maximum(self.acc, p.max(axis=0), out=self.acc)
+
+    # process a block of samples; returns the list of waterfall rows
+    # (PSDs in dB) that were completed by it
+    def process(self, block):
+        t0 = time.time()
+        block = np.asarray(block)
+        self.samples_processed += self._append(block)
+
+        buf = self._buf
+        total = self._have
+        rows = []
+        pos = 0
+        while total - pos >= self.n_fft:
+            available = (total - pos - self.n_fft)//self.hop + 1
+            k = min(available, self.batch,
+                    self.segments_per_row - self._row_segments)
+
+            segs = np.lib.stride_tricks.as_strided(buf[pos:],
+                    shape=(k, self.n_fft),
+                    strides=(self.hop*buf.itemsize, buf.itemsize))
+            seg = self._seg[:k]
+            np.multiply(segs, self.window, out=seg)
+            if _fft_supports_out():
+                spectra = np.fft.fft(seg, axis=1, out=seg)
+            else:
+                spectra = np.fft.fft(seg, axis=1)
+            pw = self._pow[:k]
+            np.abs(spectra, out=pw)
+            np.square(pw, out=pw)
+
+            self._accumulate(k)
+            self.count += k
+            self._row_segments += k
+            pos += k*self.hop
+
+            if self._row_segments == self.segments_per_row:
+                rows.append(self.psd())
+                self.rows_emitted += 1
+                self._row_segments = 0
+                if self.average == 'linear':
+                    self.acc[:] = 0
+                    self.count = 0
+
+        # carry the samples not yet fully used over to the next block
+        left = total - pos
+        buf[:left] = buf[pos:total]
+        self._have = left
+
+        self.busy_seconds += time.time() - t0
+        return rows
+
+
+# windowed-sinc lowpass FIR with num_taps taps and its cutoff at cutoff
+# (a fraction of the sample rate, 0 to 0.5), scaled for unity gain at DC
+def lowpass(num_taps, cutoff, window='hamming'):
+    n = np.arange(num_taps) - (num_taps - 1)/2.0
+    taps = 2*cutoff*np.sinc(2*cutoff*n)*get_window(window, num_taps)
+    taps /= taps.sum()
+    return taps.astype(np.float32)
+
+
+# Numerically controlled oscillator: shifts a stream of complex64 blocks
+# by freq Hz.  The phase carries over from one block to the next, so the
+# shifted stream is continuous however it is cut into blocks.
+# The per-sample rotation is a table computed once (in float64, then kept
+# as complex64) for the longest block seen; every block is then one
+# multiply by the table and one by the rotation for its starting phase.
+class NCO(object):
+
+    def __init__(self, freq, sample_rate):
+        self.sample_rate = float(sample_rate)
+        self.phase = 0.0
+        self._ramp = np.empty(0, dtype=np.complex64)
+        self.freq = freq
+
+    @property
+    def freq(self):
+        return self._freq
+
+    # retuning keeps the current phase, so there's no jump in the output
+    @freq.setter
+    def freq(self, freq):
+        self._freq = float(freq)
+        self._step = 2*np.pi*self._freq/self.sample_rate
+        self._ramp = np.empty(0, dtype=np.complex64)
+
+    def _table(self, n):
+        if len(self._ramp) < n:
+            self._ramp = np.exp(1j*self._step*np.arange(n)).astype(np.complex64)
+        return self._ramp[:n]
+
+    # x shifted by freq, written to out (which may be x)
+    def mix(self, x, out=None):
+        n = len(x)
+        if out is None:
+            out = np.empty(n, dtype=np.complex64)
+        np.multiply(x, self._table(n), out=out)
+        out *= np.complex64(np.exp(1j*self.phase))
+        self.phase = (self.phase + n*self._step) % (2*np.pi)
+        return out
+
+
+# Streaming FIR filter that keeps every decimation-th output.
+# Only the kept outputs are computed, polyphase style: the input is viewed
+# as rows of decimation samples, and the taps as len(taps)/decimation
+# polyphase rows, so one matrix product (rows x taps per phase, done by
+# BLAS on the float32 view of the samples) followed by a shifted sum of
+# its columns gives the outputs.  That's len(taps)/decimation
+# multiply-adds per input sample.
+# The input samples still needed are kept as history, so consecutive
+# blocks filter exactly like one long block.
+# The output lags the input by (len(taps) - 1)/2 input samples.
+class PolyphaseDecimator(object):
+
+    def __init__(self, taps, decimation):
+        self.decimation = d = int(decimation)
+        if d < 1:
+            raise ValueError("decimation must be at least 1")
+
+        self.taps = taps = np.asarray(taps, dtype=np.float32)
+        self.num_taps = len(taps)
+        # pad to a whole number of taps per phase
+        self.taps_per_phase = p = -(-len(taps)//d)
+        padded = np.zeros(p*d, dtype=np.float32)
+        padded[:len(taps)] = taps
+
+        # row i, column c holds the tap applied to sample c of the row of
+        # input i rows before the output's own; real and imaginary parts
+        # go through separately, hence the 2x2 interleaving
+        g = padded.reshape(p, d)[:, ::-1]
+        self._weights = np.zeros((2*d, 2*p), dtype=np.float32)
+        self._weights[0::2, 0::2] = g.T
+        self._weights[1::2, 1::2] = g.T
+        self._history = p*d - 1
+
+        self._buf = np.empty(0, dtype=np.complex64)
+        self._rows = np.empty((0, p), dtype=np.complex64)
+        self.reset()
+
+    # forget the filter history
+    def reset(self):
+        self._buf = np.zeros(max(len(self._buf), self._history),
+                dtype=np.complex64)
+        self._have = self._history
+
+    # room for n more input samples at the end of the buffer
+    def _tail(self, n):
+        need = self._have + n
+        if len(self._buf) < need:
+            buf = np.empty(need, dtype=np.complex64)
+            buf[:self._have] = self._buf[:self._have]
+            self._buf = buf
+        tail = self._buf[self._have:need]
+        self._have = need
+        return tail
+
+    # filter whatever has been added with _tail
+    # the buffer always starts with the oldest sample the next output uses
+    def _run(self, out=None):
+        d, p = self.decimation, self.taps_per_phase
+        buf, have = self._buf, self._have
+        k = (have - self._history - 1)//d + 1 if have > self._history else 0
+        if out is None:
+            out = np.empty(k, dtype=np.complex64)
+        elif out.dtype != np.complex64 or len(out) < k:
+            raise ValueError("out must be a complex64 array of at least %d "
+                    "samples" % k)
+        y = out[:k]
+
+        if k:
+            n_rows = k + p - 1
+            if len(self._rows) < n_rows:
+                self._rows = np.empty((n_rows, p), dtype=np.complex64)
+            rows = self._rows[:n_rows]
+            frames = buf[:n_rows*d].view(np.float32).reshape(n_rows, 2*d)
+            np.matmul(frames, self._weights,
+                    out=rows.view(np.float32).reshape(n_rows, 2*p))
+            y[:] = rows[p - 1:p - 1 + k, 0]
+            for i in range(1, p):
+                y += rows[p - 1 - i:p - 1 - i + k, i]
+
+            # keep just the history the next output needs
+            used = k*d
+            buf[:have - used] = buf[used:have]
+            self._have = have - used
+        return y
+
+    # filter and decimate a block of complex samples; returns the new
+    # outputs (about len(block)/decimation of them)
+    def process(self, block, out=None):
+        self._tail(len(block))[:] = block
+        return self._run(out)
+
+
+# Extracts narrow channels out of a stream of HackRF blocks.
+#
+# Every channel is an NCO shifting its offset (Hz from the tuned center
+# frequency) down to 0 Hz, followed by a PolyphaseDecimator.  All the
+# channels share one decimation and one filter; by default a lowpass
+# passing bandwidth (0.8 of the output rate unless given) with
+# taps_per_phase*decimation taps.
+#
+# Feed it consecutive blocks (raw int8 from HackRF.stream, or complex)
+# with process(); it returns one complex64 array per channel at
+# sample_rate/decimation.  Phase and filter state carry over between
+# blocks.  int8 blocks are converted once for all channels, and each
+# channel's mixer writes straight into its filter's buffer.
+class Channelizer(object):
+
+    def __init__(self, sample_rate, offsets, decimation, bandwidth=None,
+            taps=None, taps_per_phase=12, window='hamming'):
+        self.sample_rate = float(sample_rate)
+        self.decimation = int(decimation)
+        self.output_rate = self.sample_rate/self.decimation
+        if taps is None:
+            if bandwidth is None:
+                bandwidth = 0.8*self.output_rate
+            taps = lowpass(taps_per_phase*self.decimation,
+                    bandwidth/2/self.sample_rate, window)
+        self.taps = np.asarray(taps, dtype=np.float32)
+
+        self.ncos = [NCO(-offset, self.sample_rate) for offset in offsets]
+        self.filters = [PolyphaseDecimator(self.taps, self.decimation)
+                for offset in offsets]
+        self._iq = np.empty(0, dtype=np.complex64)
+
+        # throughput accounting
+        self.samples_processed = 0
+        self.busy_seconds = 0.0
+
+    @property
+    def offsets(self):
+        return [-nco.freq for nco in self.ncos]
+
+    # move channel i to a new offset, without a phase jump
+    def retune(self, i, offset):
+        self.ncos[i].freq = -offset
+
+    def reset(self):
+        for nco in self.ncos:
+            nco.phase = 0.0
+        for f in self.filters:
+            f.reset()
+
+    # how many times faster than real time the samples are processed
+    @property
+    def realtime_factor(self):
+        if self.busy_seconds == 0:
+            return float('inf')
+        return self.samples_processed/self.sample_rate/self.busy_seconds
+
+    def process(self, block):
+        t0 = time.perf_counter()
+        block = np.asarray(block)
+        if block.dtype == np.int8:
+            n = len(block)//2
+            if len(self._iq) < n:
+                self._iq = np.empty(n, dtype=np.complex64)
+            iq = iqconvert.int8_to_complex64(block, out=self._iq)
+        else:
+            iq = block
+            n = len(iq)
+
+        outputs = []
+        for nco, f in zip(self.ncos, self.filters):
+            nco.mix(iq, out=f._tail(n))
+            outputs.append(f._run())
+
+        self.samples_processed += n
+        self.busy_seconds += time.perf_counter() - t0
+        return outputs
+
+
+# Streaming rational resampler for real float32 signals: changes the rate
+# by up/down, filtering with a polyphase lowpass so nothing folds back.
+# Each output only touches the taps_per_phase taps of its own phase, so
+# it costs taps_per_phase multiply-adds per output, done for a whole
+# block at once by gathering the input window of every output.
+# cutoff is the passband edge as a fraction of the output rate (at most
+# 0.5); the history and the phase of the next output carry over between
+# blocks.
+class RationalResampler(object):
+
+    def __init__(self, up, down, cutoff=0.45, taps_per_phase=16,
+            window='hamming'):
+        ratio = fractions.Fraction(int(up), int(down))
+        self.up = L = ratio.numerator
+        self.down = M = ratio.denominator
+        self.taps_per_phase = p = int(taps_per_phase)
+
+        # the filter runs at up times the input rate
+        edge = cutoff*min(1.0, float(L)/M)/L
+        taps = lowpass(L*p, edge, window)*L
+        # row phase holds the taps for its inputs, oldest first
+        self._weights = np.ascontiguousarray(
+                taps.reshape(p, L).T[:, ::-1]).astype(np.float32)
+        self._offsets = np.arange(p)
+        self.reset()
+
+    def reset(self):
+        self._buf = np.zeros(self.taps_per_phase - 1, dtype=np.float32)
+        # time of the next output, in filter-rate samples after the first
+        # input it needs
+        self._pos = 0
+
+    def process(self, x):
+        L, M, p = self.up, self.down, self.taps_per_phase
+        buf = np.concatenate((self._buf, np.asarray(x, dtype=np.float32)))
+        have = len(buf)
+        # outputs whose newest input is already here
+        last = (have - p)*L
+        k = (last - self._pos)//M + 1 if last >= self._pos else 0
+
+        t = self._pos + M*np.arange(k)
+        start = t//L
+        windows = buf[start[:, None] + self._offsets]
+        y = np.einsum('ij,ij->i', windows, self._weights[t % L])
+
+        pos = self._pos + k*M
+        used = pos//L
+        self._pos = pos - used*L
+        self._buf = buf[used:]
+        return y.astype(np.float32, copy=False)
+
+
+# Streaming FM demodulator for HackRF blocks.
+#
+#   fm = FMDemodulator(hackrf.sample_rate, offset=0, mode='wbfm')
+#   for block in hackrf.stream():
+#       audio = fm.process(block)       # float32 at fm.audio_rate
+#
+# The stages, all of which keep their state from one block to the next:
+#   channel     a Channelizer picks the station at offset Hz from the
+#               tuned frequency and decimates it to about if_rate
+#               (250 kHz for 'wbfm', 50 kHz for 'nbfm')
+#   discriminator
+#               polar: the angle of each sample times the conjugate of
+#               the one before, scaled so deviation Hz reads 1.0
+#   resampling  a RationalResampler down to audio_rate, passing
+#               audio_bandwidth
+#   de-emphasis the single pole lowpass with time constant tau (75 us for
+#               'wbfm' as in the US, use 50e-6 in Europe; off for
+#               'nbfm'), applied as its impulse response truncated where
+#               it falls below 1e-5
+# Everything is float32/complex64.  realtime_factor tells how many times
+# faster than the samples arrive it is running.
+class FMDemodulator(object):
+
+    _modes = {
+        # if_rate, deviation, audio_bandwidth, tau
+        'wbfm': (250e3, 75e3, 15e3, 75e-6),
+        'nbfm': (50e3, 5e3, 3.5e3, None),
+        }
+
+    def __init__(self, sample_rate, offset=0.0, mode='wbfm',
+            audio_rate=48000, if_rate=None, deviation=None,
+            audio_bandwidth=None, tau=-1, taps_per_phase=12):
+        try:
+            defaults = self._modes[mode]
+        except KeyError:
+            raise ValueError("mode must be 'wbfm' or 'nbfm'")
+        if if_rate is None:
+            if_rate = defaults[0]
+        if deviation is None:
+            deviation = defaults[1]
+        if audio_bandwidth is None:
+            audio_bandwidth = defaults[2]
+        if tau == -1:
+            tau = defaults[3]
+
+        self.sample_rate = float(sample_rate)
+        self.mode = mode
+        decimation = max(1, int(self.sample_rate // if_rate))
+        self.channelizer = Channelizer(self.sample_rate, [offset],
+                decimation, taps_per_phase=taps_per_phase)
+        self.if_rate = self.channelizer.output_rate
+        self._gain = np.float32(self.if_rate/(2*np.pi*deviation))
+        self._last = np.complex64(0)
+
+        ratio = fractions.Fraction(audio_rate/self.if_rate) \
+                .limit_denominator(1000)
+        self.audio_rate = self.if_rate*ratio
+        self.resampler = RationalResampler(ratio.numerator,
+                ratio.denominator, min(0.5, audio_bandwidth/self.audio_rate))
+
+        self.tau = tau
+        if tau:
+            a = np.exp(-1.0/(self.audio_rate*tau))
+            n = int(np.ceil(np.log(1e-5)/np.log(a)))
+            taps = a**np.arange(n)
+            self._deemphasis = (taps/taps.sum()).astype(np.float32)
+            self._audio = np.zeros(n - 1, dtype=np.float32)
+
+        self._prod = np.empty(0, dtype=np.complex64)
+        self._phase = np.empty(0, dtype=np.float32)
+
+        self.samples_processed = 0
+        self.busy_seconds = 0.0
+
+    @property
+    def offset(self):
+        return self.channelizer.offsets[0]
+
+    # move to another station, keeping the audio continuous
+    @offset.setter
+    def offset(self, offset):
+        self.channelizer.retune(0, offset)
+
+    @property
+    def realtime_factor(self):
+        if self.busy_seconds == 0:
+            return float('inf')
+        return self.samples_processed/self.sample_rate/self.busy_seconds
+
+    def reset(self):
+        self.channelizer.reset()
+        self.resampler.reset()
+        self._last = np.complex64(0)
+        if self.tau:
+            self._audio[:] = 0
+
+    # the instantaneous frequency of x, in units of the deviation
+    def _discriminate(self, x):
+        n = len(x)
+        if len(self._prod) < n:
+            self._prod = np.empty(n, dtype=np.complex64)
+            self._phase = np.empty(n, dtype=np.float32)
+        prod, phase = self._prod[:n], self._phase[:n]
+        if n == 0:
+            return phase
+        np.conjugate(x[:-1], out=prod[1:])
+        prod[0] = np.conj(self._last)
+        prod *= x
+        self._last = x[-1]
+        np.arctan2(prod.imag, prod.real, out=phase)
+        phase *= self._gain
+        return phase
+
+    # demodulates a block (raw int8 or complex); returns the float32 audio
+    # it completes
+    def process(self, block):
+        t0 = time.perf_counter()
+        before = self.channelizer.samples_processed
+        x = self.channelizer.process(block)[0]
+        audio = self.resampler.process(self._discriminate(x))
+        if self.tau:
+            buf = np.concatenate((self._audio, audio))
+            audio = np.convolve(buf, self._deemphasis, 'valid') \
+                    .astype(np.float32, copy=False)
+            self._audio = buf[len(buf) - len(self._audio):]
+        self.samples_processed += self.channelizer.samples_processed - before
+        self.busy_seconds += time.perf_counter() - t0
+        return audio
@@ -0,0 +1,458 @@
+# Compressed, indexed archives of int8 IQ, for long captures that need
+# random access.
+#
+#   w = ArchiveWriter('capture.hrfa', sample_rate=20e6, center_freq=100e6)
+#   w.write(block)                       # raw int8 IQ, any length
+#   w.new_segment(center_freq=101e6)     # after retuning
+#   w.close()
+#
+#   r = ArchiveReader('capture.hrfa', threads=4)
+#   iq = r.read_time(r.start_time + 3600, seconds=60)    # complex64
+#
+# The samples are cut into chunks of chunk_samples and each chunk is
+# compressed on its own (zlib or lzma from the standard library), so any
+# range can be read by decompressing just the chunks it touches.
+# A segment is a run of samples recorded with one configuration (sample
+# rate, center frequency, gains, ...); every retune starts a new one.
+# Sample numbers run on across segments, and can jump forward where
+# samples were lost (write(..., sample=)); a read fills such gaps with
+# zeros.
+#
+# File layout, all little-endian:
+#   header   b'HRFIQARC', uint16 version, uint8 codec (0 none, 1 zlib,
+#            2 lzma)
+#   records, each b'SEGM' or b'CHNK':
+#     SEGM   uint32 length, then that many bytes of JSON: the segment's
+#            configuration plus start_sample and start_time
+#     CHNK   uint32 segment, uint32 samples, uint32 compressed bytes,
+#            uint64 first sample, float64 time of the first sample, then
+#            the compressed int8 IQ
+#   index    JSON with the segments, then the chunk table (_chunk_dtype)
+#   trailer  uint64 index offset, uint64 JSON bytes, uint64 chunks,
+#            b'HRFINDEX'
+# The index is only written by close(); if it's missing (the writer
+# died), the reader rebuilds it by walking the records.
+
+import collections
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+import numpy as np
+
+import iqconvert
+
+MAGIC = b'HRFIQARC'
+VERSION = 1
+INDEX_MAGIC = b'HRFINDEX'
+
+_HEADER = struct.Struct('<8sHB')
+_SEGMENT = struct.Struct('<4sI')
+_CHUNK = struct.Struct('<4sIIIQd')
+_TRAILER = struct.Struct('<QQQ8s')
+
+_chunk_dtype = np.dtype([
+    ('offset', '<u8'),          # file offset of the compressed data
+    ('size', '<u4'),            # compressed bytes
+    ('segment', '<u4'),
+    ('sample', '<u8'),          # first sample
+    ('num_samples', '<u4'),
+    ('time', '<f8'),            # time of the first sample
+    ])
+
+_codecs = {'none': 0, 'zlib': 1, 'lzma': 2}
+_codec_names = dict((v, k) for k, v in _codecs.items())
+
+
+# lzma is only imported when used, it's missing from some Pythons
+def _compressor(codec, level):
+    if codec == 'zlib':
+        return lambda data: zlib.compress(data, level)
+    if codec == 'lzma':
+        import lzma
+        return lambda data: lzma.compress(data, preset=level)
+    if codec == 'none':
+        return bytes
+    raise ValueError("codec must be one of %s" % ', '.join(sorted(_codecs)))
+
+
+def _decompressor(codec):
+    if codec == 'zlib':
+        return zlib.decompress
+    if codec == 'lzma':
+        import lzma
+        return lzma.decompress
+    return bytes
+
+
+# Writes an archive.  The settings after center_freq (lna, vga, amp or
+# anything else that can go in JSON) are stored with the segment.
+# timestamp is the time of the first sample (now if None).
+# level is the zlib level or lzma preset; with threads > 0 up to that many
+# chunks are compressed at once (both codecs release the GIL), and the
+# chunks are still written in order.
+class ArchiveWriter(object):
+
+    def __init__(self, path, sample_rate, center_freq, codec='zlib',
+            level=1, chunk_samples=1 << 20, threads=0, timestamp=None,
+            **config):
+        self.path = path
+        self.codec = codec
+        self._compress = _compressor(codec, level)
+        self.chunk_samples = int(chunk_samples)
+        self.threads = threads
+
+        self.f = open(path, 'wb')
+        self.f.write(_HEADER.pack(MAGIC, VERSION, _codecs[codec]))
+        self.segments = []
+        self.chunks = []
+        self._buf = np.empty(2*self.chunk_samples, dtype=np.int8)
+        self._fill = 0
+        # stream position of the first sample in _buf
+        self._sample = 0
+        self._pool = None
+        self._pending = collections.deque()
+
+        self.samples_written = 0
+        self.bytes_compressed = 0
+
+        self.new_segment(sample_rate, center_freq, timestamp, **config)
+
+    @property
+    def segment(self):
+        return self.segments[-1]
+
+    # the next sample to be written
+    @property
+    def position(self):
+        return self._sample + self._fill//2
+
+    # starts a segment with new settings; those not given carry over from
+    # the current one.  timestamp is the time of its first sample (now if
+    # None).
+    def new_segment(self, sample_rate=None, center_freq=None, timestamp=None,
+            **config):
+        self._flush()
+        if self.segments:
+            seg = dict(self.segment)
+        else:
+            seg = {}
+        if sample_rate is not None:
+            seg['sample_rate'] = float(sample_rate)
+        if center_freq is not None:
+            seg['center_freq'] = float(center_freq)
+        seg.update(config)
+        seg['start_sample'] = self.position
+        seg['start_time'] = time.time() if timestamp is None \
+                else float(timestamp)
+        self.segments.append(seg)
+
+        data = json.dumps(seg).encode('utf-8')
+        self._write_pending()
+        self.f.write(_SEGMENT.pack(b'SEGM', len(data)))
+        self.f.write(data)
+
+    # appends int8 IQ; sample is its position in the stream if that's
+    # ahead of position (samples were lost), and timestamp the time of its
+    # first sample if known
+    def write(self, data, sample=None, timestamp=None):
+        data = np.asarray(data).view(np.int8).reshape(-1)
+        if sample is not None and sample != self.position:
+            if sample < self.position:
+                raise ValueError("sample %d is before the end of the "
+                        "archive (%d)" % (sample, self.position))
+            self._flush()
+            self._sample = sample
+        if timestamp is not None:
+            seg = self.segment
+            seg['start_time'] = timestamp - \
+                    (self.position - seg['start_sample'])/seg['sample_rate']
+
+        n = len(data)
+        pos = 0
+        while pos < n:
+            k = min(n - pos, len(self._buf) - self._fill)
+            self._buf[self._fill:self._fill + k] = data[pos:pos + k]
+            self._fill += k
+            pos += k
+            if self._fill == len(self._buf):
+                self._flush()
+
+    # compresses the partly filled chunk, if there's anything in it
+    def _flush(self):
+        if self._fill == 0:
+            return
+        seg = self.segment
+        num = self._fill//2
+        sample = self._sample
+        chunk = (len(self.segments) - 1, num, sample,
+                seg['start_time'] +
+                (sample - seg['start_sample'])/seg['sample_rate'])
+        data = self._buf[:2*num].tobytes()
+        self._sample += num
+        self._fill = 0
+
+        if self.threads:
+            if self._pool is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self._pool = ThreadPoolExecutor(max_workers=self.threads)
+            self._pending.append((chunk, self._pool.submit(self._compress,
+                    data)))
+            # keep at most two chunks per thread in memory
+            while len(self._pending) > 2*self.threads:
+                self._write_chunk(*self._pending.popleft())
+        else:
+            self._write_chunk(chunk, self._compress(data))
+
+    def _write_pending(self):
+        while self._pending:
+            self._write_chunk(*self._pending.popleft())
+
+    def _write_chunk(self, chunk, data):
+        if not isinstance(data, bytes):
+            data = data.result()
+        segment, num, sample, t = chunk
+        self.f.write(_CHUNK.pack(b'CHNK', segment, num, len(data), sample, t))
+        offset = self.f.tell()
+        self.f.write(data)
+        self.chunks.append((offset, len(data), segment, sample, num, t))
+        self.samples_written += num
+        self.bytes_compressed += len(data)
+
+    # writes what's left and the index
+    def close(self):
+        if self.f is None:
+            return
+        self._flush()
+        self._write_pending()
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+        index = json.dumps({'codec': self.codec,
+                'chunk_samples': self.chunk_samples,
+                'segments': self.segments}).encode('utf-8')
+        table = np.array(self.chunks, dtype=_chunk_dtype)
+        offset = self.f.tell()
+        self.f.write(index)
+        self.f.write(table.tobytes())
+        self.f.write(_TRAILER.pack(offset, len(index), len(table),
+                INDEX_MAGIC))
+        self.f.close()
+        self.f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Reads an archive.  Reads decompress only the chunks they touch; with
+# threads > 0 the chunks are decompressed and converted to complex64 in
+# parallel.
+# segments is the list of segment configurations (each with sample_rate,
+# center_freq, start_sample, start_time, ...); chunks the chunk table
+# (see _chunk_dtype).
+class ArchiveReader(object):
+
+    def __init__(self, path, threads=0):
+        self.path = path
+        self.threads = threads
+        self.f = open(path, 'rb')
+        self._lock = threading.Lock()
+        self._pool = None
+        self.chunks_decompressed = 0
+
+        magic, version, codec = _HEADER.unpack(self.f.read(_HEADER.size))
+        if magic != MAGIC:
+            raise IOError("%s is not an IQ archive" % path)
+        if version != VERSION:
+            raise IOError("%s is archive version %d, not %d"
+                    % (path, version, VERSION))
+        self.codec = _codec_names[codec]
+        self._decompress = _decompressor(self.codec)
+
+        if not self._read_index():
+            self._scan()
+        self._samples = self.chunks['sample']
+        self._ends = self._samples + self.chunks['num_samples']
+        self._starts = np.array([s['start_sample'] for s in self.segments],
+                dtype=np.int64)
+
+    def _read_index(self):
+        f = self.f
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size < _HEADER.size + _TRAILER.size:
+            return False
+        f.seek(size - _TRAILER.size)
+        offset, json_bytes, num_chunks, magic = \
+                _TRAILER.unpack(f.read(_TRAILER.size))
+        if magic != INDEX_MAGIC:
+            return False
+        f.seek(offset)
+        index = json.loads(f.read(json_bytes).decode('utf-8'))
+        self.segments = index['segments']
+        self.chunks = np.frombuffer(
+                f.read(num_chunks*_chunk_dtype.itemsize), dtype=_chunk_dtype)
+        return True
+
+    # rebuilds the index from the records, for archives that weren't
+    # closed; a record cut short at the end is ignored
+    def _scan(self):
+        f = self.f
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        pos = _HEADER.size
+        segments, chunks = [], []
+        while pos + _SEGMENT.size <= size:
+            f.seek(pos)
+            kind = f.read(4)
+            if kind == b'SEGM':
+                n = _SEGMENT.unpack(kind + f.read(4))[1]
+                if pos + _SEGMENT.size + n > size:
+                    break
+                segments.append(json.loads(f.read(n).decode('utf-8')))
+                pos += _SEGMENT.size + n
+            elif kind == b'CHNK':
+                if pos + _CHUNK.size > size:
+                    break
+                f.seek(pos)
+                magic, seg, num, n, sample, t = \
+                        _CHUNK.unpack(f.read(_CHUNK.size))
+                if pos + _CHUNK.size + n > size:
+                    break
+                chunks.append((pos + _CHUNK.size, n, seg, sample, num, t))
+                pos += _CHUNK.size + n
+            else:
+                break
+        self.segments = segments
+        self.chunks = np.array(chunks, dtype=_chunk_dtype)
+
+    # first sample and one past the last
+    @property
+    def start_sample(self):
+        return int(self._samples[0]) if len(self.chunks) else 0
+
+    @property
+    def end_sample(self):
+        return int(self._ends[-1]) if len(self.chunks) else 0
+
+    @property
+    def start_time(self):
+        return self.time_at(self.start_sample)
+
+    @property
+    def end_time(self):
+        return self.time_at(self.end_sample)
+
+    # index of the segment sample falls in
+    def segment_at(self, sample):
+        return max(0, int(np.searchsorted(self._starts, sample, 'right')) - 1)
+
+    def time_at(self, sample):
+        i = self.chunk_at(sample)
+        if i is None:
+            seg = self.segments[self.segment_at(sample)]
+            return seg['start_time'] + \
+                    (sample - seg['start_sample'])/seg['sample_rate']
+        c = self.chunks[i]
+        rate = self.segments[c['segment']]['sample_rate']
+        return float(c['time']) + (sample - int(c['sample']))/rate
+
+    # the sample recorded at time t (host time, as time.time())
+    def sample_at(self, t):
+        times = self.chunks['time']
+        i = max(0, int(np.searchsorted(times, t, 'right')) - 1)
+        c = self.chunks[i]
+        rate = self.segments[c['segment']]['sample_rate']
+        return int(c['sample']) + int(round((t - float(c['time']))*rate))
+
+    # index of the chunk holding sample, None if it's in a gap
+    def chunk_at(self, sample):
+        i = int(np.searchsorted(self._samples, sample, 'right')) - 1
+        if i < 0 or sample >= self._ends[i]:
+            return None
+        return i
+
+    def _read_chunk(self, i):
+        c = self.chunks[i]
+        offset, size = int(c['offset']), int(c['size'])
+        if hasattr(os, 'pread'):
+            data = os.pread(self.f.fileno(), size, offset)
+        else:
+            with self._lock:
+                self.f.seek(offset)
+                data = self.f.read(size)
+        self.chunks_decompressed += 1
+        return np.frombuffer(self._decompress(data), dtype=np.int8)
+
+    # num_samples samples from sample start on, as raw int8 IQ (dtype=None)
+    # or complex64; samples in gaps read as zeros
+    # out is an optional array of the right dtype to read into
+    def read(self, start, num_samples, dtype=np.complex64, out=None):
+        start, num_samples = int(start), int(num_samples)
+        if out is None:
+            if dtype is None:
+                out = np.zeros(2*num_samples, dtype=np.int8)
+            else:
+                out = np.zeros(num_samples, dtype=np.complex64)
+        else:
+            out[:] = 0
+        end = start + num_samples
+
+        first = max(0, int(np.searchsorted(self._ends, start, 'right')))
+        last = int(np.searchsorted(self._samples, end, 'left'))
+
+        def load(i):
+            c = self.chunks[i]
+            lo = max(start, int(c['sample']))
+            hi = min(end, int(c['sample']) + int(c['num_samples']))
+            raw = self._read_chunk(i)[2*(lo - int(c['sample'])):
+                    2*(hi - int(c['sample']))]
+            if dtype is None:
+                out[2*(lo - start):2*(hi - start)] = raw
+            else:
+                iqconvert.int8_to_complex64(raw,
+                        out=out[lo - start:hi - start])
+
+        if self.threads and last - first > 1:
+            if self._pool is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self._pool = ThreadPoolExecutor(max_workers=self.threads)
+            list(self._pool.map(load, range(first, last)))
+        else:
+            for i in range(first, last):
+                load(i)
+        return out
+
+    # seconds of samples from time t on
+    # the rate is that of the segment t falls in
+    def read_time(self, t, seconds, dtype=np.complex64):
+        start = self.sample_at(t)
+        rate = self.segments[self.segment_at(start)]['sample_rate']
+        return self.read(start, int(round(seconds*rate)), dtype)
+
+    # all the samples of segment i
+    def read_segment(self, i, dtype=np.complex64):
+        start = self.segments[i]['start_sample']
+        if i + 1 < len(self.segments):
+            end = self.segments[i + 1]['start_sample']
+        else:
+            end = self.end_sample
+        return self.read(start, end - start, dtype)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,156 @@
+# Conversion of raw HackRF samples (interleaved signed int8, I Q I Q ...)
+# into numpy sample arrays.
+#
+# Every kernel takes an optional preallocated out array and does a single
+# fused pass over the input (the int8 -> float cast and the scaling happen
+# inside one ufunc call), so no full-size temporaries are made.
+# Large buffers can be split across a thread pool; numpy releases the GIL
+# while the ufuncs run.
+
+import numpy as np
+
+# full scale of a signed 8 bit sample
+SCALE = 1.0/128
+
+# don't bother threading buffers smaller than this many samples
+MIN_CHUNK = 1 << 16
+
+_pool = None
+_pool_size = 0
+
+
+# the pool (and concurrent.futures) is only set up once threads are used
+def _get_pool(threads):
+    global _pool, _pool_size
+    from concurrent.futures import ThreadPoolExecutor
+    if _pool is None or _pool_size < threads:
+        if _pool is not None:
+            _pool.shutdown(wait=False)
+        _pool = ThreadPoolExecutor(max_workers=threads)
+        _pool_size = threads
+    return _pool
+
+
+# view anything holding raw samples (bytes, bytearray, ctypes array,
+# numpy array) as a flat int8 array without copying
+def as_int8(data):
+    if isinstance(data, np.ndarray):
+        return data.reshape(-1).view(np.int8)
+    return np.frombuffer(data, dtype=np.int8)
+
+
+# returns out, or a new array of num_samples of dtype if out is None
+def _output(num_samples, dtype, out, shape=None):
+    shape = shape or (num_samples,)
+    if out is None:
+        return np.empty(shape, dtype=dtype)
+    if out.dtype != dtype or out.shape[0] < num_samples:
+        raise ValueError("out must be a %s array of at least %d samples"
+                % (np.dtype(dtype).name, num_samples))
+    return out[:num_samples]
+
+
+# runs kernel(src, dst) over the whole buffer, or over equal slices of it
+# on a thread pool when threads > 1
+# src and dst must have the same length in their first dimension
+def _run(kernel, src, dst, threads):
+    n = len(dst)
+    if not threads or threads <= 1 or n < 2*MIN_CHUNK:
+        kernel(src, dst)
+        return
+
+    threads = min(threads, n // MIN_CHUNK)
+    step = -(-n // threads)
+    pool = _get_pool(threads)
+    futures = [pool.submit(kernel, src[i:i+step], dst[i:i+step])
+            for i in range(0, n, step)]
+    for f in futures:
+        f.result()
+
+
+def _scale_kernel(real_dtype):
+    scale = real_dtype(SCALE)
+    def kernel(src, dst):
+        np.multiply(src, scale, out=dst)
+    return kernel
+
+_kernel_c64 = _scale_kernel(np.float32)
+_kernel_c128 = _scale_kernel(np.float64)
+
+
+# interleaved int8 -> complex64 in [-1, 1)
+def int8_to_complex64(data, out=None, threads=None):
+    raw = as_int8(data)
+    iq = _output(len(raw)//2, np.complex64, out)
+    _run(_kernel_c64, raw[:2*len(iq)], iq.view(np.float32), threads)
+    return iq
+
+# interleaved int8 -> complex128 in [-1, 1)
+def int8_to_complex128(data, out=None, threads=None):
+    raw = as_int8(data)
+    iq = _output(len(raw)//2, np.complex128, out)
+    _run(_kernel_c128, raw[:2*len(iq)], iq.view(np.float64), threads)
+    return iq
+
+# interleaved int8 -> (num_samples, 2) int16 array of unscaled I/Q pairs
+def int8_to_int16(data, out=None, threads=None):
+    raw = as_int8(data)
+    n = len(raw)//2
+    pairs = _output(n, np.int16, out, (n, 2))
+    _run(_copy_kernel, raw[:2*n].reshape(n, 2), pairs, threads)
+    return pairs
+
+def _copy_kernel(src, dst):
+    np.copyto(dst, src, casting='safe')
+
+
+_converters = {
+    np.dtype(np.complex64): int8_to_complex64,
+    np.dtype(np.complex128): int8_to_complex128,
+    np.dtype(np.int16): int8_to_int16,
+    }
+
+# convert interleaved int8 into dtype (complex64, complex128 or int16)
+def convert(data, dtype=np.complex64, out=None, threads=None):
+    try:
+        fn = _converters[np.dtype(dtype)]
+    except KeyError:
+        raise ValueError("can't convert int8 samples to %s"
+                % np.dtype(dtype).name)
+    return fn(data, out=out, threads=threads)
+
+
+# samples converted per step by complex_to_int8, which bounds the float
+# scratch it needs
+PACK_CHUNK = 1 << 18
+
+# complex samples in [-1, 1] -> interleaved int8 for transmitting
+# values are scaled by 127, rounded and clipped to the int8 range
+# works through the input in chunks, so only a small float scratch buffer
+# is needed however large the input is
+def complex_to_int8(iq, out=None):
+    iq = np.asarray(iq)
+    if iq.dtype == np.complex64:
+        flat = iq.reshape(-1).view(np.float32)
+    elif iq.dtype == np.complex128:
+        flat = iq.reshape(-1).view(np.float64)
+    else:
+        flat = np.asarray(iq, dtype=np.complex64).reshape(-1).view(np.float32)
+
+    n = len(flat)
+    if out is None:
+        out = np.empty(n, dtype=np.int8)
+    elif out.dtype != np.int8 or len(out) < n:
+        raise ValueError("out must be an int8 array of at least %d values" % n)
+    else:
+        out = out[:n]
+
+    scratch = np.empty(min(n, 2*PACK_CHUNK), dtype=flat.dtype)
+    for i in range(0, n, 2*PACK_CHUNK):
+        src = flat[i:i+2*PACK_CHUNK]
+        t = scratch[:len(src)]
+        np.multiply(src, 127, out=t)
+        np.rint(t, out=t)
+        np.clip(t, -128, 127, out=t)
+        out[i:i+len(src)] = t
+    return out
@@ -0,0 +1,364 @@
+# TCP server streaming raw IQ from a HackRF, in the style of rtl_tcp.
+#
+#   server = IQServer(hackrf, port=1234)
+#   server.start()
+#
+# Every client gets the same stream of interleaved int8 IQ.  The RX
+# callback copies transfers into batches of batch_size bytes, and every
+# finished batch goes to each client's own queue of queue_depth batches;
+# a sender thread per client writes out whatever has queued up with one
+# sendmsg call.  A client that can't keep up only fills its own queue:
+# batches that don't fit are dropped for it (and counted) while the other
+# clients carry on.
+#
+# On connecting a client first receives a 12 byte header:
+#   b'HRF0', uint32 sample format (1: interleaved int8 IQ),
+#   uint32 sample rate in Hz (all big-endian)
+# Clients send commands of 9 bytes, a command byte and a big-endian
+# uint64 value, which are applied to the device with HackRF.configure
+# (so repeating a setting costs nothing):
+#   0x01 center frequency (Hz)   0x02 sample rate (Hz)
+#   0x03 amp (0 or 1)            0x04 LNA gain (dB)
+#   0x05 VGA gain (dB)
+# Like rtl_tcp, settings from any client apply to everyone.
+#
+# stats() reports throughput and drops for every client.
+
+import logging
+import socket
+import struct
+import threading
+import time
+import numpy as np
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+logger = logging.getLogger('HackRf Server')
+logger.addHandler(logging.NullHandler())
+
+MAGIC = b'HRF0'
+FORMAT_INT8 = 1
+HEADER = struct.Struct('>4sII')
+COMMAND = struct.Struct('>BQ')
+
+CMD_SET_FREQ = 0x01
+CMD_SET_SAMPLE_RATE = 0x02
+CMD_SET_AMP = 0x03
+CMD_SET_LNA_GAIN = 0x04
+CMD_SET_VGA_GAIN = 0x05
+
+_command_settings = {
+    CMD_SET_FREQ: 'freq',
+    CMD_SET_SAMPLE_RATE: 'sample_rate',
+    CMD_SET_AMP: 'amp',
+    CMD_SET_LNA_GAIN: 'lna',
+    CMD_SET_VGA_GAIN: 'vga',
+    }
+
+# most batches handed to one sendmsg call
+MAX_IOV = 64
+
+
+class _Client(object):
+
+    def __init__(self, server, sock, address, queue_depth):
+        self.server = server
+        self.sock = sock
+        self.address = address
+        self.queue = queue.Queue(maxsize=queue_depth)
+        self.connected = time.time()
+        self.bytes_sent = 0
+        self.batches_sent = 0
+        self.dropped_batches = 0
+        self.dropped_bytes = 0
+        self.commands = 0
+        self.closed = False
+
+        self._sender = threading.Thread(target=self._send_loop,
+                name='hackrf-server-send')
+        self._sender.daemon = True
+        self._reader = threading.Thread(target=self._command_loop,
+                name='hackrf-server-commands')
+        self._reader.daemon = True
+
+    def start(self):
+        self._sender.start()
+        self._reader.start()
+
+    # called from the RX callback; never blocks
+    def offer(self, batch):
+        try:
+            self.queue.put_nowait(batch)
+        except queue.Full:
+            self.dropped_batches += 1
+            self.dropped_bytes += len(batch)
+
+    def _send_loop(self):
+        sock = self.sock
+        try:
+            while True:
+                batch = self.queue.get()
+                if batch is None:
+                    return
+                pending = [memoryview(batch)]
+                # send whatever else is already waiting along with it
+                while len(pending) < MAX_IOV:
+                    try:
+                        batch = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if batch is None:
+                        self.queue.put(None)
+                        break
+                    pending.append(memoryview(batch))
+                count = len(pending)
+
+                while pending:
+                    n = sock.sendmsg(pending)
+                    self.bytes_sent += n
+                    while n and n >= len(pending[0]):
+                        n -= len(pending[0])
+                        pending.pop(0)
+                    if n:
+                        pending[0] = pending[0][n:]
+                self.batches_sent += count
+        except (OSError, IOError) as e:
+            logger.info("client %s: %s", self.address, e)
+        finally:
+            self.server._drop(self)
+
+    def _recv_exactly(self, n):
+        data = b''
+        while len(data) < n:
+            chunk = self.sock.recv(n - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def _command_loop(self):
+        try:
+            while True:
+                data = self._recv_exactly(COMMAND.size)
+                if data is None:
+                    break
+                cmd, value = COMMAND.unpack(data)
+                self.commands += 1
+                self.server.command(cmd, value)
+        except (OSError, IOError) as e:
+            logger.info("client %s: %s", self.address, e)
+        finally:
+            self.server._drop(self)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except (OSError, IOError):
+            pass
+        self.sock.close()
+        # wake the sender up so it exits
+        while True:
+            try:
+                self.queue.put_nowait(None)
+                break
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def stats(self):
+        seconds = time.time() - self.connected
+        return {
+            'address': '%s:%d' % self.address[:2],
+            'seconds': seconds,
+            'bytes_sent': self.bytes_sent,
+            'batches_sent': self.batches_sent,
+            'msps': self.bytes_sent/2.0/seconds/1e6 if seconds else 0.0,
+            'queue_depth': self.queue.qsize(),
+            'dropped_batches': self.dropped_batches,
+            'dropped_bytes': self.dropped_bytes,
+            'commands': self.commands,
+            }
+
+
+# Serves hackrf's RX stream on (host, port); port 0 picks a free port,
+# see address.  RX runs from start() until stop().
+class IQServer(object):
+
+    def __init__(self, hackrf, host='127.0.0.1', port=1234,
+            batch_size=1 << 20, queue_depth=16, sndbuf=4 << 20):
+        self.hackrf = hackrf
+        self.host = host
+        self.port = port
+        self.batch_size = int(batch_size)
+        self.queue_depth = int(queue_depth)
+        self.sndbuf = sndbuf
+
+        # replaced rather than changed in place, so the RX callback can
+        # go through it without taking the lock
+        self.clients = []
+        self._lock = threading.Lock()
+        self._config_lock = threading.Lock()
+        self._batch = None
+        self._fill = 0
+        self.batches = 0
+        self.sock = None
+        self._thread = None
+        self.address = None
+
+    def start(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(8)
+        self.sock = sock
+        self.address = sock.getsockname()
+
+        self._thread = threading.Thread(target=self._accept_loop,
+                name='hackrf-server')
+        self._thread.daemon = True
+        self._thread.start()
+
+        self._batch = np.empty(self.batch_size, dtype=np.int8)
+        self._fill = 0
+        self.hackrf.start_rx(self._on_samples, arrays=True)
+
+    def stop(self):
+        self.hackrf.stop_rx()
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except (OSError, IOError):
+                pass
+            self.sock.close()
+            self.sock = None
+        for client in self.clients:
+            client.close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _accept_loop(self):
+        while True:
+            try:
+                sock, address = self.sock.accept()
+            except (OSError, IOError, AttributeError):
+                return
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+            try:
+                sock.sendall(HEADER.pack(MAGIC, FORMAT_INT8,
+                        int(self.hackrf.sample_rate)))
+            except (OSError, IOError):
+                sock.close()
+                continue
+            client = _Client(self, sock, address, self.queue_depth)
+            with self._lock:
+                self.clients = self.clients + [client]
+            client.start()
+            logger.info("client %s connected", address)
+
+    def _drop(self, client):
+        with self._lock:
+            if client in self.clients:
+                self.clients = [c for c in self.clients if c is not client]
+                logger.info("client %s disconnected", client.address)
+        client.close()
+
+    # the RX callback: fills the current batch and hands it to every
+    # client once it is full
+    def _on_samples(self, samples, seq, timestamp):
+        n = len(samples)
+        pos = 0
+        while pos < n:
+            k = min(n - pos, self.batch_size - self._fill)
+            self._batch[self._fill:self._fill + k] = samples[pos:pos + k]
+            self._fill += k
+            pos += k
+            if self._fill == self.batch_size:
+                batch = self._batch
+                self._batch = np.empty(self.batch_size, dtype=np.int8)
+                self._fill = 0
+                self.batches += 1
+                for client in self.clients:
+                    client.offer(batch)
+        return 0
+
+    # applies a client command to the device
+    def command(self, cmd, value):
+        setting = _command_settings.get(cmd)
+        if setting is None:
+            logger.warning("unknown command 0x%02x", cmd)
+            return
+        with self._config_lock:
+            self.hackrf.configure(**{setting: value})
+
+    # one dict per connected client: address, seconds connected,
+    # bytes_sent, batches_sent, msps, queue_depth, dropped_batches,
+    # dropped_bytes and commands
+    def stats(self):
+        return [client.stats() for client in self.clients]
+
+
+# Minimal client for IQServer, mostly for testing on loopback.
+class IQClient(object):
+
+    def __init__(self, host='127.0.0.1', port=1234, rcvbuf=4 << 20):
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        header = self._recv_into(bytearray(HEADER.size))
+        magic, self.sample_format, self.sample_rate = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise IOError("not a pyhackrf IQ server")
+
+    def _recv_into(self, buf):
+        view = memoryview(buf)
+        got = 0
+        while got < len(buf):
+            n = self.sock.recv_into(view[got:])
+            if n == 0:
+                raise IOError("server closed the connection")
+            got += n
+        return buf
+
+    # the next num_bytes of the stream as an int8 array (out is an
+    # optional int8 array to receive into)
+    def read(self, num_bytes, out=None):
+        if out is None:
+            out = np.empty(num_bytes, dtype=np.int8)
+        self._recv_into(out[:num_bytes])
+        return out[:num_bytes]
+
+    def command(self, cmd, value):
+        self.sock.sendall(COMMAND.pack(cmd, int(value)))
+
+    def set_freq(self, freq):
+        self.command(CMD_SET_FREQ, freq)
+
+    def set_sample_rate(self, rate):
+        self.command(CMD_SET_SAMPLE_RATE, rate)
+
+    def set_amp(self, enabled):
+        self.command(CMD_SET_AMP, 1 if enabled else 0)
+
+    def set_lna_gain(self, gain):
+        self.command(CMD_SET_LNA_GAIN, gain)
+
+    def set_vga_gain(self, gain):
+        self.command(CMD_SET_VGA_GAIN, gain)
+
+    def close(self):
+        self.sock.close()
@@ -2,10 +2,25 @@
 # TODO: make error messages more informative
 
 from ctypes import *
+import contextlib
 import logging
 import os
 import numpy as np
 import time
+import collections
+import json
+import threading
+
+import dsp
+import iqarchive
+import iqconvert
+import iqserver
+import shmring
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 try:
     from itertools import izip
@@ -13,12 +28,9 @@ except ImportError:
     izip = zip
 
 path = os.path.dirname(__file__)
-logging.basicConfig()
 logger = logging.getLogger('HackRf Core')
-logger.setLevel(logging.DEBUG)
+logger.addHandler(logging.NullHandler())
 
-#libhackrf = CDLL('/usr/local/lib/libhackrf.so')
-libhackrf = CDLL('libhackrf.so.0')
 
 def enum(*sequential, **named):
     enums = dict(zip(sequential, range(len(sequential))), **named)
@@ -55,6 +67,19 @@ HackRfConstants = enum(
     HACKRF_USB_VID=0x1d50,
     HACKRF_USB_PID=0x6089)
 
+# USB product ids reported in hackrf_device_list_t.usb_board_ids
+HackRfUsbBoardId = enum(
+    USB_BOARD_ID_JAWBREAKER=0x604B,
+    USB_BOARD_ID_HACKRF_ONE=0x6089,
+    USB_BOARD_ID_RAD1O=0xCC15,
+    USB_BOARD_ID_INVALID=0xFFFF)
+
+_usb_board_names = {
+    HackRfUsbBoardId.USB_BOARD_ID_JAWBREAKER: 'Jawbreaker',
+    HackRfUsbBoardId.USB_BOARD_ID_HACKRF_ONE: 'HackRF One',
+    HackRfUsbBoardId.USB_BOARD_ID_RAD1O: 'rad1o',
+    }
+
 HackRfError = enum(
     HACKRF_SUCCESS=0,
     HACKRF_TRUE=1,
@@ -96,7 +121,7 @@ class read_partid_serialno_t(Structure):
 
 class hackrf_device_list_t(Structure):
         _fields_ = [("serial_numbers", POINTER(c_char_p)),
-                ("usb_board_ids", c_void_p),
+                ("usb_board_ids", POINTER(c_int)),
                 ("usb_device_index", POINTER(c_int)),
                 ("devicecount", c_int),
                 ("usb_devices", POINTER(c_void_p)),
@@ -107,71 +132,333 @@ class hackrf_device_list_t(Structure):
 _callback = CFUNCTYPE(c_int, POINTER(hackrf_transfer))
 
 
-# extern ADDAPI int ADDCALL hackrf_init();
-libhackrf.hackrf_init.restype = c_int
-libhackrf.hackrf_init.argtypes = []
-# extern ADDAPI int ADDCALL hackrf_exit();
-libhackrf.hackrf_exit.restype = c_int
-libhackrf.hackrf_exit.argtypes = []
-# extern ADDAPI int ADDCALL hackrf_open(hackrf_device** device);
-libhackrf.hackrf_open.restype = c_int
-libhackrf.hackrf_open.argtypes = [POINTER(p_hackrf_device)]
-# extern ADDAPI int ADDCALL hackrf_open_by_serial
-#   (const char* const desired_serial_number, hackrf_device** device);
-# TODO: check that this one works
-f = libhackrf.hackrf_open_by_serial
-f.restype = c_int
-f.argtypes = [POINTER(p_hackrf_device)]
-
-#extern ADDAPI int ADDCALL hackrf_device_list_open
-#   (hackrf_device_list_t *list, int idx, hackrf_device** device);
-f = libhackrf.hackrf_device_list_open
-f.restype = c_int
-f.arg_types = [POINTER(hackrf_device_list_t), c_int, POINTER(p_hackrf_device)]
-#f.arg_types = [hackrf_device_list_t, c_int, POINTER(p_hackrf_device)]
-
-# extern ADDAPI int ADDCALL hackrf_close(hackrf_device* device);
-libhackrf.hackrf_close.restype = c_int
-libhackrf.hackrf_close.argtypes = [p_hackrf_device]
-
-
-
-# extern ADDAPI int ADDCALL hackrf_set_sample_rate(hackrf_device*
-# device, const double freq_hz);
-libhackrf.hackrf_set_sample_rate.restype = c_int
-libhackrf.hackrf_set_sample_rate.argtypes = [p_hackrf_device, c_double]
-
-# GAIN SETTINGS
-# extern ADDAPI int ADDCALL hackrf_set_amp_enable(hackrf_device*
-# device, const uint8_t value);
-libhackrf.hackrf_set_amp_enable.restype = c_int
-libhackrf.hackrf_set_amp_enable.argtypes = [p_hackrf_device, c_uint8]
-# extern ADDAPI int ADDCALL hackrf_set_lna_gain(hackrf_device* device,
-# uint32_t value);
-libhackrf.hackrf_set_lna_gain.restype = c_int
-libhackrf.hackrf_set_lna_gain.argtypes = [p_hackrf_device, c_uint32]
-# extern ADDAPI int ADDCALL hackrf_set_vga_gain(hackrf_device* device,
-# uint32_t value);
-libhackrf.hackrf_set_vga_gain.restype = c_int
-libhackrf.hackrf_set_vga_gain.argtypes = [p_hackrf_device, c_uint32]
-
-# START AND STOP RX
-# extern ADDAPI int ADDCALL hackrf_start_rx(hackrf_device* device,
-# hackrf_sample_block_cb_fn callback, void* rx_ctx);
-libhackrf.hackrf_start_rx.restype = c_int
-libhackrf.hackrf_start_rx.argtypes = [p_hackrf_device, _callback, c_void_p]
-# extern ADDAPI int ADDCALL hackrf_stop_rx(hackrf_device* device);
-libhackrf.hackrf_stop_rx.restype = c_int
-libhackrf.hackrf_stop_rx.argtypes = [p_hackrf_device]
-
-#extern ADDAPI hackrf_device_list_t* ADDCALL hackrf_device_list();
-f = libhackrf.hackrf_device_list
-f.restype = POINTER(hackrf_device_list_t)
-f.argtypes = []
-
-
+# loads the native library and declares the prototypes we use
+def _load_library(name='libhackrf.so.0'):
+    lib = CDLL(name)
+
+    # extern ADDAPI int ADDCALL hackrf_init();
+    lib.hackrf_init.restype = c_int
+    lib.hackrf_init.argtypes = []
+    # extern ADDAPI int ADDCALL hackrf_exit();
+    lib.hackrf_exit.restype = c_int
+    lib.hackrf_exit.argtypes = []
+    # extern ADDAPI int ADDCALL hackrf_open(hackrf_device** device);
+    lib.hackrf_open.restype = c_int
+    lib.hackrf_open.argtypes = [POINTER(p_hackrf_device)]
+    # extern ADDAPI int ADDCALL hackrf_open_by_serial
+    #   (const char* const desired_serial_number, hackrf_device** device);
+    f = lib.hackrf_open_by_serial
+    f.restype = c_int
+    f.argtypes = [c_char_p, POINTER(p_hackrf_device)]
+
+    #extern ADDAPI int ADDCALL hackrf_device_list_open
+    #   (hackrf_device_list_t *list, int idx, hackrf_device** device);
+    f = lib.hackrf_device_list_open
+    f.restype = c_int
+    f.argtypes = [POINTER(hackrf_device_list_t), c_int, POINTER(p_hackrf_device)]
+
+    # extern ADDAPI int ADDCALL hackrf_close(hackrf_device* device);
+    lib.hackrf_close.restype = c_int
+    lib.hackrf_close.argtypes = [p_hackrf_device]
+
+
+
+    # extern ADDAPI int ADDCALL hackrf_set_sample_rate(hackrf_device*
+    # device, const double freq_hz);
+    lib.hackrf_set_sample_rate.restype = c_int
+    lib.hackrf_set_sample_rate.argtypes = [p_hackrf_device, c_double]
+
+    # GAIN SETTINGS
+    # extern ADDAPI int ADDCALL hackrf_set_amp_enable(hackrf_device*
+    # device, const uint8_t value);
+    lib.hackrf_set_amp_enable.restype = c_int
+    lib.hackrf_set_amp_enable.argtypes = [p_hackrf_device, c_uint8]
+    # extern ADDAPI int ADDCALL hackrf_set_lna_gain(hackrf_device* device,
+    # uint32_t value);
+    lib.hackrf_set_lna_gain.restype = c_int
+    lib.hackrf_set_lna_gain.argtypes = [p_hackrf_device, c_uint32]
+    # extern ADDAPI int ADDCALL hackrf_set_vga_gain(hackrf_device* device,
+    # uint32_t value);
+    lib.hackrf_set_vga_gain.restype = c_int
+    lib.hackrf_set_vga_gain.argtypes = [p_hackrf_device, c_uint32]
+
+    # START AND STOP RX
+    # extern ADDAPI int ADDCALL hackrf_start_rx(hackrf_device* device,
+    # hackrf_sample_block_cb_fn callback, void* rx_ctx);
+    lib.hackrf_start_rx.restype = c_int
+    lib.hackrf_start_rx.argtypes = [p_hackrf_device, _callback, c_void_p]
+    # extern ADDAPI int ADDCALL hackrf_stop_rx(hackrf_device* device);
+    lib.hackrf_stop_rx.restype = c_int
+    lib.hackrf_stop_rx.argtypes = [p_hackrf_device]
+
+    #extern ADDAPI hackrf_device_list_t* ADDCALL hackrf_device_list();
+    f = lib.hackrf_device_list
+    f.restype = POINTER(hackrf_device_list_t)
+    f.argtypes = []
+    #extern ADDAPI void ADDCALL hackrf_device_list_free
+    #   (hackrf_device_list_t *list);
+    f = lib.hackrf_device_list_free
+    f.restype = None
+    f.argtypes = [POINTER(hackrf_device_list_t)]
+
+    # extern ADDAPI int ADDCALL hackrf_start_tx(hackrf_device* device,
+    # hackrf_sample_block_cb_fn callback, void* tx_ctx);
+    lib.hackrf_start_tx.restype = c_int
+    lib.hackrf_start_tx.argtypes = [p_hackrf_device, _callback, c_void_p]
+    # extern ADDAPI int ADDCALL hackrf_stop_tx(hackrf_device* device);
+    lib.hackrf_stop_tx.restype = c_int
+    lib.hackrf_stop_tx.argtypes = [p_hackrf_device]
+    # extern ADDAPI int ADDCALL hackrf_is_streaming(hackrf_device* device);
+    lib.hackrf_is_streaming.restype = c_int
+    lib.hackrf_is_streaming.argtypes = [p_hackrf_device]
+    ## extern ADDAPI int ADDCALL hackrf_max2837_read(hackrf_device* device,
+    ## uint8_t register_number, uint16_t* value);
+    #lib.hackrf_max2837_read.restype = c_int
+    #lib.hackrf_max2837_read.argtypes = [
+    #    POINTER(hackrf_device), c_uint8, POINTER(c_uint16)]
+    ## extern ADDAPI int ADDCALL hackrf_max2837_write(hackrf_device* device,
+    ## uint8_t register_number, uint16_t value);
+    #lib.hackrf_max2837_write.restype = c_int
+    #lib.hackrf_max2837_write.argtypes = [POINTER(hackrf_device), c_uint8, c_uint16]
+    ## extern ADDAPI int ADDCALL hackrf_si5351c_read(hackrf_device* device,
+    ## uint16_t register_number, uint16_t* value);
+    #lib.hackrf_si5351c_read.restype = c_int
+    #lib.hackrf_si5351c_read.argtypes = [
+    #    POINTER(hackrf_device), c_uint16, POINTER(c_uint16)]
+    ## extern ADDAPI int ADDCALL hackrf_si5351c_write(hackrf_device* device,
+    ## uint16_t register_number, uint16_t value);
+    #lib.hackrf_si5351c_write.restype = c_int
+    #lib.hackrf_si5351c_write.argtypes = [POINTER(hackrf_device), c_uint16, c_uint16]
+    ## extern ADDAPI int ADDCALL
+    ## hackrf_set_baseband_filter_bandwidth(hackrf_device* device, const
+    ## uint32_t bandwidth_hz);
+    #lib.hackrf_set_baseband_filter_bandwidth.restype = c_int
+    #lib.hackrf_set_baseband_filter_bandwidth.argtypes = [
+    #    POINTER(hackrf_device), c_uint32]
+    ## extern ADDAPI int ADDCALL hackrf_rffc5071_read(hackrf_device* device,
+    ## uint8_t register_number, uint16_t* value);
+    #lib.hackrf_rffc5071_read.restype = c_int
+    #lib.hackrf_rffc5071_read.argtypes = [
+    #    POINTER(hackrf_device), c_uint8, POINTER(c_uint16)]
+    ## extern ADDAPI int ADDCALL hackrf_rffc5071_write(hackrf_device*
+    ## device, uint8_t register_number, uint16_t value);
+    #lib.hackrf_rffc5071_write.restype = c_int
+    #lib.hackrf_rffc5071_write.argtypes = [POINTER(hackrf_device), c_uint8, c_uint16]
+    ## extern ADDAPI int ADDCALL hackrf_spiflash_erase(hackrf_device*
+    ## device);
+    #lib.hackrf_spiflash_erase.restype = c_int
+    #lib.hackrf_spiflash_erase.argtypes = [POINTER(hackrf_device)]
+    ## extern ADDAPI int ADDCALL hackrf_spiflash_write(hackrf_device*
+    ## device, const uint32_t address, const uint16_t length, unsigned char*
+    ## const data);
+    #lib.hackrf_spiflash_write.restype = c_int
+    #lib.hackrf_spiflash_write.argtypes = [
+    #    POINTER(hackrf_device), c_uint32, c_uint16, POINTER(c_ubyte)]
+    ## extern ADDAPI int ADDCALL hackrf_spiflash_read(hackrf_device* device,
+    ## const uint32_t address, const uint16_t length, unsigned char* data);
+    #lib.hackrf_spiflash_read.restype = c_int
+    #lib.hackrf_spiflash_read.argtypes = [
+    #    POINTER(hackrf_device), c_uint32, c_uint16, POINTER(c_ubyte)]
+    ## extern ADDAPI int ADDCALL hackrf_cpld_write(hackrf_device* device,
+    ##         unsigned char* const data, const unsigned int total_length);
+    #lib.hackrf_cpld_write.restype = c_int
+    #lib.hackrf_cpld_write.argtypes = [POINTER(hackrf_device), POINTER(c_ubyte), c_uint]
+    ## extern ADDAPI int ADDCALL hackrf_board_id_read(hackrf_device* device,
+    ## uint8_t* value);
+    #lib.hackrf_board_id_read.restype = c_int
+    #lib.hackrf_board_id_read.argtypes = [POINTER(hackrf_device), POINTER(c_uint8)]
+    ## extern ADDAPI int ADDCALL hackrf_version_string_read(hackrf_device*
+    ## device, char* version, uint8_t length);
+    #lib.hackrf_version_string_read.restype = c_int
+    #lib.hackrf_version_string_read.argtypes = [POINTER(hackrf_device), POINTER(c_char), c_uint8]
+    # extern ADDAPI int ADDCALL hackrf_set_freq(hackrf_device* device,
+    # const uint64_t freq_hz);
+    lib.hackrf_set_freq.restype = c_int
+    lib.hackrf_set_freq.argtypes = [p_hackrf_device, c_uint64]
+    #
+    ## extern ADDAPI int ADDCALL hackrf_set_freq_explicit(hackrf_device* device,
+    ##         const uint64_t if_freq_hz, const uint64_t lo_freq_hz,
+    ##         const enum rf_path_filter path);,
+    ## lib.hackrf_set_freq_explicit.restype = c_int
+    ## lib.hackrf_set_freq_explicit.argtypes = [c_uint64,
+    ## c_uint64, ]
+    #
+    ## extern ADDAPI int ADDCALL
+    ## hackrf_set_sample_rate_manual(hackrf_device* device, const uint32_t
+    ## freq_hz, const uint32_t divider);
+    #lib.hackrf_set_sample_rate_manual.restype = c_int
+    #lib.hackrf_set_sample_rate_manual.argtypes = [
+    #    POINTER(hackrf_device), c_uint32, c_uint32]
+    #
+    # extern ADDAPI int ADDCALL
+    # hackrf_board_partid_serialno_read(hackrf_device* device,
+    # read_partid_serialno_t* read_partid_serialno);
+    f = lib.hackrf_board_partid_serialno_read
+    f.restype = c_int
+    f.argtypes = [p_hackrf_device, POINTER(read_partid_serialno_t)]
+
+    # extern ADDAPI int ADDCALL hackrf_set_txvga_gain(hackrf_device*
+    # device, uint32_t value);
+    lib.hackrf_set_txvga_gain.restype = c_int
+    lib.hackrf_set_txvga_gain.argtypes = [p_hackrf_device, c_uint32]
+    ## extern ADDAPI int ADDCALL hackrf_set_antenna_enable(hackrf_device*
+    ## device, const uint8_t value);
+    #lib.hackrf_set_antenna_enable.restype = c_int
+    #lib.hackrf_set_antenna_enable.argtypes = [POINTER(hackrf_device), c_uint8]
+    #
+    ## extern ADDAPI const char* ADDCALL hackrf_error_name(enum hackrf_error errcode);
+    ## lib.hackrf_error_name.restype = POINTER(c_char)
+    ## lib.hackrf_error_name.argtypes = []
+    #
+    ## extern ADDAPI const char* ADDCALL hackrf_board_id_name(enum hackrf_board_id board_id);
+    ## lib.hackrf_board_id_name.restype = POINTER(c_char)
+    ## lib.hackrf_board_id_name.argtypes = []
+    #
+    ## extern ADDAPI const char* ADDCALL hackrf_filter_path_name(const enum rf_path_filter path);
+    ## lib.hackrf_filter_path_name.restype = POINTER(c_char)
+    ## lib.hackrf_filter_path_name.argtypes = []
+    #
+
+    return lib
+
+
+# The native library is only loaded, and hackrf_init only called, the
+# first time a device is used (or hackrf_init() is called), so importing
+# this module is cheap and works on hosts without libhackrf.
+libhackrf = None
+library_name = 'libhackrf.so.0'
+#library_name = '/usr/local/lib/libhackrf.so'
+_library_lock = threading.Lock()
+
+# loads libhackrf and initializes it if that hasn't been done yet
+# returns the library
+def hackrf_init():
+    global libhackrf
+    with _library_lock:
+        if libhackrf is None:
+            t0 = time.time()
+            try:
+                lib = _load_library(library_name)
+            except OSError as e:
+                raise IOError("Could not load %s: %s" % (library_name, e))
+            result = lib.hackrf_init()
+            if result != 0:
+                raise IOError("Error %d initializing the hackrf library"
+                        % result)
+            libhackrf = lib
+            logger.debug("loaded %s in %.1f ms", library_name,
+                    1e3*(time.time() - t0))
+    return libhackrf
+
+# releases libhackrf; it is initialized again when next needed
+# all devices should be closed first
+def hackrf_exit():
+    global libhackrf
+    with _library_lock:
+        if libhackrf is None:
+            return
+        result = libhackrf.hackrf_exit()
+        if result != 0:
+            raise IOError("Error %d shutting down the hackrf library"
+                    % result)
+        libhackrf = None
+        # device lists don't outlive the library
+        if _registry is not None:
+            _registry._devices = None
+
+# initializes libhackrf for the duration of a with block
+# the library is only shut down at the end if this session initialized
+# it and none of its devices is still open, so HackRFs opened outside the
+# block (or kept open after it) go on working
+@contextlib.contextmanager
+def session():
+    owner = libhackrf is None
+    lib = hackrf_init()
+    try:
+        yield lib
+    finally:
+        if owner and not any(h.device_opened and h.lib is lib
+                for h in list(_hackrf_dict.values())):
+            hackrf_exit()
+
+
+# the native list has to be freed with hackrf_device_list_free;
+# DeviceRegistry reads it and frees it for you
 def hackrf_device_list():
-    return libhackrf.hackrf_device_list()
+    return hackrf_init().hackrf_device_list()
+
+
+# Remembers the HackRFs that are plugged in.
+# The devices are enumerated once, the first time they are needed, and
+# their serial numbers and USB board ids are kept; the native device list
+# is freed as soon as it has been read.  Nothing enumerates again until
+# refresh() is called, so opening a device (by its serial number, with
+# hackrf_open_by_serial) doesn't go through the list every time.
+# enumerate_seconds is how long the last enumeration took.
+class DeviceRegistry(object):
+
+    def __init__(self, lib=None):
+        self._lib = lib
+        self._devices = None
+        self.enumerate_seconds = None
+        self.enumerations = 0
+
+    @property
+    def lib(self):
+        return self._lib if self._lib is not None else hackrf_init()
+
+    # enumerates the devices again
+    def refresh(self):
+        lib = self.lib
+        t0 = _clock()
+        device_list = lib.hackrf_device_list()
+        devices = []
+        if device_list:
+            try:
+                dl = device_list.contents
+                for i in range(dl.devicecount):
+                    serial = dl.serial_numbers[i]
+                    board = dl.usb_board_ids[i]
+                    devices.append({
+                        'index': i,
+                        'serial': serial.decode('ascii') if serial else None,
+                        'usb_board_id': board,
+                        'board_name': _usb_board_names.get(board, 'unknown'),
+                        })
+            finally:
+                lib.hackrf_device_list_free(device_list)
+        self._devices = devices
+        self.enumerate_seconds = _clock() - t0
+        self.enumerations += 1
+        return devices
+
+    # list of dicts with index, serial, usb_board_id and board_name
+    def devices(self):
+        if self._devices is None:
+            self.refresh()
+        return self._devices
+
+    # serial number of the device at index, None if it didn't report one
+    # (old firmware, or a descriptor that couldn't be read)
+    def serial(self, index):
+        devices = self.devices()
+        if not 0 <= index < len(devices):
+            raise IOError("No HackRF at index %d (%d found)"
+                    % (index, len(devices)))
+        return devices[index]['serial']
+
+    def __len__(self):
+        return len(self.devices())
+
+
+_registry = None
+
+# the DeviceRegistry of the native library
+def get_registry():
+    global _registry
+    if _registry is None:
+        _registry = DeviceRegistry()
+    return _registry
 
 
 
@@ -181,6 +468,133 @@ def get_dict():
     return _hackrf_dict
 
 
+_clock = time.perf_counter if hasattr(time, 'perf_counter') else time.time
+
+# number of log2 buckets in the StreamStats histograms
+HIST_BUCKETS = 24
+
+# Counters kept on the RX callback path.
+# record() is called once per transfer and only does integer arithmetic;
+# everything derived (rates, means, histogram tables) is worked out in
+# snapshot(), when someone actually asks.
+# Histograms are in microseconds, bucket k counting values in
+# [2**(k-1), 2**k) (bucket 0 is < 1 us, the last bucket is open ended).
+class StreamStats(object):
+
+    __slots__ = ('transfers', 'bytes', 'short_transfers', 'callback_hist',
+            'callback_max', 'callback_total', 'gap_hist', 'gap_max',
+            'first_time', 'last_time')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.transfers = 0
+        self.bytes = 0
+        self.short_transfers = 0    # valid_length < buffer_length
+        self.callback_hist = [0]*HIST_BUCKETS
+        self.callback_max = 0.0
+        self.callback_total = 0.0
+        self.gap_hist = [0]*HIST_BUCKETS
+        self.gap_max = 0.0
+        self.first_time = None
+        self.last_time = None
+
+    # c is the hackrf_transfer, the callback ran from t0 to t1
+    def record(self, c, t0, t1):
+        n = c.valid_length
+        self.transfers += 1
+        self.bytes += n
+        if n < c.buffer_length:
+            self.short_transfers += 1
+
+        dt = t1 - t0
+        self.callback_total += dt
+        if dt > self.callback_max:
+            self.callback_max = dt
+        k = int(dt*1e6).bit_length()
+        self.callback_hist[k if k < HIST_BUCKETS else -1] += 1
+
+        last = self.last_time
+        if last is None:
+            self.first_time = t0
+        else:
+            gap = t0 - last
+            if gap > self.gap_max:
+                self.gap_max = gap
+            k = int(gap*1e6).bit_length()
+            self.gap_hist[k if k < HIST_BUCKETS else -1] += 1
+        self.last_time = t0
+
+    # histogram as a list of (bucket upper bound in us, count), skipping
+    # empty buckets; the last bucket's bound is None
+    @staticmethod
+    def _table(hist):
+        return [(2**k if k < HIST_BUCKETS - 1 else None, n)
+                for k, n in enumerate(hist) if n]
+
+    def snapshot(self):
+        transfers = self.transfers
+        seconds = 0.0
+        if self.first_time is not None:
+            seconds = self.last_time - self.first_time
+        gaps = max(transfers - 1, 1)
+        return {
+            'transfers': transfers,
+            'bytes': self.bytes,
+            'short_transfers': self.short_transfers,
+            'seconds': seconds,
+            'msps': self.bytes/2.0/seconds/1e6 if seconds else 0.0,
+            'callback_us': {
+                'mean': 1e6*self.callback_total/max(transfers, 1),
+                'max': 1e6*self.callback_max,
+                'histogram': self._table(self.callback_hist),
+                },
+            'gap_us': {
+                'mean': 1e6*seconds/gaps,
+                'max': 1e6*self.gap_max,
+                'histogram': self._table(self.gap_hist),
+                },
+            }
+
+
+# wraps an RX callback so every transfer is counted in the device's
+# rx_counters (see StreamStats)
+def _instrumented(fn):
+    def callback(hackrf_transfer):
+        t0 = _clock()
+        result = fn(hackrf_transfer)
+        c = hackrf_transfer.contents
+        _hackrf_dict[c.device].rx_counters.record(c, t0, _clock())
+        return result
+    return callback
+
+
+# calls fn(hackrf.stats()) every interval seconds from its own thread
+# until cancel() is called
+class StatsSubscription(object):
+
+    def __init__(self, hackrf, fn, interval):
+        self.hackrf = hackrf
+        self.fn = fn
+        self.interval = interval
+        self._cancelled = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                name='hackrf-stats')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def _run(self):
+        while not self._cancelled.wait(self.interval):
+            try:
+                self.fn(self.hackrf.stats())
+            except Exception:
+                logger.exception("stats hook %r failed", self.fn)
+
+
 def read_samples_cb(hackrf_transfer):
 
     # let's access the contents
@@ -190,180 +604,833 @@ def read_samples_cb(hackrf_transfer):
     # we can get the pointer with p_hackrf_device(c.device)
     this_hackrf = _hackrf_dict[c.device]
 
-    if len(this_hackrf.buffer) == this_hackrf.num_bytes:
-        this_hackrf.still_sampling = False
+    # the capture buffer is allocated up front by read_samples,
+    # so we only copy the valid bytes of this transfer into place
+    offset = this_hackrf.buffer_offset
+    if offset == 0:
+        this_hackrf.first_transfer_time = time.time()
+        this_hackrf.first_transfer_length = c.valid_length
+    remaining = this_hackrf.num_bytes - offset
+    if remaining <= 0:
+        this_hackrf._finish_capture()
         return 0
 
-    # like == case, but cut down the buffer to size
-    if len(this_hackrf.buffer) > this_hackrf.num_bytes:
-        this_hackrf.still_sampling = False
-        this_hackrf.buffer = this_hackrf.buffer[0:this_hackrf.num_bytes]
-        return 0
+    n = min(c.valid_length, remaining)
+    memmove(this_hackrf.buffer_p + offset, c.buffer, n)
+    this_hackrf.buffer_offset = offset + n
 
-    # grab the buffer data and concatenate it
-    values = cast(c.buffer, POINTER(c_byte*c.buffer_length)).contents
-    this_hackrf.buffer = this_hackrf.buffer + bytearray(values)
+    if n == remaining:
+        this_hackrf._finish_capture()
+
+    return 0
 
-    #print("len(bd) = ",len(this_hackrf.buffer))
 
+rs_callback = _callback(_instrumented(read_samples_cb))
+
+
+# Fixed-size sample blocks handed from the libhackrf callback thread to
+# a consumer through a bounded queue.
+# All blocks come from a pool allocated up front (queue_depth + 2 of them:
+# the queued ones, the one being filled and the one the consumer holds).
+# If a filled block can't be queued because the consumer is behind,
+# it is dropped whole and counted, and the callback reuses it.
+# If limit is given, incoming data is ignored once that many blocks
+# have been queued.
+# seqs[i] is the position of block i in the stream (in blocks, counting
+# dropped ones), so block i starts at byte seqs[i]*block_bytes of the
+# stream; bytes_fed is the number of stream bytes seen so far.
+class BlockQueue(object):
+
+    def __init__(self, block_bytes, queue_depth, limit=None):
+        self.block_bytes = int(block_bytes)
+        self.queue_depth = int(queue_depth)
+        self.limit = limit
+
+        self.pool = np.empty((self.queue_depth + 2, self.block_bytes),
+                dtype=np.int8)
+        self.blocks = list(self.pool)
+        self.addrs = [b.ctypes.data for b in self.blocks]
+        self.seqs = [0]*len(self.blocks)
+
+        self.ready = queue.Queue(maxsize=self.queue_depth)
+        self.free = collections.deque(range(1, len(self.blocks)))
+
+        # block currently being filled by the callback
+        self.current = 0
+        self.offset = 0
+
+        self.received = 0       # blocks queued for the consumer
+        self.dropped = 0        # blocks thrown away because the queue was full
+        self.max_depth = 0      # most blocks ever waiting in the queue
+        self.completed = 0      # blocks filled, queued or not
+        self.bytes_fed = 0
+
+    # called from the libhackrf thread with a transfer's buffer
+    def feed(self, buf, length):
+        src = cast(buf, c_void_p).value
+        pos = 0
+        while pos < length and self.received != self.limit:
+            n = min(length - pos, self.block_bytes - self.offset)
+            memmove(self.addrs[self.current] + self.offset, src + pos, n)
+            self.offset += n
+            pos += n
+
+            if self.offset == self.block_bytes:
+                self.offset = 0
+                self.seqs[self.current] = self.completed
+                self.completed += 1
+                try:
+                    self.ready.put_nowait(self.current)
+                except queue.Full:
+                    self.dropped += 1
+                    continue
+                self.received += 1
+                self.current = self.free.popleft()
+                depth = self.ready.qsize()
+                if depth > self.max_depth:
+                    self.max_depth = depth
+        self.bytes_fed += pos
+
+    # index of the next filled block
+    # raises queue.Empty if nothing arrives within timeout seconds
+    def get(self, timeout=None):
+        return self.ready.get(timeout=timeout)
+
+    # hand a block back to the callback once the consumer is done with it
+    def release(self, i):
+        self.free.append(i)
+
+
+def stream_cb(hackrf_transfer):
+    c = hackrf_transfer.contents
+    this_hackrf = _hackrf_dict[c.device]
+    this_hackrf.block_queue.feed(c.buffer, c.valid_length)
     return 0
 
 
-rs_callback = _callback(read_samples_cb)
-
-
-
-## extern ADDAPI int ADDCALL hackrf_start_tx(hackrf_device* device,
-## hackrf_sample_block_cb_fn callback, void* tx_ctx);
-#libhackrf.hackrf_start_tx.restype = c_int
-#libhackrf.hackrf_start_tx.argtypes = [POINTER(hackrf_device), _callback, c_void_p]
-## extern ADDAPI int ADDCALL hackrf_stop_tx(hackrf_device* device);
-#libhackrf.hackrf_stop_tx.restype = c_int
-#libhackrf.hackrf_stop_tx.argtypes = [POINTER(hackrf_device)]
-# extern ADDAPI int ADDCALL hackrf_is_streaming(hackrf_device* device);
-libhackrf.hackrf_is_streaming.restype = c_int
-libhackrf.hackrf_is_streaming.argtypes = [p_hackrf_device]
-## extern ADDAPI int ADDCALL hackrf_max2837_read(hackrf_device* device,
-## uint8_t register_number, uint16_t* value);
-#libhackrf.hackrf_max2837_read.restype = c_int
-#libhackrf.hackrf_max2837_read.argtypes = [
-#    POINTER(hackrf_device), c_uint8, POINTER(c_uint16)]
-## extern ADDAPI int ADDCALL hackrf_max2837_write(hackrf_device* device,
-## uint8_t register_number, uint16_t value);
-#libhackrf.hackrf_max2837_write.restype = c_int
-#libhackrf.hackrf_max2837_write.argtypes = [POINTER(hackrf_device), c_uint8, c_uint16]
-## extern ADDAPI int ADDCALL hackrf_si5351c_read(hackrf_device* device,
-## uint16_t register_number, uint16_t* value);
-#libhackrf.hackrf_si5351c_read.restype = c_int
-#libhackrf.hackrf_si5351c_read.argtypes = [
-#    POINTER(hackrf_device), c_uint16, POINTER(c_uint16)]
-## extern ADDAPI int ADDCALL hackrf_si5351c_write(hackrf_device* device,
-## uint16_t register_number, uint16_t value);
-#libhackrf.hackrf_si5351c_write.restype = c_int
-#libhackrf.hackrf_si5351c_write.argtypes = [POINTER(hackrf_device), c_uint16, c_uint16]
-## extern ADDAPI int ADDCALL
-## hackrf_set_baseband_filter_bandwidth(hackrf_device* device, const
-## uint32_t bandwidth_hz);
-#libhackrf.hackrf_set_baseband_filter_bandwidth.restype = c_int
-#libhackrf.hackrf_set_baseband_filter_bandwidth.argtypes = [
-#    POINTER(hackrf_device), c_uint32]
-## extern ADDAPI int ADDCALL hackrf_rffc5071_read(hackrf_device* device,
-## uint8_t register_number, uint16_t* value);
-#libhackrf.hackrf_rffc5071_read.restype = c_int
-#libhackrf.hackrf_rffc5071_read.argtypes = [
-#    POINTER(hackrf_device), c_uint8, POINTER(c_uint16)]
-## extern ADDAPI int ADDCALL hackrf_rffc5071_write(hackrf_device*
-## device, uint8_t register_number, uint16_t value);
-#libhackrf.hackrf_rffc5071_write.restype = c_int
-#libhackrf.hackrf_rffc5071_write.argtypes = [POINTER(hackrf_device), c_uint8, c_uint16]
-## extern ADDAPI int ADDCALL hackrf_spiflash_erase(hackrf_device*
-## device);
-#libhackrf.hackrf_spiflash_erase.restype = c_int
-#libhackrf.hackrf_spiflash_erase.argtypes = [POINTER(hackrf_device)]
-## extern ADDAPI int ADDCALL hackrf_spiflash_write(hackrf_device*
-## device, const uint32_t address, const uint16_t length, unsigned char*
-## const data);
-#libhackrf.hackrf_spiflash_write.restype = c_int
-#libhackrf.hackrf_spiflash_write.argtypes = [
-#    POINTER(hackrf_device), c_uint32, c_uint16, POINTER(c_ubyte)]
-## extern ADDAPI int ADDCALL hackrf_spiflash_read(hackrf_device* device,
-## const uint32_t address, const uint16_t length, unsigned char* data);
-#libhackrf.hackrf_spiflash_read.restype = c_int
-#libhackrf.hackrf_spiflash_read.argtypes = [
-#    POINTER(hackrf_device), c_uint32, c_uint16, POINTER(c_ubyte)]
-## extern ADDAPI int ADDCALL hackrf_cpld_write(hackrf_device* device,
-##         unsigned char* const data, const unsigned int total_length);
-#libhackrf.hackrf_cpld_write.restype = c_int
-#libhackrf.hackrf_cpld_write.argtypes = [POINTER(hackrf_device), POINTER(c_ubyte), c_uint]
-## extern ADDAPI int ADDCALL hackrf_board_id_read(hackrf_device* device,
-## uint8_t* value);
-#libhackrf.hackrf_board_id_read.restype = c_int
-#libhackrf.hackrf_board_id_read.argtypes = [POINTER(hackrf_device), POINTER(c_uint8)]
-## extern ADDAPI int ADDCALL hackrf_version_string_read(hackrf_device*
-## device, char* version, uint8_t length);
-#libhackrf.hackrf_version_string_read.restype = c_int
-#libhackrf.hackrf_version_string_read.argtypes = [POINTER(hackrf_device), POINTER(c_char), c_uint8]
-# extern ADDAPI int ADDCALL hackrf_set_freq(hackrf_device* device,
-# const uint64_t freq_hz);
-libhackrf.hackrf_set_freq.restype = c_int
-libhackrf.hackrf_set_freq.argtypes = [p_hackrf_device, c_uint64]
-#
-## extern ADDAPI int ADDCALL hackrf_set_freq_explicit(hackrf_device* device,
-##         const uint64_t if_freq_hz, const uint64_t lo_freq_hz,
-##         const enum rf_path_filter path);,
-## libhackrf.hackrf_set_freq_explicit.restype = c_int
-## libhackrf.hackrf_set_freq_explicit.argtypes = [c_uint64,
-## c_uint64, ]
-#
-## extern ADDAPI int ADDCALL
-## hackrf_set_sample_rate_manual(hackrf_device* device, const uint32_t
-## freq_hz, const uint32_t divider);
-#libhackrf.hackrf_set_sample_rate_manual.restype = c_int
-#libhackrf.hackrf_set_sample_rate_manual.argtypes = [
-#    POINTER(hackrf_device), c_uint32, c_uint32]
-#
-# extern ADDAPI int ADDCALL
-# hackrf_board_partid_serialno_read(hackrf_device* device,
-# read_partid_serialno_t* read_partid_serialno);
-f = libhackrf.hackrf_board_partid_serialno_read
-f.restype = c_int
-f.argtypes = [p_hackrf_device, POINTER(read_partid_serialno_t)]
-
-## extern ADDAPI int ADDCALL hackrf_set_txvga_gain(hackrf_device*
-## device, uint32_t value);
-#libhackrf.hackrf_set_txvga_gain.restype = c_int
-#libhackrf.hackrf_set_txvga_gain.argtypes = [POINTER(hackrf_device), c_uint32]
-## extern ADDAPI int ADDCALL hackrf_set_antenna_enable(hackrf_device*
-## device, const uint8_t value);
-#libhackrf.hackrf_set_antenna_enable.restype = c_int
-#libhackrf.hackrf_set_antenna_enable.argtypes = [POINTER(hackrf_device), c_uint8]
-#
-## extern ADDAPI const char* ADDCALL hackrf_error_name(enum hackrf_error errcode);
-## libhackrf.hackrf_error_name.restype = POINTER(c_char)
-## libhackrf.hackrf_error_name.argtypes = []
-#
-## extern ADDAPI const char* ADDCALL hackrf_board_id_name(enum hackrf_board_id board_id);
-## libhackrf.hackrf_board_id_name.restype = POINTER(c_char)
-## libhackrf.hackrf_board_id_name.argtypes = []
+st_callback = _callback(_instrumented(stream_cb))
+
+
+# Turns fn(samples, seq, timestamp) into a libhackrf RX callback, for
+# HackRF.start_rx.
+# samples is an int8 array of the transfer's interleaved IQ:
+#   copy=False  a read-only view straight onto libhackrf's transfer
+#               buffer, only valid until fn returns
+#   copy=True   a copy in the next of pool_size buffers, which are
+#               allocated on the first transfer and reused round robin,
+#               so it stays valid until pool_size more transfers arrive
+# seq counts the transfers from 0 and timestamp is the host time
+# (time.time()) the transfer arrived.
+# libhackrf cycles through a few fixed transfer buffers, so the views of
+# them are made once and cached: nothing is allocated per transfer.
+class ArrayCallback(object):
+
+    # views of more buffers than this (a virtual device handing out
+    # transfers all over a file) are dropped and made again
+    MAX_VIEWS = 64
+
+    def __init__(self, fn, copy=False, pool_size=16):
+        self.fn = fn
+        self.copy = copy
+        self.pool_size = int(pool_size)
+        self.seq = 0
+        self._views = {}
+        self._pool = None
+        self._rows = []
+        self._addrs = []
+
+    def _view(self, c):
+        addr = cast(c.buffer, c_void_p).value
+        n = c.valid_length
+        view = self._views.get(addr)
+        if view is None or len(view) < n:
+            if len(self._views) >= self.MAX_VIEWS:
+                self._views.clear()
+            view = np.frombuffer((c_byte*n).from_address(addr),
+                    dtype=np.int8)
+            view.flags.writeable = False
+            self._views[addr] = view
+        if len(view) == n:
+            return view
+        return view[:n]
+
+    def _copy(self, c):
+        n = c.valid_length
+        if self._pool is None or self._pool.shape[1] < n:
+            self._pool = np.empty((self.pool_size, max(n, c.buffer_length)),
+                    dtype=np.int8)
+            self._rows = list(self._pool)
+            self._addrs = [row.ctypes.data for row in self._rows]
+        i = self.seq % self.pool_size
+        memmove(self._addrs[i], c.buffer, n)
+        row = self._rows[i]
+        if len(row) == n:
+            return row
+        return row[:n]
+
+    def __call__(self, hackrf_transfer):
+        c = hackrf_transfer.contents
+        samples = self._copy(c) if self.copy else self._view(c)
+        result = self.fn(samples, self.seq, time.time())
+        self.seq += 1
+        return result or 0
+
+
+# TX sources fill the buffers of TX transfers from the libhackrf thread.
+# fill(addr, length) copies up to length bytes of int8 IQ to addr and
+# returns how many it wrote; fewer than length (0 included) means the
+# source is exhausted.
+
+# data as an array of int8 IQ bytes, or as it is if it is complex (and
+# still has to be packed); anything else is rejected rather than sent as
+# its raw bytes
+def _tx_samples(data):
+    data = np.asarray(data)
+    if np.iscomplexobj(data):
+        return data
+    if data.dtype != np.int8:
+        raise ValueError("TX samples must be complex or int8 IQ, not %s"
+                % data.dtype)
+    return data.reshape(-1)
+
+# Transmits int8 IQ that is already in memory: a complex array packed to
+# int8 once up front, an int8 array, or a .cs8 file (memory-mapped, so it
+# is paged in as it is sent).  With repeat=True it loops forever.
+class ArrayTxSource(object):
+
+    def __init__(self, data, repeat=False):
+        if isinstance(data, str):
+            data = np.memmap(data, dtype=np.int8, mode='r')
+        data = _tx_samples(data)
+        if np.iscomplexobj(data):
+            data = iqconvert.complex_to_int8(data)
+        self.data = data.reshape(-1)
+        self.addr = self.data.ctypes.data
+        self.size = len(self.data) - len(self.data) % 2
+        self.repeat = repeat
+        self.offset = 0
+        self.underruns = 0
+
+    def fill(self, dst, length):
+        done = 0
+        while done < length:
+            if self.offset >= self.size:
+                if not self.repeat or self.size == 0:
+                    break
+                self.offset = 0
+            n = min(length - done, self.size - self.offset)
+            memmove(dst + done, self.addr + self.offset, n)
+            self.offset += n
+            done += n
+        return done
+
+
+# Transmits blocks from an iterable (e.g. a generator) of complex or int8
+# sample arrays.  A producer thread packs them to int8 into a pool of
+# pool_blocks preallocated blocks of block_size samples, ahead of the
+# libhackrf thread, which only copies whole packed blocks into transfers.
+# If no packed block is ready when a transfer needs one, the rest of the
+# transfer is sent as zeros and counted in underruns.
+# A block that is neither complex nor an even number of int8 bytes ends
+# the stream; the ValueError is kept in error, and transmit() raises it.
+class StreamTxSource(object):
+
+    def __init__(self, blocks, block_size=131072, pool_blocks=8):
+        self.block_bytes = 2*int(block_size)
+        self.pool = np.empty((pool_blocks, self.block_bytes), dtype=np.int8)
+        self.addrs = [b.ctypes.data for b in self.pool]
+        self.lengths = [0]*pool_blocks
+
+        self.free = queue.Queue()
+        for i in range(pool_blocks):
+            self.free.put(i)
+        self.ready = queue.Queue()
+
+        self.current = None
+        self.offset = 0
+        self.underruns = 0
+        self.finished = False
+        self.error = None
+
+        self._stop = threading.Event()
+        self._primed = threading.Event()
+        self._thread = threading.Thread(target=self._produce, args=(blocks,),
+                name='hackrf-tx-producer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    # wait until the pool is full (or the iterable is exhausted), so TX
+    # doesn't start with an underrun
+    def prime(self, timeout=None):
+        return self._primed.wait(timeout)
+
+    # next free pool block, or None once stop() was called
+    def _free_block(self):
+        while not self._stop.is_set():
+            try:
+                return self.free.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return None
+
+    def _produce(self, blocks):
+        try:
+            for block in blocks:
+                block = _tx_samples(block)
+                if np.iscomplexobj(block):
+                    n_bytes = 2*len(block)
+                else:
+                    n_bytes = len(block)
+                    # half a sample would swap I and Q from here on
+                    if n_bytes % 2:
+                        raise ValueError("int8 TX block of odd length %d"
+                                % n_bytes)
+
+                for start in range(0, n_bytes, self.block_bytes):
+                    i = self._free_block()
+                    if i is None:
+                        return
+                    n = min(self.block_bytes, n_bytes - start)
+                    dst = self.pool[i][:n]
+                    if np.iscomplexobj(block):
+                        iqconvert.complex_to_int8(
+                                block[start//2:(start + n)//2], out=dst)
+                    else:
+                        dst[:] = block[start:start + n]
+                    self.lengths[i] = n
+                    self.ready.put(i)
+                    if self.free.empty():
+                        self._primed.set()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.ready.put(None)
+            self._primed.set()
+
+    def fill(self, dst, length):
+        done = 0
+        while done < length and not self.finished:
+            if self.current is None:
+                try:
+                    self.current = self.ready.get_nowait()
+                except queue.Empty:
+                    # producer is behind: send silence rather than wait
+                    self.underruns += 1
+                    memset(dst + done, 0, length - done)
+                    return length
+                if self.current is None:
+                    self.finished = True
+                    break
+                self.offset = 0
+
+            i = self.current
+            n = min(length - done, self.lengths[i] - self.offset)
+            memmove(dst + done, self.addrs[i] + self.offset, n)
+            self.offset += n
+            done += n
+            if self.offset == self.lengths[i]:
+                self.current = None
+                self.free.put(i)
+        return done
+
+
+def transmit_cb(hackrf_transfer):
+    c = hackrf_transfer.contents
+    this_hackrf = _hackrf_dict[c.device]
+    if this_hackrf.tx_done:
+        return -1
+
+    length = c.buffer_length
+    dst = cast(c.buffer, c_void_p).value
+    n = this_hackrf.tx_source.fill(dst, length)
+    this_hackrf.tx_bytes += n
+    if n < length:
+        # pad the last transfer with silence and end after it
+        memset(dst + n, 0, length - n)
+        this_hackrf.tx_done = True
+    c.valid_length = length
+    return 0
+
+
+tx_callback = _callback(transmit_cb)
+
+
+# Writes the blocks of a BlockQueue to a file from its own thread, so the
+# libhackrf callback never waits on the disk.
+# is_streaming, if given, is called whenever no block has come for
+# STREAMING_CHECK_INTERVAL; if it returns False the recording fails with
+# an IOError rather than waiting forever.
+# The file is preallocated to num_bytes and written sequentially one
+# block at a time; it is truncated to what was written if the recording
+# ends early or fails.
+class FileRecorder(object):
+
+    def __init__(self, path, num_bytes, block_queue, timeout=None,
+            is_streaming=None):
+        self.path = path
+        self.num_bytes = int(num_bytes)
+        self.block_queue = block_queue
+        self.timeout = timeout
+        self.is_streaming = is_streaming
+
+        self.bytes_written = 0
+        self.error = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                name='hackrf-recorder')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    # ask the writer to finish early
+    def stop(self):
+        self._stop.set()
+
+    # wait for the writer to finish
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+    def _run(self):
+        bq = self.block_queue
+        try:
+            self._open()
+            try:
+                waited = 0
+                while self.bytes_written < self.num_bytes \
+                        and not self._stop.is_set():
+                    try:
+                        # wake up now and then to check for stop() and
+                        # that the device is still streaming
+                        i = bq.get(STREAMING_CHECK_INTERVAL)
+                    except queue.Empty:
+                        if self.is_streaming is not None \
+                                and not self.is_streaming() \
+                                and bq.ready.qsize() == 0:
+                            raise IOError("HackRF stopped streaming with %d "
+                                    "of %d bytes written"
+                                    % (self.bytes_written, self.num_bytes))
+                        waited += STREAMING_CHECK_INTERVAL
+                        if self.timeout is not None \
+                                and waited >= self.timeout:
+                            raise IOError("No samples received in %g s"
+                                    % self.timeout)
+                        continue
+                    waited = 0
+
+                    n = min(bq.block_bytes, self.num_bytes - self.bytes_written)
+                    self._write(bq.blocks[i][:n], bq.seqs[i])
+                    self.bytes_written += n
+                    bq.release(i)
+            finally:
+                # also when the recording failed, so the file holds just
+                # what was written
+                try:
+                    self._finish()
+                finally:
+                    self._close()
+        except Exception as e:
+            self.error = e
+
+    # the file handling, which subclasses replace to write elsewhere;
+    # seq is the block's position in the stream, in blocks
+    def _open(self):
+        self._file = open(self.path, 'wb', buffering=0)
+        if hasattr(os, 'posix_fallocate') and self.num_bytes:
+            try:
+                os.posix_fallocate(self._file.fileno(), 0, self.num_bytes)
+            except OSError:
+                pass
+
+    def _write(self, data, seq):
+        self._file.write(data)
+
+    def _finish(self):
+        self._file.truncate(self.bytes_written)
+
+    def _close(self):
+        self._file.close()
+
+
+# A FileRecorder that writes into an iqarchive.ArchiveWriter, which it
+# closes at the end.  Blocks the BlockQueue dropped leave gaps in the
+# archive's sample numbers.
+class ArchiveRecorder(FileRecorder):
+
+    def __init__(self, writer, num_bytes, block_queue, timeout=None,
+            is_streaming=None):
+        FileRecorder.__init__(self, writer.path, num_bytes, block_queue,
+                timeout, is_streaming)
+        self.writer = writer
+
+    def _open(self):
+        pass
+
+    def _write(self, data, seq):
+        self.writer.write(data, sample=seq*self.block_queue.block_bytes//2)
+
+    def _finish(self):
+        pass
+
+    def _close(self):
+        self.writer.close()
+
+
+# path of the SigMF metadata file that goes with a recording
+# foo.sigmf-data -> foo.sigmf-meta, anything else gets .sigmf-meta appended
+def sigmf_meta_path(path):
+    base, ext = os.path.splitext(path)
+    if ext == '.sigmf-data':
+        return base + '.sigmf-meta'
+    return path + '.sigmf-meta'
+
+# writes a SigMF metadata file describing a ci8 recording
+def write_sigmf_meta(path, sample_rate, center_freq, start_time,
+        lna_gain=None, vga_gain=None, amp=None):
+    t = time.gmtime(start_time)
+    usec = int(round((start_time % 1)*1e6)) % 1000000
+    meta = {
+        'global': {
+            'core:datatype': 'ci8',
+            'core:sample_rate': sample_rate,
+            'core:version': '1.0.0',
+            'core:hw': 'HackRF',
+            'core:recorder': 'pyhackrf',
+            'hackrf:lna_gain': lna_gain,
+            'hackrf:vga_gain': vga_gain,
+            'hackrf:amp_enable': amp,
+            },
+        'captures': [{
+            'core:sample_start': 0,
+            'core:frequency': center_freq,
+            'core:datetime': time.strftime('%Y-%m-%dT%H:%M:%S', t)
+                + '.%06dZ' % usec,
+            }],
+        'annotations': [],
+        }
+
+    meta_path = sigmf_meta_path(path)
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f, indent=2)
+    return meta_path
+
+
+
+# Power-triggered burst capture, fed from the RX callback as an
+# ArrayCallback function (see HackRF.bursts).
 #
-## extern ADDAPI const char* ADDCALL hackrf_filter_path_name(const enum rf_path_filter path);
-## libhackrf.hackrf_filter_path_name.restype = POINTER(c_char)
-## libhackrf.hackrf_filter_path_name.argtypes = []
+# The power of every window of window samples is computed straight from
+# the int8 samples: one cast into a float32 scratch buffer and a row-wise
+# dot product per transfer.  A window whose mean power reaches
+# threshold_db (dBFS, a full-scale complex tone reads 0) starts a burst,
+# and the burst ends once post samples in a row have stayed below the
+# threshold, or when it reaches max_samples (truncated).  Every burst
+# starts with up to pre samples from before the trigger, taken from the
+# current transfer and a ring buffer holding the end of the previous ones.
 #
+# All memory is allocated up front: the ring, num_buffers burst buffers
+# of pre + max_samples samples, and the scratch.  Finished bursts queue
+# up for get(); a burst that starts while every buffer is taken (the
+# consumer is behind) is dropped and counted in dropped.
+class BurstTrigger(object):
+
+    def __init__(self, sample_rate, threshold_db=-30.0, pre=16384,
+            post=16384, max_samples=2**20, window=1024, num_buffers=8,
+            transfer_size=262144):
+        self.sample_rate = float(sample_rate)
+        self.window = int(window)
+        self.pre = int(pre)
+        self.post_windows = max(1, -(-int(post) // self.window))
+        self.threshold_db = threshold_db
+        # window energy (sum of I^2 + Q^2) at the threshold
+        self._threshold = self.window*128.0**2*10**(threshold_db/10.0)
+
+        self.ring = np.zeros(2*self.pre, dtype=np.int8)
+        self.ring_pos = 0
+        self.ring_fill = 0
+
+        self.pool = np.empty((num_buffers, 2*(self.pre + int(max_samples))),
+                dtype=np.int8)
+        self.free = collections.deque(range(num_buffers))
+        self.ready = queue.Queue()
+
+        self._scratch = np.empty(transfer_size, dtype=np.float32)
+        self._power = np.empty(-(-transfer_size // (2*self.window)),
+                dtype=np.float32)
+
+        self.active = False
+        self.cur = None
+        self.cur_len = 0
+        self.info = None
+        self.quiet = 0
+        self.samples_seen = 0
+        self.start_time = None
+
+        self.bursts = 0
+        self.dropped = 0
+
+    # the RX callback; samples is the transfer's int8 array
+    def __call__(self, samples, seq, timestamp):
+        n = len(samples)
+        if self.start_time is None:
+            # the first sample was taken one transfer before it arrived
+            self.start_time = timestamp - n/2.0/self.sample_rate
+        if len(self._scratch) < n:
+            self._scratch = np.empty(n, dtype=np.float32)
+            self._power = np.empty(-(-n // (2*self.window)),
+                    dtype=np.float32)
+
+        w2 = 2*self.window
+        k = -(-n // w2)
+        kf = n // w2
+        f = self._scratch[:n]
+        np.copyto(f, samples)
+        p = self._power[:k]
+        full = f[:kf*w2].reshape(kf, w2)
+        np.einsum('ij,ij->i', full, full, out=p[:kf])
+        if k > kf:
+            # scale a short last window up to a whole one
+            rest = f[kf*w2:]
+            p[kf] = np.dot(rest, rest)*w2/len(rest)
+        loud = p >= self._threshold
+
+        i = 0
+        seg = 0
+        while i < k:
+            if not self.active:
+                j = int(loud[i:].argmax())
+                if not loud[i + j]:
+                    break
+                i += j
+                seg = i*w2
+                self._start(samples, seg)
+                continue
+
+            end = min((i + 1)*w2, n)
+            room = len(self.pool[0]) - self.cur_len
+            if end - seg > room:
+                self._append(samples[seg:seg + room])
+                self._finish(truncated=True)
+                i += 1
+                continue
+
+            if loud[i]:
+                self.quiet = 0
+                if p[i] > self.info['peak']:
+                    self.info['peak'] = p[i]
+            else:
+                self.quiet += 1
+            i += 1
+            if self.quiet >= self.post_windows:
+                self._append(samples[seg:end])
+                self._finish()
+
+        if self.active:
+            self._append(samples[seg:])
+        self._remember(samples)
+        self.samples_seen += n//2
+        return 0
+
+    # starts a burst at byte offset s of samples, with the pre context
+    def _start(self, samples, s):
+        self.active = True
+        self.quiet = 0
+        from_here = min(s, 2*self.pre)
+        from_ring = min(2*self.pre - from_here, self.ring_fill)
+        first = self.samples_seen + (s - from_here - from_ring)//2
+        self.info = {
+            'sample_index': first,
+            'trigger_index': self.samples_seen + s//2,
+            'time': self.start_time + first/self.sample_rate,
+            'pre_samples': (from_here + from_ring)//2,
+            'peak': 0.0,
+            'truncated': False,
+            }
+        self.cur_len = 0
+        if not self.free:
+            self.cur = None
+            self.dropped += 1
+            return
+        self.cur = self.free.popleft()
+
+        if from_ring:
+            self._append(self._ring_tail(from_ring))
+        self._append(samples[s - from_here:s])
+
+    def _append(self, data):
+        n = len(data)
+        if self.cur is not None and n:
+            self.pool[self.cur, self.cur_len:self.cur_len + n] = data
+        self.cur_len += n
+
+    def _finish(self, truncated=False):
+        self.active = False
+        if self.cur is None:
+            return
+        info = self.info
+        info['truncated'] = truncated
+        info['buffer'] = self.cur
+        info['samples'] = self.pool[self.cur, :self.cur_len]
+        info['num_samples'] = self.cur_len//2
+        info['peak_db'] = float(10*np.log10(max(info.pop('peak'), 1.0)
+                /(self.window*128.0**2)))
+        self.cur = None
+        self.bursts += 1
+        self.ready.put(info)
+
+    # ends a burst still in progress (after RX has stopped)
+    def flush(self):
+        if self.active:
+            self._finish(truncated=True)
+
+    # the last n bytes that went through the ring, oldest first
+    def _ring_tail(self, n):
+        ring, pos = self.ring, self.ring_pos
+        if n <= pos:
+            return ring[pos - n:pos]
+        return np.concatenate((ring[len(ring) - (n - pos):], ring[:pos]))
+
+    def _remember(self, samples):
+        size = len(self.ring)
+        n = len(samples)
+        if size == 0:
+            return
+        if n >= size:
+            self.ring[:] = samples[n - size:]
+            self.ring_pos = 0
+        else:
+            pos = self.ring_pos
+            first = min(n, size - pos)
+            self.ring[pos:pos + first] = samples[:first]
+            self.ring[:n - first] = samples[first:]
+            self.ring_pos = (pos + n) % size
+        self.ring_fill = min(size, self.ring_fill + n)
+
+    # the next finished burst; raises queue.Empty after timeout seconds
+    def get(self, timeout=None):
+        return self.ready.get(timeout=timeout)
+
+    # gives a burst's buffer back once its samples are no longer needed
+    def release(self, burst):
+        self.free.append(burst['buffer'])
+
+
+# raised by a read_samples that was ended with cancel()
+class CaptureCancelled(IOError):
+    pass
+
+# how often (seconds) a capture in progress checks that the device is
+# still streaming
+STREAMING_CHECK_INTERVAL = 0.1
+
+# libhackrf keeps this many transfers of TRANSFER_SAMPLES samples in
+# flight while streaming, all of which may have been taken before a
+# setting changed
+TRANSFER_COUNT = 4
+TRANSFER_SAMPLES = 131072
+
+# rough time (seconds) the radio takes to settle after each setting
+# changes, used by configure() to tell how many samples to throw away
+SETTLE_SECONDS = {
+    'sample_rate': 0.01,    # clock generator and baseband filter
+    'freq': 0.001,          # synthesizer lock
+    'amp': 0.0001,
+    'lna': 0.0001,
+    'vga': 0.0001,
+    }
+
+# the settings configure() takes, in the order they are sent, with the
+# functions that turn a requested value into what the device ends up with
+_settings = (
+    ('sample_rate', float),
+    ('freq', int),
+    ('amp', bool),
+    ('lna', lambda gain: int(gain) - int(gain) % 8),
+    ('vga', lambda gain: int(gain) - int(gain) % 2),
+    )
 
 
 class HackRF(object):
     
     _center_freq = 100e6
     _sample_rate = 20e6
+    _amp_enabled = False
+    _txvga_gain = 0
     device_opened = False
-
-    def __init__(self, device_index=0):
-        self.open(device_index)
+    capture_listener = None
+
+    # backend is an object with the libhackrf functions HackRF uses;
+    # by default that's the native library, see backends.py for virtual
+    # devices that replay files or generate signals
+    # if serial is given the device with that serial number is opened
+    # instead of the one at device_index
+    # registry is the DeviceRegistry device indexes are looked up in; the
+    # shared one for the native library, or one of the backend's own
+    def __init__(self, device_index=0, backend=None, serial=None,
+            registry=None):
+        self.lib = backend if backend is not None else hackrf_init()
+        if registry is None:
+            registry = get_registry() if backend is None \
+                    else DeviceRegistry(backend)
+        self.registry = registry
+
+        self.open(device_index, serial)
         
         # TODO: initialize defaults here
         self.disable_amp()
         self.set_lna_gain(16)
         self.set_vga_gain(16)
 
-        self.buffer = bytearray()
+        self.buffer = np.empty(0, dtype=np.int8)
+        self.buffer_p = None
+        self.buffer_offset = 0
         self.num_bytes = 16*262144
-
-    def open(self, device_index=0):
+        self.first_transfer_time = None
+        self.first_transfer_length = 0
+        self.capture_done = threading.Event()
+        self._capture_cancelled = False
+
+        self.rx_counters = StreamStats()
+        self.block_queue = None
+        self._subscriptions = []
+
+    # devices are always opened by serial number; a device_index is
+    # looked up in the registry, which is enumerated again once if the
+    # device can't be opened or isn't in it (it may have been unplugged
+    # or plugged in since)
+    # open_seconds is how long opening took
+    def open(self, device_index=0, serial=None):
+        t0 = _clock()
 
         # pointer to device structure
         self.dev_p = p_hackrf_device(None)
 
-        hdl = hackrf_device_list()
-        result = libhackrf.hackrf_device_list_open(hdl, device_index, pointer(self.dev_p))
+        # a serial number given by the caller may be just the end of it
+        self._serial_no = None
+        if serial is not None:
+            result = self._open_serial(serial)
+        else:
+            try:
+                result = self._open_index(device_index)
+            except IOError:
+                result = HackRfError.HACKRF_ERROR_NOT_FOUND
+            if result != 0:
+                self.registry.refresh()
+                result = self._open_index(device_index)
+            serial = self._serial_no or 'at index %d' % device_index
         if result != 0:
-            raise IOError('Error code %d when opening HackRF' % (result))
+            raise IOError('Error code %d when opening HackRF %s'
+                    % (result, serial))
 
         # This is how I used to do it...
         # Note I only pass in the dev_p here, but it worked.
         # But above, I have to pass in a pointer(self.dev_p)
         # They should both take the same thing
-        #result = libhackrf.hackrf_open(self.dev_p)
+        #result = self.lib.hackrf_open(self.dev_p)
         #if result != 0:
         #    raise IOError('Error code %d when opening HackRF' % (result))
 
@@ -372,58 +1439,601 @@ class HackRF(object):
         _hackrf_dict[self.dev_p.value] = self
         #print("self.dev_p.value = ", self.dev_p.value)
 
+        # settings as last sent to this device, for configure()
+        self._applied = {}
+
         self.device_opened = True
+        self.open_seconds = _clock() - t0
+
+    def _open_serial(self, serial):
+        return self.lib.hackrf_open_by_serial(serial.encode('ascii'),
+                pointer(self.dev_p))
+
+    # opens the device at device_index by its serial number from the
+    # registry; a board without one can only be opened from a device list,
+    # so that one is opened from a fresh list, which is then freed
+    def _open_index(self, device_index):
+        serial = self._serial_no = self.registry.serial(device_index)
+        if serial is not None:
+            return self._open_serial(serial)
+
+        device_list = self.lib.hackrf_device_list()
+        if not device_list:
+            return HackRfError.HACKRF_ERROR_NOT_FOUND
+        try:
+            return self.lib.hackrf_device_list_open(device_list,
+                    device_index, pointer(self.dev_p))
+        finally:
+            self.lib.hackrf_device_list_free(device_list)
 
     def close(self):
         if not self.device_opened:
             return
 
-        libhackrf.hackrf_close(self.dev_p)
+        for sub in self._subscriptions:
+            sub.cancel()
+        self._subscriptions = []
+        executor = getattr(self, '_aio_executor', None)
+        if executor is not None:
+            executor.shutdown(wait=False)
+            self._aio_executor = None
+
+        t0 = _clock()
+        self.lib.hackrf_close(self.dev_p)
         self.device_opened = False
+        self.close_seconds = _clock() - t0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
     def __del__(self):
-        print("del function is being called")
         self.close()
 
-    # sleep_time in seconds
-    # I used to have just pass in the while loop
-    def read_samples(self,num_samples=131072,sleep_time=0.05):
+    # out is an optional preallocated array of at least 2*num_samples bytes
+    # that the raw int8 samples are captured into (avoids an allocation
+    # per call when capturing repeatedly)
+    # the callback signals when the capture is complete, so this returns
+    # as soon as the last transfer has arrived
+    # timeout (seconds) raises IOError if the capture hasn't finished in
+    # time; an IOError is also raised as soon as the device stops
+    # streaming before the capture is complete
+    # cancel() from another thread ends it with CaptureCancelled
+    # sleep_time is no longer used and is only kept for compatibility
+    def read_samples(self, num_samples=131072, sleep_time=0.05, out=None,
+            timeout=None):
+
+        self._start_capture(num_samples, out)
+        try:
+            self._wait_capture(None if timeout is None
+                    else _clock() + timeout)
+        finally:
+            self._stop_capture()
 
-        num_bytes = 2*num_samples
-        self.num_bytes = int(num_bytes)
+        # convert samples to iq
+        iq = bytes2iq(self.buffer)
 
-        self.buffer = bytearray()
+        return iq
+
+    # ends a read_samples in progress in another thread, which then
+    # raises CaptureCancelled
+    def cancel(self):
+        self._capture_cancelled = True
+        self.capture_done.set()
+        if self.capture_listener is not None:
+            self.capture_listener()
+
+    # called from the libhackrf thread once the capture buffer is full,
+    # which also calls capture_listener (if set) from that thread
+    def _finish_capture(self):
+        self.still_sampling = False
+        self.capture_done.set()
+        if self.capture_listener is not None:
+            self.capture_listener()
+
+    # sets up the capture buffer for read_samples_cb
+    def _prepare_capture(self, num_samples, out=None):
+        num_bytes = 2*int(num_samples)
+        self.num_bytes = num_bytes
+        self.buffer = _capture_buffer(num_bytes, out)
+        self.buffer_p = self.buffer.ctypes.data
+        self.buffer_offset = 0
+        self.first_transfer_time = None
+        self.first_transfer_length = 0
+        self.capture_done.clear()
+        self._capture_cancelled = False
+        self.still_sampling = True
+
+    # starts RX into a new capture buffer with read_samples_cb
+    # capture_done is set once num_samples have been captured
+    def _start_capture(self, num_samples, out=None):
+        self._prepare_capture(num_samples, out)
 
         # start receiving
-        result = libhackrf.hackrf_start_rx(self.dev_p, rs_callback, None)
+        result = self.lib.hackrf_start_rx(self.dev_p, rs_callback, None)
         if result != 0:
+            self.still_sampling = False
             raise IOError("Error in hackrf_start_rx")
-        self.still_sampling = True      # this does get called
-
-        while self.still_sampling:
-            if sleep_time:
-                time.sleep(sleep_time)
 
+    # blocks until the capture is complete or cancelled, the device stops
+    # streaming, or deadline (a _clock() time) passes
+    def _wait_capture(self, deadline=None):
+        done = self.capture_done
+        while not done.is_set():
+            wait = STREAMING_CHECK_INTERVAL
+            if deadline is not None:
+                wait = min(wait, deadline - _clock())
+                if wait <= 0:
+                    raise IOError("Capture timed out with %d of %d bytes "
+                            "received" % (self.buffer_offset, self.num_bytes))
+            if done.wait(wait):
+                break
+            if self.lib.hackrf_is_streaming(self.dev_p) \
+                    != HackRfError.HACKRF_TRUE and not done.is_set():
+                raise IOError("HackRF stopped streaming with %d of %d bytes "
+                        "received" % (self.buffer_offset, self.num_bytes))
+
+        if self._capture_cancelled:
+            raise CaptureCancelled("Capture cancelled with %d of %d bytes "
+                    "received" % (self.buffer_offset, self.num_bytes))
+
+    def _is_streaming(self):
+        return self.lib.hackrf_is_streaming(self.dev_p) \
+                == HackRfError.HACKRF_TRUE
+
+    def _stop_capture(self):
         # stop receiving
-        result = libhackrf.hackrf_stop_rx(self.dev_p)
+        result = self.lib.hackrf_stop_rx(self.dev_p)
         if result != 0:
             raise IOError("Error in hackrf_stop_rx")
 
-        # convert samples to iq
-        iq = bytes2iq(self.buffer)
 
-        return iq
+    # generator yielding blocks of block_size samples as raw interleaved
+    # int8 IQ (2*block_size bytes) until num_blocks have been yielded
+    # or the generator is closed
+    # a yielded block is only valid until the next one is requested;
+    # copy it if you need to keep it
+    # if the consumer falls more than queue_depth blocks behind, whole
+    # blocks are dropped and counted in self.block_queue.dropped
+    # timeout (seconds) raises IOError if no block arrives in time
+    def stream(self, block_size=131072, queue_depth=16, num_blocks=None,
+            timeout=None):
+
+        bq = BlockQueue(2*int(block_size), queue_depth)
+        self.block_queue = bq
+
+        result = self.lib.hackrf_start_rx(self.dev_p, st_callback, None)
+        if result != 0:
+            raise IOError("Error in hackrf_start_rx")
+
+        try:
+            count = 0
+            while num_blocks is None or count < num_blocks:
+                try:
+                    i = bq.get(timeout)
+                except queue.Empty:
+                    raise IOError("No samples received in %g s" % timeout)
+                yield bq.blocks[i]
+                bq.release(i)
+                count += 1
+        finally:
+            result = self.lib.hackrf_stop_rx(self.dev_p)
+            if result != 0:
+                raise IOError("Error in hackrf_stop_rx")
+
+
+    # asyncio versions of stream, read_samples and configure (Python 3
+    # only, see aiohackrf.py): async for over astream, await the others
+    def astream(self, block_size=131072, queue_depth=16, num_blocks=None,
+            timeout=None):
+        import aiohackrf
+        return aiohackrf.astream(self, block_size, queue_depth, num_blocks,
+                timeout)
+
+    def aread_samples(self, num_samples=131072, out=None, timeout=None,
+            dtype=np.complex128):
+        import aiohackrf
+        return aiohackrf.aread_samples(self, num_samples, out, timeout, dtype)
+
+    def aconfigure(self, freq=None, sample_rate=None, lna=None, vga=None,
+            amp=None, force=False):
+        import aiohackrf
+        return aiohackrf.aconfigure(self, freq=freq, sample_rate=sample_rate,
+                lna=lna, vga=vga, amp=amp, force=force)
+
+    # generator yielding bursts of signal, found by a BurstTrigger on the
+    # RX callback (see it for threshold_db, pre, post, max_samples, window
+    # and num_buffers)
+    # each burst is a dict with
+    #   samples        raw int8 IQ, pre-trigger context included; only
+    #                  valid until the next burst is requested
+    #   num_samples    its length in samples
+    #   sample_index   stream position of its first sample
+    #   trigger_index  stream position of the window that triggered it
+    #   pre_samples    how many samples of context come before that
+    #   time           estimated host time of its first sample
+    #   peak_db        power of its loudest window, dBFS
+    #   truncated      whether it was cut off at max_samples
+    # stops after num_bursts bursts or duration seconds, or once the
+    # device stops streaming (a burst in progress is then yielded too)
+    # the trigger is kept in burst_trigger (bursts, dropped)
+    def bursts(self, threshold_db=-30.0, pre=16384, post=16384,
+            max_samples=2**20, window=1024, num_buffers=8, num_bursts=None,
+            duration=None):
+        trigger = BurstTrigger(self._sample_rate, threshold_db, pre, post,
+                max_samples, window, num_buffers)
+        self.burst_trigger = trigger
+        deadline = None if duration is None else _clock() + duration
+
+        self.start_rx(trigger, arrays=True)
+        stopped = False
+        try:
+            count = 0
+            while num_bursts is None or count < num_bursts:
+                if deadline is not None and _clock() >= deadline:
+                    break
+                try:
+                    burst = trigger.get(STREAMING_CHECK_INTERVAL)
+                except queue.Empty:
+                    if self.lib.hackrf_is_streaming(self.dev_p) \
+                            == HackRfError.HACKRF_TRUE:
+                        continue
+                    # nothing more is coming; stop RX so nothing else
+                    # touches the trigger and hand out what is left
+                    stopped = True
+                    self.stop_rx()
+                    trigger.flush()
+                    try:
+                        burst = trigger.get(0)
+                    except queue.Empty:
+                        break
+                yield burst
+                trigger.release(burst)
+                count += 1
+        finally:
+            if not stopped:
+                self.stop_rx()
+
+    # writes a burst from bursts() to path as raw int8 IQ, with a SigMF
+    # metadata file alongside; returns the metadata path
+    def save_burst(self, burst, path):
+        burst['samples'].tofile(path)
+        return write_sigmf_meta(path, self._sample_rate, self._center_freq,
+                burst['time'], getattr(self, '_lna_gain', None),
+                getattr(self, '_vga_gain', None), self._amp_enabled)
+
+    # starts RX into a shared-memory ring that consumers in other
+    # processes attach to by name (see shmring.py)
+    # returns the RingPublisher; stop with stop_rx(), then close it
+    def publish(self, name=None, num_slots=64, slot_size=262144):
+        publisher = shmring.RingPublisher(name, num_slots, slot_size,
+                self._sample_rate, self._center_freq)
+        self.start_rx(publisher, arrays=True)
+        return publisher
+
+    # starts RX and serves it over TCP to any number of clients (see
+    # iqserver.py); port 0 picks a free port, see the server's address
+    # returns the IQServer; stop() it to end RX and disconnect everyone
+    def serve(self, host='127.0.0.1', port=1234, batch_size=1 << 20,
+            queue_depth=16):
+        server = iqserver.IQServer(self, host, port, batch_size, queue_depth)
+        server.start()
+        return server
+
+    # records raw int8 IQ to path for duration seconds or num_samples
+    # samples, with a SigMF metadata file alongside (see sigmf_meta_path)
+    # samples go through a queue of queue_depth blocks of block_size
+    # samples to a writer thread; if the disk can't keep up whole blocks
+    # are dropped and counted
+    # returns a dict with bytes_written and dropped_blocks
+    def record(self, path, duration=None, num_samples=None,
+            block_size=1048576, queue_depth=64, timeout=None):
+
+        if num_samples is None:
+            if duration is None:
+                raise ValueError("record needs a duration or num_samples")
+            num_samples = duration*self._sample_rate
+        num_bytes = 2*int(num_samples)
+
+        block_bytes = 2*int(block_size)
+        bq = BlockQueue(block_bytes, queue_depth,
+                limit=-(-num_bytes // block_bytes))
+        self.block_queue = bq
+
+        recorder = FileRecorder(path, num_bytes, bq, timeout,
+                self._is_streaming)
+
+        start_time = time.time()
+        result = self.lib.hackrf_start_rx(self.dev_p, st_callback, None)
+        if result != 0:
+            raise IOError("Error in hackrf_start_rx")
+
+        # only once RX is armed, or the writer would see the device not
+        # streaming yet and give up; blocks wait in bq until it starts
+        recorder.start()
+        try:
+            recorder.join()
+        finally:
+            recorder.stop()
+            recorder.join()
+            result = self.lib.hackrf_stop_rx(self.dev_p)
+
+        meta_path = write_sigmf_meta(path, self._sample_rate,
+                self._center_freq, start_time, getattr(self, '_lna_gain', None),
+                getattr(self, '_vga_gain', None), self._amp_enabled)
+
+        if recorder.error is not None:
+            raise recorder.error
+        if result != 0:
+            raise IOError("Error in hackrf_stop_rx")
+
+        return {
+            'path': path,
+            'meta_path': meta_path,
+            'bytes_written': recorder.bytes_written,
+            'dropped_blocks': bq.dropped,
+            'dropped_bytes': bq.dropped*block_bytes,
+            }
+
+
+    # records like record(), but into a compressed archive with an index
+    # (see iqarchive.py), so any part of it can be read back without
+    # going through the rest
+    # blocks of chunk_samples go to a writer thread that compresses them
+    # with codec at level, on threads threads if given
+    # returns a dict with samples_written, archive_bytes (the compressed
+    # size), dropped_blocks and dropped_samples
+    def record_archive(self, path, duration=None, num_samples=None,
+            codec='zlib', level=1, chunk_samples=1 << 20, threads=0,
+            queue_depth=32, timeout=None):
+
+        if num_samples is None:
+            if duration is None:
+                raise ValueError("record_archive needs a duration or "
+                        "num_samples")
+            num_samples = duration*self._sample_rate
+        num_bytes = 2*int(num_samples)
+
+        block_bytes = 2*int(chunk_samples)
+        bq = BlockQueue(block_bytes, queue_depth,
+                limit=-(-num_bytes // block_bytes))
+        self.block_queue = bq
+
+        start_time = time.time()
+        writer = iqarchive.ArchiveWriter(path, self._sample_rate,
+                self._center_freq, codec, level, chunk_samples, threads,
+                start_time, lna=getattr(self, '_lna_gain', None),
+                vga=getattr(self, '_vga_gain', None), amp=self._amp_enabled)
+        recorder = ArchiveRecorder(writer, num_bytes, bq, timeout,
+                self._is_streaming)
+
+        result = self.lib.hackrf_start_rx(self.dev_p, st_callback, None)
+        if result != 0:
+            writer.close()
+            raise IOError("Error in hackrf_start_rx")
+
+        # started after RX for the same reason as in record()
+        recorder.start()
+        try:
+            recorder.join()
+        finally:
+            recorder.stop()
+            recorder.join()
+            result = self.lib.hackrf_stop_rx(self.dev_p)
+
+        if recorder.error is not None:
+            raise recorder.error
+        if result != 0:
+            raise IOError("Error in hackrf_stop_rx")
+
+        return {
+            'path': path,
+            'samples_written': writer.samples_written,
+            'archive_bytes': writer.bytes_compressed,
+            'dropped_blocks': bq.dropped,
+            'dropped_samples': bq.dropped*block_bytes//2,
+            }
+
+    # sweeps start_hz to stop_hz, yielding one stitched spectrum per pass
+    # RX runs for the whole sweep; each step retunes, throws away
+    # settle_samples (by default what configure() says: the transfers
+    # already in flight from the old frequency plus PLL settling), then
+    # averages windowed FFTs over dwell seconds of samples in one batch
+    # bin_width is the FFT resolution in Hz; only the middle usable
+    # fraction of each step's spectrum is kept, away from the filter edges
+    # yields dicts with freqs (Hz), power (dBFS), seconds, seconds_per_ghz
+    # and steps; num_passes=None sweeps until the generator is closed
+    def sweep(self, start_hz, stop_hz, bin_width=100e3, dwell=0.001,
+            num_passes=1, settle_samples=None, usable=0.75,
+            window='hann', timeout=1.0):
+
+        rate = self._sample_rate
+        n_fft = max(1, int(round(rate/bin_width)))
+        bin_width = rate/float(n_fft)
+        n_avg = max(1, int(round(dwell*rate/n_fft)))
+        keep = max(2, int(n_fft*usable)) & ~1
+        lo = n_fft//2 - keep//2
+        step = keep*bin_width
+
+        centers = []
+        f = start_hz + step/2
+        while f - step/2 < stop_hz:
+            centers.append(f)
+            f += step
+        offsets = (np.arange(keep) + lo - n_fft//2)*bin_width
+        freqs = (np.array(centers)[:, None] + offsets).reshape(-1)
+        in_band = (freqs >= start_hz) & (freqs < stop_hz)
+
+        block_samples = n_fft*n_avg
+        bq = BlockQueue(2*block_samples, 4)
+        self.block_queue = bq
+        iq = np.empty(block_samples, dtype=np.complex64)
+        power = np.empty((len(centers), keep))
+        spectrum = np.empty(n_fft)
+
+        result = self.lib.hackrf_start_rx(self.dev_p, st_callback, None)
+        if result != 0:
+            raise IOError("Error in hackrf_start_rx")
+
+        try:
+            passes = 0
+            while num_passes is None or passes < num_passes:
+                t0 = time.time()
+                for k, center in enumerate(centers):
+                    settle = self.configure(freq=center)['settle_samples']
+                    if settle_samples is not None:
+                        settle = int(settle_samples)
+                    first = bq.bytes_fed + 2*settle
+
+                    # skip blocks that started before the settling ended
+                    while True:
+                        try:
+                            i = bq.get(timeout)
+                        except queue.Empty:
+                            raise IOError("No samples received in %g s"
+                                    % timeout)
+                        if bq.seqs[i]*bq.block_bytes >= first:
+                            break
+                        bq.release(i)
+
+                    iqconvert.int8_to_complex64(bq.blocks[i], out=iq)
+                    bq.release(i)
+                    dsp.batch_power(iq, n_fft, window, out=spectrum)
+                    power[k] = spectrum[lo:lo + keep]
+
+                seconds = time.time() - t0
+                passes += 1
+                yield {
+                    'freqs': freqs[in_band],
+                    'power': dsp.to_db(power.reshape(-1)[in_band]),
+                    'seconds': seconds,
+                    'seconds_per_ghz': seconds/((stop_hz - start_hz)/1e9),
+                    'steps': len(centers),
+                    }
+        finally:
+            result = self.lib.hackrf_stop_rx(self.dev_p)
+            if result != 0:
+                raise IOError("Error in hackrf_stop_rx")
+
+
+    # transmits source, which can be
+    #   a complex numpy array (packed to int8 once, before TX starts)
+    #   an int8 numpy array or the path of a .cs8 file (memory-mapped)
+    #   an iterable of complex or int8 blocks (packed by a producer thread)
+    #   an ArrayTxSource or StreamTxSource
+    # repeat loops array and file sources forever
+    # with wait=True this returns when the source is exhausted, otherwise
+    # it returns straight away and TX runs until stop_tx()
+    # returns a dict with bytes_sent and underruns (so far, if not waiting)
+    def transmit(self, source, repeat=False, wait=True, sleep_time=0.01):
+        if isinstance(source, (str, np.ndarray)):
+            source = ArrayTxSource(source, repeat)
+        elif not isinstance(source, (ArrayTxSource, StreamTxSource)):
+            source = StreamTxSource(source)
+        if isinstance(source, StreamTxSource):
+            source.prime()
+
+        self.tx_source = source
+        self.tx_bytes = 0
+        self.tx_done = False
+
+        result = self.lib.hackrf_start_tx(self.dev_p, tx_callback, None)
+        if result != 0:
+            raise IOError("Error in hackrf_start_tx")
+
+        if wait:
+            # the callback ends the stream one transfer after tx_done, once
+            # the last padded transfer has gone out
+            try:
+                while not self.tx_done or self.lib.hackrf_is_streaming(
+                        self.dev_p) == HackRfError.HACKRF_TRUE:
+                    time.sleep(sleep_time)
+            finally:
+                self.stop_tx()
+            error = getattr(source, 'error', None)
+            if error is not None:
+                raise error
+
+        return self.tx_stats()
+
+    def tx_stats(self):
+        return {
+            'bytes_sent': self.tx_bytes,
+            'underruns': self.tx_source.underruns,
+            }
+
+    # tx_cb_fn is a callback function (in python) that fills the
+    # transfer buffer, like the start_rx callback
+    def start_tx(self, tx_cb_fn):
+        self._tx_cb = _callback(tx_cb_fn)
+        result = self.lib.hackrf_start_tx(self.dev_p, self._tx_cb, None)
+        if result != 0:
+            raise IOError("start_tx failure")
+
+    def stop_tx(self):
+        source = getattr(self, 'tx_source', None)
+        if hasattr(source, 'stop'):
+            source.stop()
+        result = self.lib.hackrf_stop_tx(self.dev_p)
+        if result != 0:
+            raise IOError("stop_tx failure")
+
+    # 0 to 47 dB in 1 dB steps
+    def set_txvga_gain(self, gain):
+        gain = int(gain)
+        result = self.lib.hackrf_set_txvga_gain(self.dev_p, gain)
+        if result != 0:
+            raise IOError("error setting txvga gain")
+        self._txvga_gain = gain
+        return 0
+
+    def get_txvga_gain(self):
+        return self._txvga_gain
+
+    txvga_gain = property(get_txvga_gain, set_txvga_gain)
+
+
+    # counters for the RX callbacks since the device was opened (or since
+    # reset_stats), plus the state of the current block queue if a
+    # stream, record or sweep is using one
+    def stats(self):
+        s = self.rx_counters.snapshot()
+        bq = self.block_queue
+        if bq is not None:
+            s['queue_depth'] = bq.ready.qsize()
+            s['max_queue_depth'] = bq.max_depth
+            s['blocks_received'] = bq.received
+            s['dropped_blocks'] = bq.dropped
+        return s
+
+    def reset_stats(self):
+        self.rx_counters.reset()
+
+    # calls fn(self.stats()) every interval seconds from a separate thread
+    # returns the subscription; cancel it with unsubscribe_stats
+    def subscribe_stats(self, fn, interval=1.0):
+        sub = StatsSubscription(self, fn, interval)
+        self._subscriptions.append(sub)
+        return sub
+
+    def unsubscribe_stats(self, sub):
+        sub.cancel()
+        if sub in self._subscriptions:
+            self._subscriptions.remove(sub)
 
 
     # setting the center frequency
     def set_freq(self, freq):
         freq = int(freq)
-        result = libhackrf.hackrf_set_freq(self.dev_p, freq)
+        result = self.lib.hackrf_set_freq(self.dev_p, freq)
         if result != 0:
             raise IOError('Error code %d when setting frequency to %d Hz'\
                     % (result, freq))
 
         self._center_freq = freq
+        self._applied['freq'] = freq
         return
 
     def get_freq(self):
@@ -434,11 +2044,12 @@ class HackRF(object):
 
     # sample rate
     def set_sample_rate(self, rate):
-        result = libhackrf.hackrf_set_sample_rate(self.dev_p, rate)
+        result = self.lib.hackrf_set_sample_rate(self.dev_p, rate)
         if result != 0:
             # TODO: make this error message better
             raise IOError('Sample rate set failure')
         self._sample_rate = rate
+        self._applied['sample_rate'] = float(rate)
         return
 
     def get_sample_rate(self):
@@ -446,34 +2057,48 @@ class HackRF(object):
 
     sample_rate = property(get_sample_rate, set_sample_rate)
 
+    # read from the device once, or taken from the registry
     def get_serial_no(self):
-        return get_serial_no(self.dev_p)
+        if self._serial_no is None:
+            self._serial_no = get_serial_no(self.dev_p, self.lib)
+        return self._serial_no
 
     def enable_amp(self):
-        result = libhackrf.hackrf_set_amp_enable(self.dev_p, 1)
+        result = self.lib.hackrf_set_amp_enable(self.dev_p, 1)
         if result != 0:
             # TODO: make this a better message
             raise IOError("error enabling amp")
+        self._amp_enabled = True
+        self._applied['amp'] = True
         return 0
 
     def disable_amp(self):
-        result = libhackrf.hackrf_set_amp_enable(self.dev_p, 0)
+        result = self.lib.hackrf_set_amp_enable(self.dev_p, 0)
         if result != 0:
             # TODO: make this a better message
             raise IOError("error disabling amp")
+        self._amp_enabled = False
+        self._applied['amp'] = False
         return 0
 
+    def _set_amp(self, enabled):
+        if enabled:
+            self.enable_amp()
+        else:
+            self.disable_amp()
+
     # rounds down to multiple of 8 (15 -> 8, 39 -> 32), etc.
     # internally, hackrf_set_lna_gain does the same thing
     # But we take care of it so we can keep track of the correct gain
     def set_lna_gain(self, gain):
         gain -= (gain % 8)    # round DOWN to multiple of 8
-        result = libhackrf.hackrf_set_lna_gain(self.dev_p, gain)
+        result = self.lib.hackrf_set_lna_gain(self.dev_p, gain)
         if result != 0:
             # TODO: make this a better message
             raise IOError("error setting lna gain")
         self._lna_gain = gain
-        print("LNA gain set to",gain,"dB.")
+        self._applied['lna'] = int(gain)
+        logger.debug("LNA gain set to %d dB", gain)
         return 0
 
     def get_lna_gain(self):
@@ -483,12 +2108,13 @@ class HackRF(object):
 
     def set_vga_gain(self, gain):
         gain -= (gain % 2)
-        result = libhackrf.hackrf_set_vga_gain(self.dev_p, gain)
+        result = self.lib.hackrf_set_vga_gain(self.dev_p, gain)
         if result != 0:
             # TODO: make this a better message
             raise IOError("error setting vga gain")
         self._vga_gain = gain
-        print("VGA gain set to",gain,"dB.")
+        self._applied['vga'] = int(gain)
+        logger.debug("VGA gain set to %d dB", gain)
         return 0
 
     def get_vga_gain(self):
@@ -496,54 +2122,196 @@ class HackRF(object):
 
     vga_gain = property(get_vga_gain, set_vga_gain)
 
+    # sets any of sample_rate, freq, amp (True/False), lna and vga gain in
+    # one go, sending only the ones that differ from what was last sent to
+    # the device (force=True sends them all)
+    # the sample rate goes first, then the frequency, then the gains
+    # returns a dict with
+    #   changed         names of the settings that were sent
+    #   settle_samples  how many samples to throw away after this call
+    #                   before the new settings are in effect: the
+    #                   transfers libhackrf may already have in flight,
+    #                   plus an estimate of the settling time
+    #                   (SETTLE_SECONDS); 0 if nothing changed
+    def configure(self, freq=None, sample_rate=None, lna=None, vga=None,
+            amp=None, force=False):
+        requested = {'sample_rate': sample_rate, 'freq': freq, 'amp': amp,
+                'lna': lna, 'vga': vga}
+        setters = {'sample_rate': self.set_sample_rate,
+                'freq': self.set_freq, 'amp': self._set_amp,
+                'lna': self.set_lna_gain, 'vga': self.set_vga_gain}
+
+        changed = []
+        for name, normalize in _settings:
+            value = requested[name]
+            if value is None:
+                continue
+            value = normalize(value)
+            if force or self._applied.get(name) != value:
+                setters[name](value)
+                changed.append(name)
+
+        settle = 0
+        if changed:
+            seconds = max(SETTLE_SECONDS[name] for name in changed)
+            settle = int(seconds*self._sample_rate)
+            if self.lib.hackrf_is_streaming(self.dev_p) \
+                    == HackRfError.HACKRF_TRUE:
+                settle += TRANSFER_COUNT*TRANSFER_SAMPLES
+        return {'changed': changed, 'settle_samples': settle}
+
     # rx_cb_fn is a callback function (in python)
-    def start_rx(self, rx_cb_fn):
-        rx_cb = _callback(rx_cb_fn)
-        result = libhackrf.hackrf_start_rx(self.dev_p, rx_cb, None)
+    # rx_cb_fn is called for every transfer from libhackrf's thread and
+    # returns 0 to carry on receiving
+    # by default it gets the POINTER(hackrf_transfer); with arrays=True it
+    # gets (samples, seq, timestamp) instead, samples being an int8 numpy
+    # array of the transfer (see ArrayCallback for copy and pool_size)
+    def start_rx(self, rx_cb_fn, arrays=False, copy=False, pool_size=16):
+        if arrays or copy:
+            rx_cb_fn = ArrayCallback(rx_cb_fn, copy, pool_size)
+        # keep a reference for as long as libhackrf may call it
+        self._rx_cb = _callback(_instrumented(rx_cb_fn))
+        result = self.lib.hackrf_start_rx(self.dev_p, self._rx_cb, None)
         if result != 0:
             raise IOError("start_rx failure")
 
     def stop_rx(self):
-        result = libhackrf.hackrf_stop_rx(self.dev_p)
+        result = self.lib.hackrf_stop_rx(self.dev_p)
         if result != 0:
             raise IOError("stop_rx failure");
 
 
 
+# Captures from several HackRFs at once.
+# devices is a list of device indexes, serial number strings or already
+# opened HackRF objects.  read_samples arms RX on all of them back to back,
+# each device fills its own preallocated buffer from its own libhackrf
+# thread, and the captures run concurrently, so N devices take about as
+# long as one.
+class MultiHackRF(object):
+
+    def __init__(self, devices):
+        self.hackrfs = []
+        self._owned = []
+        for d in devices:
+            if isinstance(d, HackRF):
+                hackrf = d
+            else:
+                if isinstance(d, str):
+                    hackrf = HackRF(serial=d)
+                else:
+                    hackrf = HackRF(device_index=d)
+                self._owned.append(hackrf)
+            self.hackrfs.append(hackrf)
+
+    def __len__(self):
+        return len(self.hackrfs)
+
+    def __getitem__(self, i):
+        return self.hackrfs[i]
+
+    # closes the devices this object opened
+    def close(self):
+        for hackrf in self._owned:
+            hackrf.close()
+
+    # ends a read_samples in progress in another thread
+    def cancel(self):
+        for hackrf in self.hackrfs:
+            hackrf.cancel()
+
+    def set_freq(self, freq):
+        for hackrf in self.hackrfs:
+            hackrf.set_freq(freq)
+
+    def set_sample_rate(self, rate):
+        for hackrf in self.hackrfs:
+            hackrf.set_sample_rate(rate)
+
+    # captures num_samples from every device
+    # out is an optional list with one preallocated capture buffer per
+    # device (see HackRF.read_samples)
+    # returns one dict per device with
+    #   samples      the capture, converted to dtype (raw int8 if None)
+    #   arm_time     host time RX was started on the device
+    #   start_time   estimated host time of the first sample
+    #   start_offset start of this capture relative to the earliest one,
+    #                in samples
+    # timeout (seconds) raises IOError if the captures don't finish in time
+    # sleep_time is no longer used and is only kept for compatibility
+    def read_samples(self, num_samples=131072, dtype=np.complex128,
+            out=None, sleep_time=0.001, timeout=None):
+        if out is None:
+            out = [None]*len(self.hackrfs)
+
+        arm_times = []
+        started = []
+        try:
+            for hackrf, buf in zip(self.hackrfs, out):
+                hackrf._start_capture(num_samples, buf)
+                arm_times.append(time.time())
+                started.append(hackrf)
+
+            deadline = None if timeout is None else _clock() + timeout
+            for hackrf in self.hackrfs:
+                hackrf._wait_capture(deadline)
+        finally:
+            for hackrf in started:
+                hackrf._stop_capture()
+
+        results = []
+        for hackrf, arm_time in zip(self.hackrfs, arm_times):
+            samples = hackrf.buffer
+            if dtype is not None:
+                samples = iqconvert.convert(samples, dtype)
+            # a transfer is only delivered once it is full, so its first
+            # sample was taken one transfer length earlier
+            start_time = hackrf.first_transfer_time \
+                    - hackrf.first_transfer_length/2.0/hackrf.sample_rate
+            results.append({
+                'samples': samples,
+                'arm_time': arm_time,
+                'start_time': start_time,
+                })
+
+        first = min(r['start_time'] for r in results)
+        for hackrf, r in zip(self.hackrfs, results):
+            r['start_offset'] = int(round((r['start_time'] - first)
+                *hackrf.sample_rate))
+        return results
+
+
 # returns serial number as a string
 # it is too big to be a single number, so make it a string
 # the returned string matches the hackrf_info output
-def get_serial_no(dev_p):
+def get_serial_no(dev_p, lib=None):
+    if lib is None:
+        lib = hackrf_init()
     sn = read_partid_serialno_t()
-    result = libhackrf.hackrf_board_partid_serialno_read(dev_p, sn)
+    result = lib.hackrf_board_partid_serialno_read(dev_p, sn)
     if result != 0:
         raise IOError("Error %d while getting serial number" % (result))
 
 
     # convert the serial number to a string
-    sn_str = ""
-    for i in xrange(0,4): 
-        sni = sn.serial_no[i]
-        if sni == 0:
-            sn_str += "00000000"
-        else:
-            sn_str += hex(sni)[2:-1]
-
-    return sn_str
+    return "".join("%08x" % sn.serial_no[i] for i in range(4))
+
+# returns a flat int8 array of num_bytes to capture into
+# if out is given, it is reused (no allocation) as long as it is big enough
+def _capture_buffer(num_bytes, out=None):
+    if out is None:
+        return np.empty(num_bytes, dtype=np.int8)
+
+    if not isinstance(out, np.ndarray) or not out.flags.c_contiguous:
+        raise ValueError("out must be a C-contiguous numpy array")
+    buf = out.reshape(-1).view(np.int8)
+    if len(buf) < num_bytes:
+        raise ValueError("out holds %d bytes but %d are needed"
+                % (len(buf), num_bytes))
+    return buf[:num_bytes]
 
 # converts byte array to iq values
-def bytes2iq(data):
-    values = np.array(data).astype(np.int8)
-    iq = values.astype(np.float64).view(np.complex128)
-    iq /= 127.5
-    iq -= (1 + 1j)
-
-    return iq
-
-
-
-
-# really, user shouldn't have to call this function at all
-result = libhackrf.hackrf_init()
-if result != 0:
-    print("error initializing the hackrf library")
+# data is interleaved signed int8 (bytes, bytearray or numpy array);
+# see iqconvert for complex64 and allocation-free variants
+def bytes2iq(data, out=None):
+    return iqconvert.int8_to_complex128(data, out=out)
@@ -0,0 +1,288 @@
+# Shared-memory ring of raw HackRF transfers, for fanning one device out
+# to consumers in other processes.
+#
+# A RingPublisher is an RX callback (see HackRF.publish) that copies each
+# transfer into the next slot of a multiprocessing.shared_memory block and
+# stamps it with a sequence number.  Consumers attach by name with
+# RingConsumer and read the slots as zero-copy numpy views, so several
+# processes (demodulation, PSD, recording, ...) can work on the same
+# samples on different cores without pickling anything.
+#
+# Layout of the shared memory:
+#   header   int64[8]: magic, version, slot_size, num_slots, head (the
+#            sequence number of the next slot to be written), closed
+#   info     float64[8]: sample_rate, center_freq
+#   seqs     int64[num_slots]: sequence number held by each slot, -1 while
+#            it is being written
+#   lengths  int64[num_slots]: bytes of samples in each slot
+#   times    float64[num_slots]: host time each transfer arrived
+#   data     int8[num_slots, slot_size], page aligned
+#
+# The publisher never waits for consumers.  A consumer that falls more
+# than num_slots - 1 slots behind has been lapped: it skips ahead to the
+# oldest slot still intact and counts what it missed.  Since views are
+# zero-copy, the publisher can also overwrite a slot while a consumer is
+# still reading it; valid(seq) tells whether that happened.
+
+import time
+import numpy as np
+
+MAGIC = 0x46524b4341480001
+VERSION = 1
+
+_HEADER = 64
+_INFO = 64
+_PAGE = 4096
+
+# header fields
+_SLOT_SIZE = 2
+_NUM_SLOTS = 3
+_HEAD = 4
+_CLOSED = 5
+
+
+def _layout(num_slots, slot_size):
+    seqs = _HEADER + _INFO
+    lengths = seqs + 8*num_slots
+    times = lengths + 8*num_slots
+    data = -(-(times + 8*num_slots) // _PAGE)*_PAGE
+    return seqs, lengths, times, data, data + num_slots*slot_size
+
+
+# attaching to a block makes Python (before 3.13) register it with the
+# resource tracker, and a consumer process with its own tracker would then
+# unlink it on exit, pulling it from under the publisher; so consumers
+# attach with registering switched off and only the creator tracks it
+def _attach(name):
+    from multiprocessing import shared_memory
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+    from multiprocessing import resource_tracker
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+class _Ring(object):
+
+    def _map(self, shm):
+        self.shm = shm
+        buf = shm.buf
+        self.header = np.ndarray(8, np.int64, buf, 0)
+        self.info = np.ndarray(8, np.float64, buf, _HEADER)
+        self.num_slots = n = int(self.header[_NUM_SLOTS])
+        self.slot_size = size = int(self.header[_SLOT_SIZE])
+        seqs, lengths, times, data, end = _layout(n, size)
+        self.seqs = np.ndarray(n, np.int64, buf, seqs)
+        self.lengths = np.ndarray(n, np.int64, buf, lengths)
+        self.times = np.ndarray(n, np.float64, buf, times)
+        self.data = np.ndarray((n, size), np.int8, buf, data)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    # sequence number of the next slot to be written
+    @property
+    def head(self):
+        return int(self.header[_HEAD])
+
+    @property
+    def closed(self):
+        return bool(self.header[_CLOSED])
+
+    @property
+    def sample_rate(self):
+        return float(self.info[0])
+
+    @property
+    def center_freq(self):
+        return float(self.info[1])
+
+    def _unmap(self):
+        # the numpy views have to go before the memory can be closed
+        self.header = self.info = self.seqs = self.lengths = None
+        self.times = self.data = None
+        try:
+            self.shm.close()
+        except BufferError:
+            # someone still holds a view; the mapping goes when it does
+            pass
+
+
+# Creates the ring and fills it from the RX callback:
+#   publisher = RingPublisher(num_slots=64, sample_rate=hackrf.sample_rate)
+#   hackrf.start_rx(publisher, arrays=True)
+# (or just hackrf.publish()).  name is picked by the system if None.
+# Transfers longer than slot_size are split over several slots.
+# close() marks the ring closed for the consumers and, with unlink=True,
+# removes it once they have detached.
+class RingPublisher(_Ring):
+
+    def __init__(self, name=None, num_slots=64, slot_size=262144,
+            sample_rate=0.0, center_freq=0.0):
+        from multiprocessing import shared_memory
+        if num_slots < 2:
+            raise ValueError("the ring needs at least 2 slots")
+        end = _layout(num_slots, slot_size)[-1]
+        shm = shared_memory.SharedMemory(name=name, create=True, size=end)
+
+        header = np.ndarray(8, np.int64, shm.buf, 0)
+        header[:] = 0
+        header[0] = MAGIC
+        header[1] = VERSION
+        header[_SLOT_SIZE] = slot_size
+        header[_NUM_SLOTS] = num_slots
+        self._map(shm)
+        del header
+        self.info[:] = 0
+        self.info[0] = sample_rate
+        self.info[1] = center_freq
+        self.seqs[:] = -1
+        self.lengths[:] = 0
+
+        self._seq = 0
+        self.published = 0
+
+    def set_center_freq(self, freq):
+        self.info[1] = freq
+
+    # the RX callback: samples is the transfer's int8 array
+    def __call__(self, samples, seq, timestamp):
+        n = len(samples)
+        pos = 0
+        while pos < n:
+            k = min(n - pos, self.slot_size)
+            self.write(samples[pos:pos + k], timestamp)
+            pos += k
+        return 0
+
+    # publishes data (at most slot_size int8 values) as the next slot
+    def write(self, data, timestamp=None):
+        s = self._seq
+        i = s % self.num_slots
+        n = len(data)
+        # readers of the old contents can tell it's being overwritten
+        self.seqs[i] = -1
+        self.data[i, :n] = data
+        self.lengths[i] = n
+        self.times[i] = time.time() if timestamp is None else timestamp
+        self.seqs[i] = s
+        self._seq = s + 1
+        self.header[_HEAD] = s + 1
+        self.published += 1
+
+    def close(self, unlink=True):
+        if self.shm is None:
+            return
+        self.header[_CLOSED] = 1
+        self._unmap()
+        if unlink:
+            self.shm.unlink()
+        self.shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Reads a ring by name, usually from another process.
+# start='latest' begins with the next slot to be published, 'oldest' with
+# the oldest one still in the ring.
+# read() returns (seq, samples, timestamp) for the next slot, samples
+# being a read-only int8 view into the shared memory; it is only good
+# until the publisher comes round to that slot again, which valid(seq)
+# checks.  If the consumer has been lapped, read() skips to the oldest
+# intact slot and adds the slots it skipped to missed.
+class RingConsumer(_Ring):
+
+    def __init__(self, name, start='latest', poll_interval=0.0005):
+        if start not in ('latest', 'oldest'):
+            raise ValueError("start must be 'latest' or 'oldest'")
+        self._map(_attach(name))
+        if self.header[0] != MAGIC or self.header[1] != VERSION:
+            self._unmap()
+            raise IOError("%s is not a pyhackrf ring" % name)
+
+        self.data.flags.writeable = False
+        self._rows = list(self.data)
+        self.poll_interval = poll_interval
+        self.missed = 0
+        self.received = 0
+        if start == 'latest':
+            self.seq = self.head
+        else:
+            self.seq = max(0, self.head - self.num_slots + 1)
+
+    # how many slots are waiting to be read
+    def available(self):
+        return self.head - self.seq
+
+    # the next slot, waiting up to timeout seconds for it (forever if None)
+    # returns None if the publisher closed the ring or the time ran out
+    def read(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            head = int(self.header[_HEAD])
+            if self.seq < head:
+                break
+            if self.header[_CLOSED]:
+                return None
+            if deadline is not None and time.time() >= deadline:
+                return None
+            time.sleep(self.poll_interval)
+
+        while True:
+            # the slot being written is the one for head, so the oldest
+            # intact one is num_slots - 1 back
+            oldest = head - self.num_slots + 1
+            if self.seq < oldest:
+                self.missed += oldest - self.seq
+                self.seq = oldest
+
+            s = self.seq
+            i = s % self.num_slots
+            if self.seqs[i] == s:
+                break
+            # overwritten since head was read
+            head = int(self.header[_HEAD])
+
+        n = int(self.lengths[i])
+        timestamp = float(self.times[i])
+        row = self._rows[i]
+        self.seq = s + 1
+        self.received += 1
+        return s, (row if n == len(row) else row[:n]), timestamp
+
+    # whether the slot read as seq still holds it, i.e. its samples
+    # weren't overwritten while they were being used
+    def valid(self, seq):
+        return self.seqs[seq % self.num_slots] == seq
+
+    # yields (seq, samples, timestamp) until the publisher closes the ring
+    def __iter__(self):
+        while True:
+            r = self.read()
+            if r is None:
+                return
+            yield r
+
+    def close(self):
+        if self.shm is None:
+            return
+        self._rows = None
+        self._unmap()
+        self.shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,122 @@
+# Checks of the asyncio calls (aiohackrf.py) that run without a HackRF:
+#   python -m pytest test_aiohackrf.py
+
+import asyncio
+import time
+import numpy as np
+
+from libhackrf import *
+from backends import SyntheticBackend
+
+
+# a device that takes a while to start RX, as a real one does on USB
+class _SlowStartBackend(SyntheticBackend):
+
+    def hackrf_start_rx(self, dev_p, callback, rx_ctx):
+        time.sleep(0.3)
+        return SyntheticBackend.hackrf_start_rx(self, dev_p, callback, rx_ctx)
+
+
+def _virtual_hackrf(backend_class=SyntheticBackend, sample_rate=2e6):
+    backend = backend_class()
+    hackrf = HackRF(backend=backend)
+    hackrf.sample_rate = sample_rate
+    return hackrf, backend
+
+
+# the longest the loop went without running while coro ran
+async def _longest_stall(coro):
+    stall = [0.0]
+    running = [True]
+
+    async def ticker():
+        last = time.perf_counter()
+        while running[0]:
+            await asyncio.sleep(0.01)
+            now = time.perf_counter()
+            stall[0] = max(stall[0], now - last)
+            last = now
+
+    task = asyncio.ensure_future(ticker())
+    await asyncio.sleep(0)
+    try:
+        result = await coro
+    finally:
+        running[0] = False
+        await task
+    return result, stall[0]
+
+
+def test_astream():
+    hackrf, backend = _virtual_hackrf(_SlowStartBackend)
+
+    async def blocks():
+        got = []
+        async for block in hackrf.astream(block_size=65536, num_blocks=4,
+                timeout=5):
+            got.append(block.copy())
+        return got
+
+    got, stall = asyncio.run(_longest_stall(blocks()))
+    assert len(got) == 4
+    assert all(len(block) == 2*65536 for block in got)
+    # the loop kept running while RX started
+    assert stall < 0.2, stall
+    assert not backend.streaming
+    hackrf.close()
+
+
+def test_aread_samples():
+    hackrf, backend = _virtual_hackrf(_SlowStartBackend)
+    iq, stall = asyncio.run(_longest_stall(
+            hackrf.aread_samples(100000, timeout=5)))
+    assert len(iq) == 100000 and iq.dtype == np.complex128
+    assert stall < 0.2, stall
+
+    raw = asyncio.run(hackrf.aread_samples(1000, dtype=None, timeout=5))
+    assert len(raw) == 2000 and raw.dtype == np.int8
+    assert not backend.streaming
+    hackrf.close()
+
+
+# cancelling stops RX, also while it is still starting
+def test_aread_samples_cancel():
+    hackrf, backend = _virtual_hackrf(_SlowStartBackend, sample_rate=1e6)
+
+    async def cancel_after(seconds):
+        task = asyncio.ensure_future(hackrf.aread_samples(10e6))
+        await asyncio.sleep(seconds)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            return True
+        return False
+
+    for seconds in (0.1, 0.5):
+        assert asyncio.run(cancel_after(seconds))
+        assert not backend.streaming
+        assert hackrf.capture_listener is None
+    hackrf.close()
+
+
+def test_aconfigure():
+    hackrf, backend = _virtual_hackrf()
+
+    async def configure():
+        first = await hackrf.aconfigure(freq=433.92e6, lna=24)
+        again = await hackrf.aconfigure(freq=433.92e6, lna=24)
+        return first, again
+
+    first, again = asyncio.run(configure())
+    assert sorted(first['changed']) == ['freq', 'lna']
+    assert again['changed'] == []
+    assert backend.center_freq == 433920000 and backend.lna_gain == 24
+    hackrf.close()
+
+
+if __name__ == '__main__':
+    test_astream()
+    test_aread_samples()
+    test_aread_samples_cancel()
+    test_aconfigure()
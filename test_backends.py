@@ -0,0 +1,152 @@
+# Checks of the virtual devices in backends.py:
+#   python -m pytest test_backends.py
+
+import os
+import tempfile
+import time
+import numpy as np
+
+from libhackrf import *
+from backends import FileBackend, SyntheticBackend, TRANSFER_SIZE
+
+
+# starts RX with a callback keeping a copy of every transfer and the time
+# it arrived; returns the list they go to
+def _collect(hackrf, delay=0):
+    got = []
+
+    def callback(samples, seq, timestamp):
+        got.append((time.time(), samples.copy()))
+        if delay:
+            time.sleep(delay)
+        return 0
+
+    hackrf.start_rx(callback, arrays=True)
+    return got
+
+
+def _wait_stopped(hackrf, timeout=5):
+    deadline = time.time() + timeout
+    while hackrf.lib.hackrf_is_streaming(hackrf.dev_p) \
+            == HackRfError.HACKRF_TRUE:
+        assert time.time() < deadline, "still streaming"
+        time.sleep(0.01)
+
+
+def _cs8_file(n):
+    data = np.random.randint(-128, 128, n).astype(np.int8)
+    fd, path = tempfile.mkstemp(suffix='.cs8')
+    os.close(fd)
+    data.tofile(path)
+    return data, path
+
+
+# a transfer arrives once its last sample would have been taken, and the
+# stream keeps to the sample rate
+def test_pacing():
+    backend = SyntheticBackend()
+    hackrf = HackRF(backend=backend)
+    hackrf.sample_rate = 4e6
+    backend.reset()
+    period = TRANSFER_SIZE/2.0/4e6
+
+    t0 = time.time()
+    got = _collect(hackrf)
+    time.sleep(10*period)
+    hackrf.stop_rx()
+    hackrf.close()
+
+    assert got[0][0] - t0 >= 0.9*period
+    times = np.array([t for t, samples in got])
+    assert 8 <= len(times) <= 11
+    assert abs(np.mean(np.diff(times)) - period) < 0.2*period
+    assert backend.overruns == 0
+
+
+# a callback slower than the stream counts overruns
+def test_overruns():
+    backend = SyntheticBackend()
+    hackrf = HackRF(backend=backend)
+    hackrf.sample_rate = 10e6
+    backend.reset()
+    period = TRANSFER_SIZE/2.0/10e6
+
+    _collect(hackrf, delay=2.5*period)
+    time.sleep(12*period)
+    hackrf.stop_rx()
+    hackrf.close()
+    assert backend.overruns > 0
+
+
+# stopping doesn't wait out the transfer being paced
+def test_stop_is_prompt():
+    hackrf = HackRF(backend=SyntheticBackend())
+    hackrf.sample_rate = 1e5                 # 1.3 s per transfer
+    hackrf.lib.reset()
+    _collect(hackrf)
+    time.sleep(0.05)
+    t0 = time.time()
+    hackrf.stop_rx()
+    assert time.time() - t0 < 0.1
+    hackrf.close()
+
+
+# the end of the file ends the stream, after a short last transfer; with
+# loop=True it starts over instead
+def test_file_eof():
+    data, path = _cs8_file(2*TRANSFER_SIZE + TRANSFER_SIZE//2)
+    try:
+        hackrf = HackRF(backend=FileBackend(path, realtime=False))
+        got = _collect(hackrf)
+        _wait_stopped(hackrf)
+        hackrf.stop_rx()
+        hackrf.close()
+        assert [len(samples) for t, samples in got] \
+                == [TRANSFER_SIZE, TRANSFER_SIZE, TRANSFER_SIZE//2]
+        assert np.array_equal(np.concatenate([s for t, s in got]), data)
+
+        hackrf = HackRF(backend=FileBackend(path, loop=True, realtime=False))
+        hackrf.read_samples(3*len(data)//2, timeout=5)
+        hackrf.close()
+        assert np.array_equal(hackrf.buffer, np.concatenate([data]*3))
+    finally:
+        os.remove(path)
+
+
+# every device list handed out is freed again
+def test_device_lists_freed():
+    backend = SyntheticBackend()
+    registry = DeviceRegistry(backend)
+    for i in range(3):
+        registry.refresh()
+    hackrf = HackRF(backend=backend, registry=registry)
+    hackrf.close()
+    assert backend.lists == 3
+    assert backend.lists_freed == backend.lists
+
+
+# tx_sink sees exactly what the TX callback filled transfers with
+def test_tx_sink():
+    sent = []
+    backend = SyntheticBackend(realtime=False,
+            tx_sink=lambda buf: sent.append(buf.copy()))
+    hackrf = HackRF(backend=backend)
+    data = np.random.randint(-128, 128, 3*TRANSFER_SIZE//2).astype(np.int8)
+    result = hackrf.transmit(data)
+    hackrf.close()
+
+    assert result['bytes_sent'] == len(data)
+    assert all(len(buf) == TRANSFER_SIZE for buf in sent)
+    assert backend.tx_bytes == len(sent)*TRANSFER_SIZE
+    sent = np.concatenate(sent)
+    assert np.array_equal(sent[:len(data)], data)
+    assert (sent[len(data):] == 0).all()
+
+
+if __name__ == '__main__':
+    test_pacing()
+    test_overruns()
+    test_stop_is_prompt()
+    test_file_eof()
+    test_device_lists_freed()
+    test_tx_sink()
@@ -0,0 +1,27 @@
+# Checks of dsp.py that run without a HackRF:
+#   python -m pytest test_dsp.py
+
+import numpy as np
+
+import dsp
+
+
+# a full-scale complex tone centred on a bin reads 0 dB whichever way the
+# segments are averaged
+def test_welch_tone_reads_0db():
+    n_fft, rate = 256, 1e6
+    bin_ = 32
+    t = np.arange(200000)
+    tone = np.exp(2j*np.pi*bin_/n_fft*t).astype(np.complex64)
+    for average, alpha in (('linear', 0.1), ('max', 0.1),
+            ('exponential', 0.1), ('exponential', 0.5)):
+        psd = dsp.WelchPSD(n_fft=n_fft, sample_rate=rate, average=average,
+                alpha=alpha, row_rate=1.0, batch=16)
+        for i in range(0, len(tone), 10000):
+            psd.process(tone[i:i+10000])
+        peak = psd.psd()[n_fft//2 + bin_]
+        assert abs(peak) < 0.01, (average, alpha, peak)
+
+
+if __name__ == '__main__':
+    test_welch_tone_reads_0db()
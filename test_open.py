@@ -0,0 +1,112 @@
+# Checks of opening devices through the DeviceRegistry, and of session(),
+# that run without a HackRF:
+#   python -m pytest test_open.py
+
+from libhackrf import *
+import libhackrf
+from backends import SyntheticBackend
+
+
+# stands in for the native library, counting hackrf_init and hackrf_exit
+class _NativeBackend(SyntheticBackend):
+
+    def __init__(self):
+        SyntheticBackend.__init__(self)
+        self.inits = 0
+        self.exits = 0
+
+    def hackrf_init(self):
+        self.inits += 1
+        return HackRfError.HACKRF_SUCCESS
+
+    def hackrf_exit(self):
+        self.exits += 1
+        return HackRfError.HACKRF_SUCCESS
+
+
+# a board whose descriptor has no serial number
+class _NoSerialBackend(SyntheticBackend):
+
+    def hackrf_device_list(self):
+        device_list = SyntheticBackend.hackrf_device_list(self)
+        device_list.contents.serial_numbers[0] = None
+        return device_list
+
+    def hackrf_open_by_serial(self, serial, dev_pp):
+        raise AssertionError("opened by serial")
+
+
+def test_open_by_serial():
+    backend = SyntheticBackend()
+    hackrf = HackRF(backend=backend)
+    assert hackrf._serial_no == backend.serial_string
+    hackrf.close()
+    hackrf = HackRF(serial=backend.serial_string[-8:], backend=backend)
+    hackrf.close()
+    assert backend.lists == backend.lists_freed
+
+
+def test_open_without_serial():
+    backend = _NoSerialBackend()
+    hackrf = HackRF(backend=backend)
+    assert hackrf.device_opened
+    hackrf.close()
+    assert backend.lists == backend.lists_freed
+
+
+# a registry enumerated while nothing was plugged in is enumerated again
+# rather than failing every open after that
+def test_stale_registry():
+    backend = SyntheticBackend()
+    registry = DeviceRegistry(backend)
+    registry._devices = []
+    hackrf = HackRF(backend=backend, registry=registry)
+    hackrf.close()
+    assert registry.enumerations == 1
+
+    try:
+        HackRF(device_index=1, backend=backend, registry=registry)
+    except IOError as e:
+        assert 'index 1' in str(e)
+    else:
+        raise AssertionError("opened a device that isn't there")
+    assert registry.enumerations == 2
+    assert backend.lists == backend.lists_freed
+
+
+# session() leaves the library alone if something else initialized it or
+# a device opened on it is still open
+def test_session():
+    native = _NativeBackend()
+    load_library = libhackrf._load_library
+    libhackrf._load_library = lambda name: native
+    try:
+        with session():
+            pass
+        assert (native.inits, native.exits) == (1, 1)
+
+        hackrf = HackRF()
+        with session() as lib:
+            assert lib is native
+        assert native.exits == 1 and libhackrf.libhackrf is native
+        hackrf.close()
+
+        hackrf_exit()
+        assert native.exits == 2
+        with session():
+            hackrf = HackRF()
+        assert native.exits == 2 and libhackrf.libhackrf is native
+        hackrf.close()
+        hackrf_exit()
+        assert (native.inits, native.exits) == (3, 3)
+    finally:
+        libhackrf._load_library = load_library
+        libhackrf.libhackrf = None
+        libhackrf._registry = None
+
+
+if __name__ == '__main__':
+    test_open_by_serial()
+    test_open_without_serial()
+    test_stale_registry()
+    test_session()
@@ -0,0 +1,136 @@
+# Checks of read_samples and its callback that run without a HackRF:
+#   python -m pytest test_read_samples.py
+# read_samples_cb is fed synthetic transfers directly, and read_samples
+# runs on a FileBackend.
+
+from ctypes import *
+import os
+import tempfile
+import threading
+import time
+import numpy as np
+
+from libhackrf import *
+import libhackrf
+from backends import FileBackend
+
+TRANSFER_SIZE = 262144
+DEV = 0x2000
+
+
+# a HackRF object that was never opened, registered under a fake device
+# pointer so read_samples_cb can find it
+def _unopened_hackrf():
+    hackrf = HackRF.__new__(HackRF)
+    hackrf.dev_p = p_hackrf_device(DEV)
+    hackrf.capture_done = threading.Event()
+    libhackrf._hackrf_dict[DEV] = hackrf
+    return hackrf
+
+# a transfer of data (int8) with valid_length bytes of it valid
+def _transfer(data, valid_length=None):
+    buf = (c_byte*len(data)).from_buffer_copy(data.tobytes())
+    if valid_length is None:
+        valid_length = len(data)
+    transfer = hackrf_transfer(DEV, cast(buf, POINTER(c_byte)), len(data),
+            valid_length, None, None)
+    transfer._data = buf
+    return transfer
+
+def _random(n):
+    return np.random.randint(-128, 128, n).astype(np.int8)
+
+
+def test_capture_stops_at_num_bytes():
+    hackrf = _unopened_hackrf()
+    data = [_random(TRANSFER_SIZE) for i in range(3)]
+    num_samples = 300000        # ends part way into the third transfer
+    out = np.full(2*num_samples + 1000, 99, dtype=np.int8)
+    hackrf._prepare_capture(num_samples, out)
+
+    for d in data:
+        read_samples_cb(pointer(_transfer(d)))
+    assert hackrf.capture_done.is_set()
+    assert hackrf.buffer_offset == 2*num_samples
+    assert np.array_equal(out[:2*num_samples],
+            np.concatenate(data)[:2*num_samples])
+    # nothing written past the end of the capture
+    assert (out[2*num_samples:] == 99).all()
+
+    # transfers after the capture is complete are ignored
+    read_samples_cb(pointer(_transfer(_random(TRANSFER_SIZE))))
+    assert hackrf.buffer_offset == 2*num_samples
+
+
+def test_short_transfer_copies_valid_length():
+    hackrf = _unopened_hackrf()
+    short, full = _random(TRANSFER_SIZE), _random(TRANSFER_SIZE)
+    hackrf._prepare_capture(TRANSFER_SIZE//2)
+
+    read_samples_cb(pointer(_transfer(short, 1000)))
+    assert hackrf.buffer_offset == 1000
+    assert not hackrf.capture_done.is_set()
+
+    read_samples_cb(pointer(_transfer(full)))
+    assert hackrf.capture_done.is_set()
+    assert np.array_equal(hackrf.buffer[:1000], short[:1000])
+    assert np.array_equal(hackrf.buffer[1000:], full[:TRANSFER_SIZE - 1000])
+
+
+def test_out_is_reused_and_checked():
+    data = _random(2*1000000)
+    fd, path = tempfile.mkstemp(suffix='.cs8')
+    os.close(fd)
+    try:
+        data.tofile(path)
+        hackrf = HackRF(backend=FileBackend(path, realtime=False))
+        out = np.empty(2*500000, dtype=np.int8)
+        hackrf.read_samples(500000, out=out, timeout=5)
+        assert np.shares_memory(hackrf.buffer, out)
+        assert np.array_equal(out, data[:2*500000])
+        # and again into the same array
+        hackrf.read_samples(500000, out=out, timeout=5)
+        assert np.shares_memory(hackrf.buffer, out)
+
+        for bad in (np.empty(1000, dtype=np.int8),
+                np.empty(4*500000, dtype=np.int8)[::2]):
+            try:
+                hackrf.read_samples(500000, out=bad)
+            except ValueError:
+                pass
+            else:
+                raise AssertionError("read_samples accepted a bad out")
+        hackrf.close()
+    finally:
+        os.remove(path)
+
+
+# copying is the only per-transfer work, so the cost of a transfer must not
+# depend on how big the capture is
+def test_copy_cost_is_linear():
+    hackrf = _unopened_hackrf()
+    p = pointer(_transfer(_random(TRANSFER_SIZE)))
+
+    def per_transfer(num_samples):
+        best = None
+        for i in range(3):
+            hackrf._prepare_capture(num_samples)
+            n = 0
+            t0 = time.perf_counter()
+            while not hackrf.capture_done.is_set():
+                read_samples_cb(p)
+                n += 1
+            dt = (time.perf_counter() - t0)/n
+            best = dt if best is None else min(best, dt)
+        return best
+
+    small = per_transfer(2**20)
+    large = per_transfer(2**23)
+    assert large < 3*small, (small, large)
+
+
+if __name__ == '__main__':
+    test_capture_stops_at_num_bytes()
+    test_short_transfer_copies_valid_length()
+    test_out_is_reused_and_checked()
+    test_copy_cost_is_linear()
@@ -0,0 +1,95 @@
+# Checks of HackRF.record and record_archive that run without a HackRF:
+#   python -m pytest test_record.py
+# Both record from virtual backends straight after opening them, so the
+# device only starts streaming once hackrf_start_rx has built its signal.
+
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from libhackrf import *
+from backends import FileBackend, SyntheticBackend
+import iqarchive
+
+
+def _tmpdir():
+    return tempfile.mkdtemp(prefix='pyhackrf-test-')
+
+
+def test_record_fresh_synthetic():
+    d = _tmpdir()
+    try:
+        path = os.path.join(d, 'tone.sigmf-data')
+        hackrf = HackRF(backend=SyntheticBackend(realtime=False))
+        hackrf.sample_rate = 10e6
+        hackrf.center_freq = 433.92e6
+        result = hackrf.record(path, num_samples=3000000, timeout=5)
+        hackrf.close()
+
+        assert result['bytes_written'] == 6000000
+        assert result['dropped_blocks'] == 0
+        assert os.path.getsize(path) == 6000000
+
+        assert result['meta_path'] == os.path.join(d, 'tone.sigmf-meta')
+        with open(result['meta_path']) as f:
+            meta = json.load(f)
+        assert meta['global']['core:datatype'] == 'ci8'
+        assert meta['global']['core:sample_rate'] == 10e6
+        assert meta['captures'][0]['core:frequency'] == 433.92e6
+    finally:
+        shutil.rmtree(d)
+
+
+# the file ends before num_samples: record fails, and what is left on disk
+# is exactly what was received rather than the preallocated size
+def test_record_truncated_at_eof():
+    d = _tmpdir()
+    try:
+        source = os.path.join(d, 'source.cs8')
+        data = np.random.randint(-128, 128, 5*262144).astype(np.int8)
+        data.tofile(source)
+
+        path = os.path.join(d, 'short.cs8')
+        hackrf = HackRF(backend=FileBackend(source, realtime=False))
+        try:
+            hackrf.record(path, num_samples=1000000, block_size=131072,
+                    timeout=5)
+        except IOError as e:
+            assert 'stopped streaming' in str(e)
+        else:
+            raise AssertionError("record ran past the end of the source")
+        hackrf.close()
+
+        assert os.path.getsize(path) == len(data)
+        assert np.array_equal(np.fromfile(path, dtype=np.int8), data)
+        assert os.path.exists(path + '.sigmf-meta')
+    finally:
+        shutil.rmtree(d)
+
+
+def test_record_archive_fresh_synthetic():
+    d = _tmpdir()
+    try:
+        path = os.path.join(d, 'tone.iqa')
+        hackrf = HackRF(backend=SyntheticBackend(realtime=False, seed=1))
+        result = hackrf.record_archive(path, num_samples=1 << 21,
+                chunk_samples=1 << 18, timeout=5)
+        hackrf.close()
+
+        assert result['samples_written'] == 1 << 21
+        assert result['dropped_blocks'] == 0
+        reader = iqarchive.ArchiveReader(path)
+        iq = reader.read(0, 1 << 21, dtype=None)
+        reader.close()
+        assert len(iq) == 2 << 21
+        assert np.abs(iq.astype(np.float32)).max() > 0
+    finally:
+        shutil.rmtree(d)
+
+
+if __name__ == '__main__':
+    test_record_fresh_synthetic()
+    test_record_truncated_at_eof()
+    test_record_archive_fresh_synthetic()
@@ -0,0 +1,67 @@
+# Checks of HackRF.sweep that run without a HackRF:
+#   python -m pytest test_sweep.py
+
+import numpy as np
+
+from libhackrf import *
+from backends import SyntheticBackend
+
+
+# A band with one tone at tone_hz.  Like libhackrf, the TRANSFER_COUNT
+# transfers after the ones already handed to the callback were taken
+# before a retune, so they still hold the old frequency's signal.
+class _BandBackend(SyntheticBackend):
+
+    def __init__(self, tone_hz, **kwargs):
+        SyntheticBackend.__init__(self, table_transfers=2, seed=1, **kwargs)
+        self.tone_hz = tone_hz
+        self.completed = 0
+        self._retune = None
+
+    def _table_at(self, center):
+        offset = self.tone_hz - center
+        self.tones = [(offset, 0.5)] if abs(offset) < self.sample_rate/2 \
+                else []
+        return self.make_table()
+
+    def reset(self):
+        self.table = self._table_at(self.center_freq)
+        self.index = 0
+        self._retune = None
+
+    def hackrf_set_freq(self, dev_p, freq):
+        SyntheticBackend.hackrf_set_freq(self, dev_p, freq)
+        self._retune = (self.completed + TRANSFER_COUNT, self._table_at(freq))
+        return HackRfError.HACKRF_SUCCESS
+
+    def next_transfer(self):
+        # every transfer before this one has been through the callback
+        self.completed = self.transfers
+        retune = self._retune
+        if retune is not None and self.transfers >= retune[0]:
+            self.table = retune[1]
+            self._retune = None
+        return SyntheticBackend.next_transfer(self)
+
+
+# paced, so each step really has to wait out the transfers in flight
+def test_sweep_finds_tone():
+    tone = 107.3e6
+    hackrf = HackRF(backend=_BandBackend(tone))
+    hackrf.sample_rate = 10e6
+    for result in hackrf.sweep(100e6, 125e6, bin_width=100e3, num_passes=3,
+            timeout=5):
+        freqs, power = result['freqs'], result['power']
+        assert result['steps'] == 4
+        assert freqs[0] >= 100e6 and freqs[-1] < 125e6
+
+        peak = np.argmax(power)
+        assert abs(freqs[peak] - tone) <= 100e3
+        assert power[peak] > -10
+        # nothing from a previous step's frequency leaks in elsewhere
+        assert (power[np.abs(freqs - tone) > 500e3] < -30).all()
+    hackrf.close()
+
+
+if __name__ == '__main__':
+    test_sweep_finds_tone()
@@ -0,0 +1,65 @@
+# Checks of HackRF.transmit and the TX sources that run without a HackRF:
+#   python -m pytest test_transmit.py
+
+import numpy as np
+
+from libhackrf import *
+from backends import SyntheticBackend
+import iqconvert
+
+
+def _virtual_hackrf(sink=None):
+    return HackRF(backend=SyntheticBackend(realtime=False, tx_sink=sink))
+
+
+def _rejects(fn, *args):
+    try:
+        fn(*args)
+    except ValueError:
+        return True
+    return False
+
+
+# only complex and int8 samples can be sent; other arrays used to go out
+# as their raw bytes
+def test_tx_dtypes():
+    for dtype in (np.float32, np.float64, np.int16, np.uint8):
+        assert _rejects(ArrayTxSource, np.zeros(1000, dtype))
+
+    hackrf = _virtual_hackrf()
+    assert _rejects(hackrf.transmit, np.zeros(1000))
+    assert hackrf.transmit(np.zeros(1000, np.int8))['bytes_sent'] == 1000
+    assert hackrf.transmit(np.zeros(1000, np.complex64))['bytes_sent'] \
+            == 2000
+    hackrf.close()
+
+
+def test_stream_rejects_bad_blocks():
+    hackrf = _virtual_hackrf()
+    for bad in (np.zeros(4, np.float32), np.zeros(3, np.int8)):
+        blocks = iter([np.zeros(10, np.int8), bad, np.zeros(10, np.int8)])
+        assert _rejects(hackrf.transmit, blocks)
+    hackrf.close()
+
+
+def test_stream_contents():
+    sent = []
+    hackrf = _virtual_hackrf(lambda buf: sent.append(buf.copy()))
+    iq = np.exp(2j*np.pi*np.arange(100000)/100.0)*0.5
+    blocks = [iq[:30000], np.zeros(1000, np.int8), iq[30000:]]
+    result = hackrf.transmit(iter(blocks))
+    hackrf.close()
+
+    expected = np.concatenate([iqconvert.complex_to_int8(iq[:30000]),
+            np.zeros(1000, np.int8), iqconvert.complex_to_int8(iq[30000:])])
+    assert result['bytes_sent'] == len(expected)
+    sent = np.concatenate(sent)
+    assert np.array_equal(sent[:len(expected)], expected)
+    # the rest of the last transfer is silence
+    assert (sent[len(expected):] == 0).all()
+
+
+if __name__ == '__main__':
+    test_tx_dtypes()
+    test_stream_rejects_bad_blocks()
+    test_stream_contents()